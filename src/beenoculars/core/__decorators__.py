@@ -6,6 +6,7 @@ from beenoculars.config.configs import CONFIGS
 from beenoculars.core import EventType, GUIFramework
 from beenoculars.core.pipelines import (
     AbstractProcess,
+    ImageProcessingPipeline,
     ProcessFactory,
     ProcessLogic,
     ProcessLogicProperty,
@@ -87,7 +88,9 @@ def _silence(element, eventType: EventType, second_element):
             raise ValueError(f"Unknown GUI framework: {CONFIGS.gui_framework}")
 
 
-def processLogic(func: Callable[..., Dict]) -> Callable[..., ProcessLogic]:
+def processLogic(func: Callable[..., Dict] | None = None,
+                 *,
+                 outputs: tuple[str, ...] | None = None) -> Callable[..., ProcessLogic]:
     """A decorator for creating inline process.
 
        It can turn a function to a process, as long as the function
@@ -105,12 +108,18 @@ def processLogic(func: Callable[..., Dict]) -> Callable[..., ProcessLogic]:
 
             proc1 >> proc2()
 
+           The names of the returned payload can be declared, so the
+           pipelines can check the down-stream processes when they are built:
+           @processLogic(outputs=("value",))
+
     Parameters
     ----------
     func : Callable[..., Dict]
         Callable function that contains the logic of creating the process.
         The Callable function must include '**kwargs' in its arguments and
         returns a Dict as it payloads.
+    outputs : tuple[str, ...] | None, optional
+        The names of the returned payload, by default None (unknown).
 
     Returns
     -------
@@ -118,14 +127,18 @@ def processLogic(func: Callable[..., Dict]) -> Callable[..., ProcessLogic]:
         The decorated process. By calling it without any argument,
         it returns a process that can be joined or forked to others.
     """
-    p_logic = ProcessLogic(func)
+    if func is None:
+        return functools.partial(processLogic, outputs=outputs)
+    p_logic = ProcessLogic(func, outputs=outputs)
 
     def logic() -> ProcessLogic:
         return p_logic
     return logic
 
 
-def processLogicProperty(func: Callable[..., Dict]) -> property:
+def processLogicProperty(func: Callable[..., Dict] | None = None,
+                         *,
+                         outputs: tuple[str, ...] | None = None) -> property:
     """A decorator for creating inline process inside classes as a property.
 
        It can turn a class method to a process as a property, as long as the method
@@ -150,6 +163,9 @@ def processLogicProperty(func: Callable[..., Dict]) -> property:
         A method that defined in a class that contains the logic of creating
         the process. The Callable method must have '**kwargs' in its arguments
         (including the default 'self' argument) and returns a Dict as it payloads.
+    outputs : tuple[str, ...] | None, optional
+        The names of the returned payload, by default None (unknown).
+        (see processLogic)
 
     Returns
     -------
@@ -157,7 +173,9 @@ def processLogicProperty(func: Callable[..., Dict]) -> property:
         The decorated process. By using it like a property,
         it returns a process that can be joined or forked to others.
     """
-    p_logic = ProcessLogicProperty(func)
+    if func is None:
+        return functools.partial(processLogicProperty, outputs=outputs)
+    p_logic = ProcessLogicProperty(func, outputs=outputs)
 
     def logic(caller) -> ProcessLogicProperty:
         p_logic.caller_class = caller
@@ -177,7 +195,9 @@ def processFactory(cache: bool,
     ----------
     cache : bool
         Cache the created pipeline based on the arguments that pass to
-        the factory function.
+        the factory function. The cached pipelines are also compiled
+        once (see ImageProcessingPipeline.compile), so their runs reuse
+        the same execution plan.
     cache_size : int, optional
         The size of the cache, by default 256
     """
@@ -188,7 +208,10 @@ def processFactory(cache: bool,
             @functools.lru_cache(cache_size)
             def cached_factory(*args, **kwargs) -> AbstractProcess:
                 """Parametrisation arguments are passed here."""
-                return p_factory.create(*args, **kwargs)
+                process = p_factory.create(*args, **kwargs)
+                if isinstance(process, ImageProcessingPipeline):
+                    process.compile()
+                return process
             return cached_factory
         else:
             def factory(*args, **kwargs) -> AbstractProcess:
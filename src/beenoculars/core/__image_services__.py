@@ -9,12 +9,16 @@ from beenoculars.core.pipelines import Process
 
 
 class ToOpenCVImageProcess(Process):
+    outputs = ("image",)
+
     @abstractmethod
     def __call__(self, *, image: ndarray, **kwargs) -> Dict:
         pass
 
 
 class ToFrameworkImageProcess(Process):
+    outputs = ("image",)
+
     @abstractmethod
     def __call__(self, *, image: Any, **kwargs) -> Dict:
         pass
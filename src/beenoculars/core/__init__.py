@@ -20,9 +20,26 @@ from .__decorators__ import (  # noqa; service_callback,
     silence_crossed_events,
 )
 from .__image_services__ import ProcessesRegistry  # noqa
+from .executors import (  # noqa
+    ForkExecutor,
+    SequentialForkExecutor,
+    ThreadPoolForkExecutor,
+    set_default_fork_executor,
+)
 from .__image_services__ import ToFrameworkImageProcess as ToFrameworkImage  # noqa
 from .__image_services__ import ToOpenCVImageProcess as ToOpenCVImage  # noqa
 from .__loggers__ import __dummy__  # noqa
 from .__safe_calls__ import int_, safe_async_call, safe_call  # noqa
+from .buffers import BufferPool  # noqa
+from .caches import CachedProcess, DiskResultCache, ResultCache  # noqa
+from .cancellation import CancellationToken, PipelineCancelledException, using_token  # noqa
+from .memo import StageMemo  # noqa
+from .payloads import Payload  # noqa
+from .plans import register_rewrite  # noqa
+from .profiling import Profiler  # noqa
+from .ragged import RaggedArray  # noqa
 from .pipelines import ProcessPassThrough  # noqa
 from .pipelines import ImageProcessingPipeline, Process  # noqa
+from .runners import ProcessPoolRunner  # noqa
+from .schedulers import LatestWinsScheduler  # noqa
+from .streaming import StreamingExecutor  # noqa
@@ -1,4 +1,7 @@
 
+from beenoculars.core.cancellation import PipelineCancelledException
+
+
 def int_(value, /, base: int = 10, default: int = 0):
     try:
         return int(value)
@@ -41,13 +44,17 @@ def safe_call(log, exceptions={}):
         A logger instance to write the errors.
     exceptions : dict, optional
         Dictionary of exceptions and thier corresponding messages to catch and
-        log, instead of showing file and line number, by default {}
+        log, instead of showing file and line number, by default {}.
+        PipelineCancelledException is not an error, it is logged as debug.
     """
     def try_call(func):
 
         def caller(*args, **kwargs):
             try:
                 return func(*args, **kwargs)
+            except PipelineCancelledException as e:
+                # A cancelled run is not an error
+                log.debug(f"{e}")
             except Exception as e:
                 if type(e) in exceptions:
                     log.error(f"{exceptions[type(e)]}")
@@ -67,12 +74,16 @@ def safe_async_call(log, exceptions={}):
         A logger instance to write the errors.
     exceptions : dict, optional
         Dictionary of exceptions and thier corresponding messages to catch and
-        log, instead of showing file and line number, by default {}
+        log, instead of showing file and line number, by default {}.
+        PipelineCancelledException is not an error, it is logged as debug.
     """
     def try_call(func):
         async def caller(*args, **kwargs):
             try:
                 return await func(*args, **kwargs)
+            except PipelineCancelledException as e:
+                # A cancelled run is not an error
+                log.debug(f"{e}")
             except Exception as e:
                 if type(e) in exceptions:
                     log.error(f"{exceptions[type(e)]}")
@@ -0,0 +1,400 @@
+"""The image buffers of the pipelines: a pool and copy-on-write.
+
+   Notes:
+   ------
+       1- The image processes draw their output arrays ('dst=' of OpenCV)
+          from the pool of the running pipeline by 'out_buffer', instead of
+          allocating new full resolution arrays for every frame. Without a
+          pool, 'out_buffer' is None and OpenCV allocates them as before.
+
+       2- A pipeline uses a pool by 'ImageProcessingPipeline.use_buffers'. Its
+          compiled plan makes the pool current while it runs (it follows
+          the branches of the forks to their threads) and gives an array
+          back to the pool when it is dropped from the payload: it is
+          overwritten by a later stage or is not read anymore (see the
+          liveness of beenoculars.core.plans).
+
+       3- An array is only given back if it has come from the pool and
+          nothing else references it (e.g. the caller, a StageMemo, a cache
+          or another name of the payload). So the results that are kept
+          elsewhere are never overwritten.
+
+       4- The temporary arrays of a process can be borrowed with 'borrowed',
+          which gives them back unconditionally at the end of the block.
+
+       5- The arrays are copy-on-write: the plans pass the writeable arrays of
+          the caller and the ones that the stages return as read-only views,
+          so they can be shared (e.g. by PassThrough, a memo or a cache)
+          without copies. A process that changes an argument in-place
+          declares it by 'mutates' (e.g. mutates = ("image",)) and it gets a
+          writeable array: the returned one if nothing else references it or
+          a copy (see 'own').
+
+       6- The arrays themselves are never made read-only, since they may
+          belong to the caller or to other code (e.g. a decoded frame), and
+          the caller gets them back instead of their views (see 'originals'),
+          unless they are shared with the next runs (e.g. by a StageMemo).
+"""
+from __future__ import annotations
+
+import contextvars
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Iterator, Mapping
+
+import numpy as np
+from numpy import ndarray
+
+from beenoculars.config import Config
+from beenoculars.core.ragged import RaggedArray
+
+# The pool of the running pipeline, if it uses one
+_current_pool: contextvars.ContextVar[BufferPool | None] = contextvars.ContextVar(
+    "beenoculars_buffer_pool", default=None)
+
+
+def _probe(array: ndarray) -> int:
+    return sys.getrefcount(array)
+
+
+def _probe_item(payload: Mapping[str, Any], name: str) -> int:
+    return sys.getrefcount(payload[name])
+
+
+# The read-only views of the payloads by their id, with what they view and
+# whether a process has returned it (see 'read_only' and 'freeze').
+__views: dict[int, tuple[weakref.ref, Any, bool]] = {}
+
+# The reference count of an array that is only referenced by the argument
+# of a function, or by a payload (it depends on the version of Python).
+_UNREFERENCED = _probe(np.empty(1))
+_UNREFERENCED_ITEM = _probe_item({"array": np.empty(1)}, "array")
+
+
+def _thaw(array: ndarray) -> None:
+    """Make an array that owns its data writeable again."""
+    if not array.flags.writeable:
+        from beenoculars.core.caches import forget
+        forget(array)
+        array.flags.writeable = True
+
+
+class BufferPool:
+    def __init__(self, max_bytes: int | None = None):
+        """The free arrays by their shape and dtype, bounded by their bytes.
+
+        Parameters
+        ----------
+        max_bytes : int | None, optional
+            The bytes of the free arrays that are kept, by default None,
+            which is the 'buffer_pool_mb' of the 'pipeline' section of config.toml.
+        """
+        if max_bytes is None:
+            max_bytes = int(Config.get("pipeline", {}).get("buffer_pool_mb", 64) * 2**20)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._free: OrderedDict[tuple, list[ndarray]] = OrderedDict()
+        # The arrays that are lent, by their id
+        self._lent: dict[int, weakref.ref] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: tuple[int, ...], dtype=np.uint8) -> ndarray:
+        """An array of the shape and dtype, with undefined content."""
+        key = (tuple(shape), np.dtype(dtype).str)
+        array = None
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                array = free.pop()
+                self.nbytes -= array.nbytes
+                self.hits += 1
+            else:
+                self.misses += 1
+        if array is None:
+            array = np.empty(shape, dtype)
+        self._lend(array)
+        return array
+
+    def _lend(self, array: ndarray) -> None:
+        key = id(array)
+
+        def forget(ref, key=key):
+            if self._lent.get(key) is ref:
+                del self._lent[key]
+        self._lent[key] = weakref.ref(array, forget)
+
+    def release(self, array: ndarray) -> bool:
+        """Give an array back, if it is from the pool and nothing else references it.
+
+           The frozen arrays are made writeable again (see the notes of the module).
+
+           The array must be passed as a temporary, e.g. release(payload.pop(name)),
+           since a local variable of the caller is a reference, too.
+
+        Returns
+        -------
+        bool
+            Whether the array has been given back.
+        """
+        if sys.getrefcount(array) > _UNREFERENCED:
+            return False
+        if not array.flags.owndata:
+            # The read-only view of a returned array (see 'freeze')
+            array = _returned_base(array)
+            if array is None:
+                return False
+        ref = self._lent.get(id(array))
+        if ref is None or ref() is not array or not array.flags.owndata:
+            return False
+        return self._give_back(array)
+
+    def _give_back(self, array: ndarray) -> bool:
+        _thaw(array)
+        key = (array.shape, array.dtype.str)
+        with self._lock:
+            self._lent.pop(id(array), None)
+            if array.nbytes > self.max_bytes:
+                return False
+            self._free.setdefault(key, []).append(array)
+            self._free.move_to_end(key)
+            self.nbytes += array.nbytes
+            # Drop the arrays of the least recently used shapes first
+            while self.nbytes > self.max_bytes:
+                oldest = next(iter(self._free))
+                free = self._free[oldest]
+                self.nbytes -= free.pop(0).nbytes
+                if len(free) == 0:
+                    del self._free[oldest]
+        return True
+
+    @contextmanager
+    def borrowed(self, shape: tuple[int, ...], dtype=np.uint8) -> Iterator[ndarray]:
+        """Borrow a temporary array, which is given back at the end of the block.
+
+           Example:
+               with pool.borrowed(image.shape) as rgb:
+                   cv.cvtColor(image, cv.COLOR_BGR2RGB, dst=rgb)
+                   data = rgb.tobytes()
+        """
+        array = self.acquire(shape, dtype)
+        try:
+            yield array
+        finally:
+            self._give_back(array)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._free.clear()
+            self.nbytes = 0
+
+    def __repr__(self) -> str:
+        return (f"BufferPool(nbytes={self.nbytes}, max_bytes={self.max_bytes}, "
+                f"hits={self.hits}, misses={self.misses})")
+
+
+def current_buffer_pool() -> BufferPool | None:
+    """The pool of the running pipeline, or None."""
+    return _current_pool.get()
+
+
+@contextmanager
+def using_buffer_pool(pool: BufferPool | None) -> Iterator[None]:
+    """Make a pool current in the block (e.g. while a plan runs)."""
+    token = _current_pool.set(pool)
+    try:
+        yield
+    finally:
+        _current_pool.reset(token)
+
+
+def out_buffer(shape: tuple[int, ...], dtype=np.uint8) -> ndarray | None:
+    """An output array from the current pool, or None, so OpenCV allocates it.
+
+       Example:
+           gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY, dst=out_buffer(image.shape[:2]))
+    """
+    pool = _current_pool.get()
+    if pool is None:
+        return None
+    return pool.acquire(shape, dtype)
+
+
+@contextmanager
+def borrowed(shape: tuple[int, ...], dtype=np.uint8) -> Iterator[ndarray]:
+    """Borrow a temporary array from the current pool, or a new one (see 'BufferPool.borrowed')."""
+    pool = _current_pool.get()
+    if pool is None:
+        yield np.empty(shape, dtype)
+    else:
+        with pool.borrowed(shape, dtype) as array:
+            yield array
+
+
+def _view_of(value: Any, returned: bool) -> Any:
+    """A read-only view of an array or a RaggedArray, which is registered."""
+    if isinstance(value, ndarray):
+        view = value.view()
+        view.flags.writeable = False
+    else:
+        view = RaggedArray(*(_view_of(a, returned) if a.flags.writeable else a
+                             for a in (value.values, value.starts, value.ends)))
+    key = id(view)
+    __views[key] = (weakref.ref(view, lambda _: __views.pop(key, None)), value, returned)
+    return view
+
+
+def _registered(value: Any) -> tuple | None:
+    entry = __views.get(id(value))
+    if entry is not None and entry[0]() is value:
+        return entry
+    return None
+
+
+def _is_writeable(value: Any) -> bool:
+    if isinstance(value, ndarray):
+        return value.flags.writeable
+    return (isinstance(value, RaggedArray) and
+            any(a.flags.writeable for a in (value.values, value.starts, value.ends)))
+
+
+def read_only(payload: dict) -> dict:
+    """Replace the writeable arrays of a payload (in-place) by read-only views of them."""
+    for name, value in payload.items():
+        if _is_writeable(value):
+            payload[name] = _view_of(value, returned=False)
+    return payload
+
+
+def freeze(payload: dict) -> None:
+    """Replace the writeable arrays of a returned payload (in-place) by read-only views of them.
+
+       The arrays themselves are left writeable, since they may be owned by
+       the caller or by other code (e.g. a decoded frame).
+    """
+    for name, value in payload.items():
+        if _is_writeable(value):
+            payload[name] = _view_of(value, returned=True)
+
+
+def originals(payload: dict, returned: bool = True) -> dict:
+    """Replace the read-only views of 'read_only' and 'freeze' (in-place) by what they view.
+
+    Parameters
+    ----------
+    payload : dict
+        The resulting payload of a pipeline, for its caller.
+    returned : bool, optional
+        Replace the views of the arrays that the processes returned, too,
+        by default True. They must stay read-only if they are shared with
+        the next runs (e.g. by a StageMemo).
+    """
+    for name, value in payload.items():
+        entry = _registered(value)
+        if entry is not None and (returned or not entry[2]):
+            payload[name] = entry[1]
+    return payload
+
+
+def is_frozen(array: ndarray) -> bool:
+    """Whether the data of the array cannot change.
+
+       It is read-only and so are the arrays it views, or it is the view of
+       an array that a process has returned (see 'freeze'), which is only
+       changed by the processes that own it (see 'own').
+    """
+    while isinstance(array, ndarray):
+        entry = _registered(array)
+        if entry is not None and entry[2]:
+            return True
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return True
+
+
+def _original_refcount(view: ndarray) -> int:
+    original = __views[id(view)][1]
+    return sys.getrefcount(original)
+
+
+def _probe_view() -> int:
+    view = _view_of(np.empty(1), returned=True)
+    return _original_refcount(view)
+
+
+# The reference count of an array that is only referenced by its view
+_VIEWED = _probe_view()
+
+
+def _returned_base(view: ndarray) -> ndarray | None:
+    """The array of the view of a returned array, if it owns its data and only the view references it."""
+    entry = _registered(view)
+    if (entry is None or not entry[2] or not isinstance(entry[1], ndarray) or
+            not entry[1].flags.owndata):
+        return None
+    entry = None
+    if _original_refcount(view) > _VIEWED:
+        return None
+    return __views[id(view)][1]
+
+
+def _exclusive(payload: Mapping[str, Any], name: str) -> bool:
+    """Whether the array of a name owns its data and only the payload references it."""
+    return (sys.getrefcount(payload[name]) <= _UNREFERENCED_ITEM and
+            payload[name].flags.owndata)
+
+
+def _copy(array: ndarray) -> ndarray:
+    dst = out_buffer(array.shape, array.dtype)
+    if dst is None:
+        return array.copy()
+    np.copyto(dst, array)
+    return dst
+
+
+def own(payload: Mapping[str, Any],
+        names: tuple[str, ...],
+        reuse: bool = True) -> Mapping[str, Any]:
+    """The payload of a process that changes the arrays of the names in-place.
+
+    Parameters
+    ----------
+    payload : Mapping[str, Any]
+        The payload of the process.
+    names : tuple[str, ...]
+        The names that the process mutates (see AbstractProcess.mutates).
+    reuse : bool, optional
+        Reuse the arrays that nothing else references, by default True.
+        It must be False when the payload is shared with other threads
+        (e.g. the branches of a fork).
+
+    Returns
+    -------
+    Mapping[str, Any]
+        The payload itself, with the reused arrays made writeable, or a
+        copy of it with copies of the shared arrays (from the current pool).
+    """
+    copies = {}
+    for name in names:
+        if not isinstance(payload.get(name), ndarray):
+            continue
+        if reuse and sys.getrefcount(payload[name]) <= _UNREFERENCED_ITEM:
+            base = _returned_base(payload[name])
+            if base is not None:
+                # The returned array behind its read-only view
+                copies[name] = base
+                continue
+        if reuse and _exclusive(payload, name):
+            _thaw(payload[name])
+        else:
+            copies[name] = _copy(payload[name])
+    if len(copies) == 0:
+        return payload
+    owned = dict(payload)
+    owned.update(copies)
+    return owned
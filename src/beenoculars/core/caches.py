@@ -0,0 +1,580 @@
+"""Content-addressed caches of the results of processes.
+
+   Notes:
+   ------
+       1- A CachedProcess keys the results of a process on the digests of
+          the payload it reads: the bytes (with the shape and dtype) of the
+          ndarrays, and lists/tuples of them or RaggedArrays, and the values
+          of the scalar parameters. So the same image with a threshold that has been used
+          before is a hit, even if it is another object (unlike StageMemo,
+          see beenoculars.core.memo).
+
+       2- Hashing an image is not free (about 1ms per MB with sha256). To
+          hash each image once, the digests of the read-only arrays are
+          remembered by identity. The arrays that a CachedProcess returns
+          are made read-only and tagged with a digest that is derived from
+          their key, so chained cached processes never hash them. The
+          writeable inputs that it passes through are copied first, so the
+          arrays of the caller are never made read-only.
+
+       3- The ResultCache is bounded by the bytes of the arrays it keeps
+          and evicts the least recently used results first. A DiskResultCache
+          can persist its results between the runs of the app, e.g. the
+          contours of the images that have been analysed before.
+"""
+from __future__ import annotations
+
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Hashable, Iterable, Mapping
+
+import numpy as np
+from numpy import ndarray
+
+from beenoculars.config import Config
+from beenoculars.core.contracts import Contract
+from beenoculars.core.payloads import Payload, nbytes
+from beenoculars.core.pipelines import AbstractProcess, ImageProcessingPipeline, Process
+from beenoculars.core.ragged import RaggedArray
+
+# logger
+log = logging.getLogger(__name__)
+
+# sha256 is hardware accelerated on most of the CPUs and it
+# is faster than blake2b and md5 there.
+_hash = hashlib.sha256
+
+_SCALARS = (int, float, complex, str, bytes, bool, type(None), np.generic)
+
+# The digests of the read-only arrays, by their id
+__digests: dict[int, tuple[weakref.ref, bytes]] = {}
+
+
+def _remember(array: ndarray, digest: bytes) -> None:
+    key = id(array)
+    __digests[key] = (weakref.ref(array, lambda _: __digests.pop(key, None)), digest)
+
+
+def _remembered(array: ndarray) -> bytes | None:
+    entry = __digests.get(id(array))
+    if entry is not None and entry[0]() is array:
+        return entry[1]
+    return None
+
+
+def forget(array: ndarray) -> None:
+    """Forget the digest of a read-only array, before it is made writeable again."""
+    entry = __digests.get(id(array))
+    if entry is not None and entry[0]() is array:
+        del __digests[id(array)]
+
+
+def _array_digest(array: ndarray) -> bytes:
+    if not array.flags.writeable:
+        digest = _remembered(array)
+        if digest is not None:
+            return digest
+    h = _hash(f"{array.dtype.str}{array.shape}".encode())
+    h.update(memoryview(np.ascontiguousarray(array)).cast("B"))
+    digest = h.digest()
+    if not array.flags.writeable:
+        _remember(array, digest)
+    return digest
+
+
+def digest(value: Any) -> Hashable | None:
+    """The content key of a payload value.
+
+    Returns
+    -------
+    Hashable | None
+        The digest of an ndarray, or a list/tuple of them (or a RaggedArray),
+        the value of a scalar, or a list/tuple of scalars, otherwise None
+        (not cacheable).
+    """
+    if isinstance(value, ndarray):
+        if value.dtype == object:
+            return None
+        return _array_digest(value)
+    if isinstance(value, RaggedArray):
+        # The same items, whether they share their values or not
+        compact = value.compact()
+        h = _hash(f"RaggedArray{len(value)}".encode())
+        h.update(_array_digest(compact.values))
+        h.update(_array_digest(compact.lengths))
+        return h.digest()
+    if isinstance(value, _SCALARS):
+        return (type(value).__name__, value)
+    if isinstance(value, (list, tuple)):
+        if all(isinstance(v, _SCALARS) for v in value):
+            return (type(value).__name__, tuple(value))
+        if all(isinstance(v, ndarray) and v.dtype != object for v in value):
+            h = _hash(f"{type(value).__name__}{len(value)}".encode())
+            for v in value:
+                h.update(_array_digest(v))
+            return h.digest()
+    return None
+
+
+def _mutable(array: ndarray) -> bool:
+    """Whether the data of the array can be changed: it, or the array it views, is writeable."""
+    while isinstance(array, ndarray):
+        if array.flags.writeable:
+            return True
+        array = array.base
+    return False
+
+
+def _writeable_arrays(payload: Mapping[str, Any]) -> list[ndarray]:
+    arrays = []
+    for value in payload.values():
+        if isinstance(value, RaggedArray):
+            value = (value.values, value.starts, value.ends)
+        elif not isinstance(value, (list, tuple)):
+            value = (value,)
+        # e.g. the read-only views of the writeable arrays in the pipelines
+        arrays.extend(v for v in value if isinstance(v, ndarray) and _mutable(v))
+    return arrays
+
+
+def _owned(value: Any, arguments: list[ndarray]) -> Any:
+    """The value, or a copy of it if it shares the memory of a writeable argument."""
+    def shared(array: ndarray) -> bool:
+        return _mutable(array) and any(np.may_share_memory(array, a) for a in arguments)
+
+    if isinstance(value, ndarray):
+        return value.copy() if shared(value) else value
+    if isinstance(value, RaggedArray):
+        return value.copy() if any(map(shared, (value.values, value.starts, value.ends))) else value
+    if isinstance(value, (list, tuple)) and any(isinstance(v, ndarray) and shared(v) for v in value):
+        return type(value)(v.copy() if isinstance(v, ndarray) and shared(v) else v for v in value)
+    return value
+
+
+def _freeze(key: Hashable,
+            payload: Mapping[str, Any],
+            arguments: Mapping[str, Any] | None = None) -> Payload:
+    """Make the arrays of a cached result read-only and tag them with derived digests.
+
+    The arrays that share the memory of a writeable argument (e.g. passed
+    through) are copied first, so the arrays of the caller stay writeable.
+    """
+    shared = _writeable_arrays(arguments) if arguments else []
+    if shared:
+        payload = Payload({name: _owned(value, shared) for name, value in payload.items()})
+    for value in payload.values():
+        if isinstance(value, ndarray):
+            value.flags.writeable = False
+        elif isinstance(value, RaggedArray):
+            value.freeze()
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                if isinstance(v, ndarray):
+                    v.flags.writeable = False
+    _tag(key, payload)
+    return payload
+
+
+def _tag(key: Hashable, payload: Mapping[str, Any]) -> None:
+    for name, value in payload.items():
+        if isinstance(value, ndarray) and not value.flags.writeable:
+            _remember(value, _hash(repr((key, name)).encode()).digest())
+
+
+class ResultCache:
+    def __init__(self,
+                 max_bytes: int | None = None,
+                 store: DiskResultCache | None = None):
+        """A LRU cache of the results of processes, bounded by their bytes.
+
+        Parameters
+        ----------
+        max_bytes : int | None, optional
+            The memory budget, by default None, which is the
+            'result_cache_mb' of the 'pipeline' section of config.toml.
+        store : DiskResultCache | None, optional
+            A persistent store behind the memory, by default None. The
+            results are written to it and the memory misses are read from it.
+        """
+        if max_bytes is None:
+            max_bytes = int(Config.get("pipeline", {}).get("result_cache_mb", 256) * 2**20)
+        self.max_bytes = max_bytes
+        self.store = store
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        """Return the cached result of the key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        result = self.store.get(key) if self.store is not None else None
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        _tag(key, result)
+        self._put(key, result, nbytes(result))
+        return result
+
+    def put(self, key: Hashable, result: Any, size: int) -> None:
+        """Store a result of 'size' bytes and evict the least recently used ones."""
+        if self.store is not None:
+            self.store.put(key, result)
+        self._put(key, result, size)
+
+    def _put(self, key: Hashable, result: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return (f"ResultCache({self.nbytes}/{self.max_bytes} bytes, hits={self.hits}, "
+                f"misses={self.misses}, evictions={self.evictions})")
+
+
+class DiskResultCache:
+    def __init__(self,
+                 path: str | Path,
+                 max_bytes: int | None = None):
+        """A persistent store of cached results, e.g. in 'app.data_path / "analysis_cache"'.
+
+           Each result is a folder named by the digest of its key. The ndarrays
+           are '.npy' files that are memory-mapped when they are read, a
+           list/tuple of ndarrays is one concatenated file, whose items are read
+           back as views, and a RaggedArray (e.g. the contours) is its values and
+           its offsets. The scalars are in 'meta.json', which is written last,
+           so a crash never leaves a partial result.
+
+        Parameters
+        ----------
+        path : str | Path
+            The folder of the store.
+        max_bytes : int | None, optional
+            The size of the store, by default None, which is the 'disk_cache_mb'
+            of the 'pipeline' section of config.toml. The least recently used
+            results are deleted first.
+        """
+        if max_bytes is None:
+            max_bytes = int(Config.get("pipeline", {}).get("disk_cache_mb", 1024) * 2**20)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # The size and the last access of the results, by their folder name
+        self._index: dict[str, tuple[int, float]] = {}
+        for entry in self.path.iterdir():
+            meta = entry / "meta.json"
+            if meta.is_file():
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                self._index[entry.name] = (size, meta.stat().st_mtime)
+            else:
+                # Left by a crash during a write
+                shutil.rmtree(entry, ignore_errors=True)
+        self.nbytes = sum(size for size, _ in self._index.values())
+
+    @staticmethod
+    def name_of(key: Hashable) -> str:
+        return _hash(repr(key).encode()).hexdigest()
+
+    def get(self, key: Hashable) -> Payload | None:
+        """Read a result, or return None."""
+        name = self.name_of(key)
+        with self._lock:
+            if name not in self._index:
+                self.misses += 1
+                return None
+            self._index[name] = (self._index[name][0], time.time())
+        folder = self.path / name
+        try:
+            result = _load(folder)
+            os.utime(folder / "meta.json")
+        except (OSError, ValueError) as e:
+            log.warning(f"The cached result '{folder}' cannot be read: {e}")
+            self._remove(name)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key: Hashable, result: Mapping[str, Any]) -> bool:
+        """Write a result, unless it has values that cannot be stored.
+
+        Returns
+        -------
+        bool
+            True if the result has been stored.
+        """
+        name = self.name_of(key)
+        if name in self._index:
+            return True
+        tmp = self.path / f".{name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if not _save(tmp, result):
+                shutil.rmtree(tmp, ignore_errors=True)
+                return False
+            os.replace(tmp, self.path / name)
+        except OSError as e:
+            log.warning(f"The result cannot be cached in '{self.path}': {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+            return False
+        size = sum(f.stat().st_size for f in (self.path / name).iterdir())
+        with self._lock:
+            self._index[name] = (size, time.time())
+            self.nbytes += size
+            evicted = []
+            while self.nbytes > self.max_bytes and len(self._index) > 1:
+                oldest = min(self._index, key=lambda n: self._index[n][1])
+                self.nbytes -= self._index.pop(oldest)[0]
+                self.evictions += 1
+                evicted.append(oldest)
+        for oldest in evicted:
+            shutil.rmtree(self.path / oldest, ignore_errors=True)
+        return True
+
+    def _remove(self, name: str) -> None:
+        with self._lock:
+            if name in self._index:
+                self.nbytes -= self._index.pop(name)[0]
+        shutil.rmtree(self.path / name, ignore_errors=True)
+
+    def clear(self) -> None:
+        for name in list(self._index):
+            self._remove(name)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __repr__(self) -> str:
+        return (f"DiskResultCache('{self.path}', {self.nbytes}/{self.max_bytes} bytes, "
+                f"hits={self.hits}, misses={self.misses}, evictions={self.evictions})")
+
+
+def _json_value(value) -> bool:
+    if isinstance(value, (list, tuple)):
+        return all(_json_value(v) for v in value)
+    return isinstance(value, (int, float, str, bool, type(None)))
+
+
+def _save(folder: Path, result: Mapping[str, Any]) -> bool:
+    folder.mkdir()
+    meta = {}
+    for name, value in result.items():
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, ndarray) and value.dtype != object:
+            np.save(folder / f"{name}.npy", value)
+            meta[name] = {"kind": "array"}
+        elif isinstance(value, RaggedArray) and value.values.dtype != object:
+            compact = value.compact()
+            np.save(folder / f"{name}.npy", compact.values)
+            np.save(folder / f"{name}.offsets.npy", compact.offsets)
+            meta[name] = {"kind": "ragged"}
+        elif (isinstance(value, (list, tuple)) and len(value) > 0 and
+              all(isinstance(v, ndarray) for v in value) and
+              len({v.dtype for v in value}) == 1 and value[0].dtype != object):
+            np.save(folder / f"{name}.npy", np.concatenate([v.ravel() for v in value]))
+            meta[name] = {"kind": "arrays",
+                          "container": type(value).__name__,
+                          "shapes": [v.shape for v in value]}
+        elif _json_value(value):
+            meta[name] = {"kind": "value",
+                          "container": type(value).__name__,
+                          "value": value}
+        else:
+            return False
+    with open(folder / "meta.json", "w") as f:
+        json.dump(meta, f)
+    return True
+
+
+def _load(folder: Path) -> Payload:
+    with open(folder / "meta.json") as f:
+        meta = json.load(f)
+    result = Payload()
+    for name, entry in meta.items():
+        match entry["kind"]:
+            case "array":
+                result[name] = np.load(folder / f"{name}.npy", mmap_mode="r")
+            case "arrays":
+                # Plain ndarray views of the memory map are cheaper to slice.
+                flat = np.load(folder / f"{name}.npy", mmap_mode="r").view(ndarray)
+                offsets = list(itertools.accumulate((math.prod(s) for s in entry["shapes"]),
+                                                    initial=0))
+                arrays = [flat[start:end].reshape(shape)
+                          for shape, start, end in zip(entry["shapes"],
+                                                       offsets[:-1],
+                                                       offsets[1:])]
+                result[name] = tuple(arrays) if entry["container"] == "tuple" else arrays
+            case "ragged":
+                offsets = np.load(folder / f"{name}.offsets.npy")
+                result[name] = RaggedArray(
+                    np.load(folder / f"{name}.npy", mmap_mode="r").view(ndarray),
+                    offsets[:-1], offsets[1:])
+            case "value":
+                value = entry["value"]
+                result[name] = tuple(value) if entry["container"] == "tuple" else value
+    return result
+
+
+__instances = itertools.count()
+
+
+def _namespace(process: AbstractProcess) -> str:
+    func = getattr(process, "logic_callback", None)
+    if func is not None:
+        return f"{func.__module__}.{func.__qualname__}"
+    name = f"{type(process).__module__}.{type(process).__qualname__}"
+    if isinstance(process, Process):
+        return name
+    # The instances of a class can have different parameters.
+    return f"{name}#{next(__instances)}"
+
+
+class CachedProcess(AbstractProcess):
+    def __init__(self,
+                 process: AbstractProcess | ImageProcessingPipeline,
+                 cache: ResultCache,
+                 namespace: str | None = None,
+                 reads: Iterable[str] | None = None,
+                 outputs: Iterable[str] | None = None):
+        """Cache the results of a process by the content of the payload it reads.
+
+           Example:
+               cache = ResultCache(max_bytes=512 * 2**20)
+               pipeline = imp.ToBlackWhite.cached(cache) >> imp.ToContours.cached(cache)
+
+        Parameters
+        ----------
+        process : AbstractProcess | ImageProcessingPipeline
+            A pure process, whose results only depend on its named arguments,
+            or a pipeline of them.
+        cache : ResultCache
+            The cache, which can be shared between processes.
+        namespace : str | None, optional
+            The name of the process in the keys, by default None, which is the
+            qualified name of its class (or of its logic callback). The
+            processes that are not singletons (Process) get a unique one.
+            It must be given (and changed with the logic) for the results
+            that are persisted by a DiskResultCache.
+        reads : Iterable[str] | None, optional
+            The names of the key, by default None, which is the names that
+            the process reads. It must be given for pipelines.
+        outputs : Iterable[str] | None, optional
+            The names of the returned payload that are cached (and returned),
+            by default None, which is the declared outputs of the process.
+
+        Raises
+        ------
+        ValueError
+            Raises when the names that the process reads are not known.
+        """
+        contract = process.contract
+        if reads is None:
+            if contract.reads is None:
+                raise ValueError(
+                    f"The names that '{type(process).__name__}' reads are not known "
+                    f"(use the 'reads' argument).")
+            reads = contract.reads
+        self.process = process
+        self.cache = cache
+        self.namespace = namespace or _namespace(process)
+        self.reads = tuple(sorted(reads))
+        self.outputs = tuple(outputs) if outputs is not None else process.outputs
+        self.pure = getattr(process, "pure", True)
+        self.main_thread = getattr(process, "main_thread", False)
+        self._contract = Contract(requires=contract.requires,
+                                  optional=set(self.reads) - contract.requires,
+                                  outputs=self.outputs,
+                                  accepts_any=contract.accepts_any)
+        # The cached processes without some lazy outputs, so the
+        # plans that are compiled again share them (and their memo)
+        self._without: dict[frozenset, CachedProcess] = {}
+
+    @property
+    def contract(self) -> Contract:
+        return self._contract
+
+    @property
+    def lazy_outputs(self) -> tuple[str, ...]:
+        return tuple(name for name in getattr(self.process, "lazy_outputs", ())
+                     if self.outputs is None or name in self.outputs)
+
+    def without(self, names: frozenset) -> AbstractProcess:
+        """The process without the lazy outputs 'names', cached by another namespace."""
+        names = frozenset(names)
+        cached = self._without.get(names)
+        if cached is None:
+            process = self.process.without(names)
+            if process is self.process:
+                return self
+            outputs = (None if self.outputs is None else
+                       tuple(name for name in self.outputs if name not in names))
+            cached = self._without.setdefault(names, CachedProcess(
+                process, self.cache,
+                namespace=f"{self.namespace}-{'-'.join(sorted(names))}",
+                reads=self.reads,
+                outputs=outputs))
+        return cached
+
+    def key(self, payload: Mapping[str, Any]) -> Hashable | None:
+        """The key of the payload, or None if a read value is not cacheable."""
+        digests = []
+        for name in self.reads:
+            d = digest(payload.get(name))
+            if d is None and payload.get(name) is not None:
+                return None
+            digests.append(d)
+        return (self.namespace, self.reads, tuple(digests))
+
+    def __call__(self, **kwargs) -> Mapping[str, Any]:
+        key = self.key(kwargs)
+        if key is None:
+            return self.process(**kwargs)
+        ret = self.cache.get(key)
+        if ret is None:
+            ret = self.process(**kwargs)
+            if self.outputs is not None:
+                ret = Payload({name: ret[name] for name in self.outputs if name in ret})
+            ret = _freeze(key, ret, kwargs)
+            self.cache.put(key, ret, nbytes(ret))
+        return ret
@@ -0,0 +1,123 @@
+"""Cooperative cancellation of the running pipelines.
+
+   Notes:
+   ------
+       1- A CancellationToken is made current by 'using_token' and the
+          pipelines check it between their stages (the interpreted loop,
+          the stages of a compiled plan and the branches of the forks,
+          which inherit it on their threads). A cancelled run raises
+          PipelineCancelledException at the next check.
+
+       2- The processes that loop over many items (e.g. the contours of a
+          large scan) check it inside their loops, too, by iterating
+          over 'cancellable(items)'.
+
+       3- A stage is never interrupted in the middle of an OpenCV call, so
+          the latency of a cancellation is the longest stage (or chunk of a
+          loop) that runs when it is cancelled.
+
+       4- 'safe_call' and 'safe_async_call' treat PipelineCancelledException
+          as benign: it is logged as debug, not as an error.
+
+   Example:
+       token = CancellationToken()
+       with using_token(token):
+           pipeline(image=image)     # token.cancel() from another thread
+"""
+from __future__ import annotations
+
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, TypeVar
+
+_T = TypeVar('_T')
+
+# The token of the running pipeline, if it can be cancelled
+_current_token: contextvars.ContextVar[CancellationToken | None] = contextvars.ContextVar(
+    "beenoculars_cancellation_token", default=None)
+
+
+class PipelineCancelledException(Exception):
+    def __init__(self, message="The pipeline has been cancelled."):
+        self.message = message
+        super().__init__(self.message)
+
+
+class CancellationToken:
+    def __init__(self, parent: CancellationToken | None = None):
+        """A flag that cancels the pipelines that check it (see the notes of the module).
+
+        Parameters
+        ----------
+        parent : CancellationToken | None, optional
+            It is cancelled with its parent, too, by default None.
+            Cancelling it does not cancel the parent.
+        """
+        self._event = threading.Event()
+        self.parent = parent
+        self.reason = ""
+
+    def cancel(self, reason: str = "") -> None:
+        """Cancel the runs of the token, from any thread."""
+        self.reason = reason
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (self.parent is not None and self.parent.cancelled)
+
+    def check(self) -> None:
+        """Raise if the token has been cancelled.
+
+        Raises
+        ------
+        PipelineCancelledException
+            Raises when the token has been cancelled.
+        """
+        if self._event.is_set():
+            raise PipelineCancelledException(
+                self.reason or "The pipeline has been cancelled.")
+        if self.parent is not None:
+            self.parent.check()
+
+    def __repr__(self) -> str:
+        return f"CancellationToken(cancelled={self.cancelled})"
+
+
+def current_token() -> CancellationToken | None:
+    """The token of the running pipeline, or None."""
+    return _current_token.get()
+
+
+@contextmanager
+def using_token(token: CancellationToken | None) -> Iterator[CancellationToken | None]:
+    """Make a token current in the block, so the pipelines that run in it can be cancelled."""
+    reset = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset)
+
+
+def check_cancelled() -> None:
+    """Raise PipelineCancelledException if the current token has been cancelled."""
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+def cancellable(items: Iterable[_T], every: int = 64) -> Iterator[_T]:
+    """Iterate over the items and check the current token every 'every' items.
+
+       Example:
+           hulls = [cv.convexHull(cnt) for cnt in cancellable(contours)]
+    """
+    token = _current_token.get()
+    if token is None:
+        yield from items
+        return
+    for index, item in enumerate(items):
+        if index % every == 0:
+            token.check()
+        yield item
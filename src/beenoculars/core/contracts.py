@@ -0,0 +1,339 @@
+"""Input/output contracts of processes and static validation of pipelines.
+
+   Notes:
+   ------
+       1- The contract of a process is derived once from the signature of its
+          '__call__' (or of its logic callback): the keyword arguments without
+          a default are required, the ones with a default are optional, and
+          '**kwargs' means it accepts (and ignores) the rest of the payload.
+
+       2- The outputs of a process are only known when they are declared
+          (e.g. 'outputs = ("image",)' in the class). A process without
+          declared outputs may return anything, so the names that are
+          required after it are not checked.
+
+       3- A pipeline is validated once when it is built (e.g. by '>>'). The
+          required names that no upstream process returns become the inputs
+          of the pipeline, which are checked once per call, before the
+          first process runs.
+
+       4- The processes after a process without declared outputs cannot be
+          checked when the pipeline is built, so their required names are
+          checked before they are called (see 'PipelineContract.check_process').
+"""
+from __future__ import annotations
+
+import functools
+import inspect
+from typing import Callable, Iterable
+
+_INPUT = "(input of the pipline)"
+
+
+def _name(obj) -> str:
+    return type(obj).__name__
+
+
+class Contract:
+    def __init__(self,
+                 requires: Iterable[str] = (),
+                 optional: Iterable[str] = (),
+                 outputs: Iterable[str] | None = None,
+                 accepts_any: bool = True,
+                 forwards: bool = False,
+                 positional_only: Iterable[str] = ()):
+        """The payload names that a process reads and returns.
+
+        Parameters
+        ----------
+        requires : Iterable[str], optional
+            The names that must be in the payload.
+        optional : Iterable[str], optional
+            The names that are read if they are in the payload.
+        outputs : Iterable[str] | None, optional
+            The names of the returned payload, by default None (unknown).
+        accepts_any : bool, optional
+            The process has '**kwargs', by default True.
+        forwards : bool, optional
+            The process returns its whole input payload (e.g. PassThrough)
+            and so it reads all of it, by default False.
+        positional_only : Iterable[str], optional
+            The required positional-only arguments, which a payload can
+            never provide.
+        """
+        self.requires = frozenset(requires)
+        self.optional = frozenset(optional)
+        self.outputs = None if outputs is None else frozenset(outputs)
+        self.accepts_any = accepts_any
+        self.forwards = forwards
+        self.positional_only = tuple(positional_only)
+
+    @property
+    def reads(self) -> frozenset | None:
+        """The names that the process reads, or None if it reads the whole payload."""
+        if self.forwards:
+            return None
+        return self.requires | self.optional
+
+    @staticmethod
+    def of_callable(func: Callable,
+                    outputs: Iterable[str] | None = None,
+                    skip_first: bool = False) -> Contract:
+        """Derive the contract from the signature of a callable.
+
+        Parameters
+        ----------
+        func : Callable
+            The '__call__' of a process or a logic callback.
+        outputs : Iterable[str] | None, optional
+            The declared outputs, by default None.
+        skip_first : bool, optional
+            Skip the first argument (e.g. 'self' of processLogicProperty).
+        """
+        outputs = None if outputs is None else tuple(outputs)
+        return _of_callable(getattr(func, "__func__", func),
+                            outputs,
+                            skip_first or hasattr(func, "__func__"))
+
+    def __repr__(self) -> str:
+        outputs = "?" if self.outputs is None else sorted(self.outputs)
+        return (f"Contract(requires={sorted(self.requires)}, "
+                f"optional={sorted(self.optional)}, outputs={outputs})")
+
+
+@functools.lru_cache(maxsize=1024)
+def _of_callable(func: Callable, outputs: tuple | None, skip_first: bool) -> Contract:
+    requires, optional, positional_only = [], [], []
+    accepts_any = False
+    try:
+        parameters = list(inspect.signature(func).parameters.values())
+    except (TypeError, ValueError):
+        # e.g. builtins without a signature: nothing can be checked.
+        return Contract(outputs=outputs)
+    if skip_first:
+        parameters = parameters[1:]
+    for p in parameters:
+        match p.kind:
+            case inspect.Parameter.VAR_KEYWORD:
+                accepts_any = True
+            case inspect.Parameter.VAR_POSITIONAL:
+                pass
+            case inspect.Parameter.POSITIONAL_ONLY:
+                if p.default is inspect.Parameter.empty:
+                    positional_only.append(p.name)
+            case _:
+                if p.default is inspect.Parameter.empty:
+                    requires.append(p.name)
+                else:
+                    optional.append(p.name)
+    return Contract(requires, optional, outputs, accepts_any,
+                    positional_only=positional_only)
+
+
+def _incompatible(process: str, previous: str):
+    from beenoculars.core.pipelines import IncompatibleArgsException
+    return IncompatibleArgsException(
+        f"The process '{process}' received incompatible payload from "
+        f"the previous process '{previous}'.")
+
+
+class PipelineContract(Contract):
+    def __init__(self,
+                 requires: dict[str, tuple[int, str, str]],
+                 outputs: Iterable[str] | None,
+                 deferred: dict[int, tuple[frozenset, str]] | None = None):
+        """The contract of a pipeline.
+
+        Parameters
+        ----------
+        requires : dict[str, tuple[int, str, str]]
+            The names that the caller must provide, with the position and
+            the name of the first process that needs it and the name of
+            its previous process.
+        outputs : Iterable[str] | None
+            The names that the processes of the pipeline return, or None if
+            some of them are unknown.
+        deferred : dict[int, tuple[frozenset, str]] | None, optional
+            The required names of the processes (by their id) that follow
+            a process without declared outputs, with the name of their
+            previous process, by default None.
+        """
+        super().__init__(requires=requires.keys(), outputs=outputs,
+                         accepts_any=True, forwards=True)
+        self.consumers = requires
+        self.deferred = deferred or {}
+
+    def check(self, kwargs) -> None:
+        """Check the payload of a call against the inputs of the pipeline.
+
+        Raises
+        ------
+        IncompatibleArgsException
+        """
+        missing = self.requires.difference(kwargs)
+        if len(missing) > 0:
+            raise _incompatible(*min(self.consumers[name] for name in missing)[1:])
+
+    def deferred_check(self, process) -> tuple[frozenset, str] | None:
+        """The names to check before the process is called, and its previous process."""
+        return self.deferred.get(id(process))
+
+    def check_process(self, process, kwargs) -> None:
+        """Check the payload of a process that could not be checked when it was built.
+
+        Raises
+        ------
+        IncompatibleArgsException
+        """
+        deferred = self.deferred.get(id(process))
+        if deferred is not None:
+            check_requires(process, *deferred, kwargs)
+
+
+def check_requires(process, requires: frozenset, previous: str, kwargs) -> None:
+    """Raise an IncompatibleArgsException if the payload lacks a required name."""
+    if not requires.issubset(kwargs):
+        raise _incompatible(_name(process), previous)
+
+
+class _State:
+    """The names that are known to be in the payload at a point of a pipeline."""
+
+    def __init__(self, known: frozenset = frozenset(), opaque: bool = False):
+        self.known = known
+        self.opaque = opaque
+
+    def __or__(self, other: _State) -> _State:
+        return _State(self.known | other.known, self.opaque or other.opaque)
+
+
+class _Validator:
+    def __init__(self):
+        self.requires: dict[str, tuple[int, str, str]] = {}
+        self.order = 0
+        # The processes without '**kwargs', which also receive
+        # the inputs of the pipeline.
+        self.strict: list[tuple[str, frozenset]] = []
+        # The processes that are checked when they are called
+        self.deferred: dict[int, tuple[frozenset, str]] = {}
+
+    def require(self, names, process, previous: str) -> None:
+        for name in names:
+            if name not in self.requires:
+                self.requires[name] = (self.order, _name(process), previous)
+        self.order += 1
+
+    def chain(self, processes, state: _State, previous: str) -> tuple[_State, str]:
+        from beenoculars.core.pipelines import (
+            ImageProcessingPipeline,
+            ProcessFork,
+            ProcessJoined,
+        )
+        for process in processes:
+            match process:
+                case ImageProcessingPipeline():
+                    state, previous = self.chain(process.processes, state, previous)
+                    continue
+                case ProcessJoined(forkedProcess=ProcessFork()):
+                    state = state | self.fork_join(process, state)
+                case _:
+                    state = self.call(process, state, previous)
+            previous = _name(process)
+        return state, previous
+
+    def call(self, process, state: _State, previous: str) -> _State:
+        """Check a process and return the state after merging its output."""
+        returned = self.returned(process, state, previous)
+        return state | returned
+
+    def returned(self, process, state: _State, previous: str) -> _State:
+        """Check a process and return the state of its returned payload."""
+        from beenoculars.core.pipelines import (
+            AbstractProcess,
+            ImageProcessingPipeline,
+            IncompatibleArgsException,
+            ProcessFork,
+            ProcessJoined,
+        )
+        match process:
+            case ImageProcessingPipeline():
+                return self.chain(process.processes, state, _INPUT)[0]
+            case ProcessJoined(forkedProcess=ProcessFork()):
+                return self.fork_join(process, state)
+            case ProcessFork():
+                return _State(opaque=True)
+            case AbstractProcess():
+                contract = process.contract
+            case _:
+                return _State(opaque=True)
+        #
+        if len(contract.positional_only) > 0:
+            raise IncompatibleArgsException(
+                f"The process '{_name(process)}' has positional-only arguments "
+                f"{list(contract.positional_only)}, which cannot be passed by the payload.")
+        if not contract.accepts_any:
+            self.strict.append((_name(process), contract.requires | contract.optional))
+            unexpected = state.known - contract.requires - contract.optional
+            if len(unexpected) > 0:
+                raise IncompatibleArgsException(
+                    f"The process '{_name(process)}' does not accept {sorted(unexpected)} "
+                    f"from the previous process '{previous}' (it has no '**kwargs').")
+        if not state.opaque:
+            self.require(contract.requires - state.known, process, previous)
+        elif len(contract.requires - state.known) > 0:
+            self.deferred[id(process)] = (contract.requires - state.known, previous)
+        #
+        if contract.forwards:
+            # It returns its payload and its declared outputs (if any)
+            return state | _State(contract.outputs or frozenset())
+        if contract.outputs is None:
+            return _State(opaque=True)
+        return _State(contract.outputs)
+
+    def fork_join(self, joined, state: _State) -> _State:
+        from beenoculars.core.pipelines import IncompatibleArgsException
+        fork = joined.forkedProcess
+        result = _State()
+        for index, branch in enumerate(fork.processes):
+            ret = self.returned(branch, state, _INPUT)
+            for old_key, new_key in joined.kwargs_mapping.get(index, []):
+                if old_key in ret.known:
+                    ret = _State((ret.known - {old_key}) | {new_key}, ret.opaque)
+                elif ret.opaque or _forwards(branch):
+                    ret = _State(ret.known | {new_key}, ret.opaque)
+                else:
+                    raise IncompatibleArgsException(
+                        f"The branch {index} ('{_name(branch)}') of the fork does not "
+                        f"return '{old_key}' to be renamed to '{new_key}'.")
+            result = result | ret
+        return result
+
+
+def _forwards(process) -> bool:
+    from beenoculars.core.pipelines import AbstractProcess, ImageProcessingPipeline
+    if isinstance(process, ImageProcessingPipeline):
+        return True
+    return isinstance(process, AbstractProcess) and process.contract.forwards
+
+
+def validate_pipeline(processes) -> PipelineContract:
+    """Validate the processes of a pipeline and derive its contract.
+
+    Raises
+    ------
+    IncompatibleArgsException
+        Raises when a process can never accept the payload of its previous
+        process, or a fork renames an output that its branch never returns.
+    """
+    from beenoculars.core.pipelines import IncompatibleArgsException
+    validator = _Validator()
+    state, _ = validator.chain(processes, _State(), _INPUT)
+    for name, accepted in validator.strict:
+        unexpected = validator.requires.keys() - accepted
+        if len(unexpected) > 0:
+            raise IncompatibleArgsException(
+                f"The process '{name}' does not accept {sorted(unexpected)} "
+                f"from the input of the pipeline (it has no '**kwargs').")
+    return PipelineContract(validator.requires,
+                            None if state.opaque else state.known,
+                            validator.deferred)
@@ -0,0 +1,194 @@
+"""Executors for the branches of forked processes.
+
+   Notes:
+   ------
+       1- A ProcessFork hands its branches to a ForkExecutor. The results
+          are always returned in the order of the branches and, if any of
+          them raises, the exception of the first failing branch (in the
+          order of the branches) is raised, exactly like the sequential
+          loop.
+
+       2- The default executor is read from the 'pipeline' section of
+          config.toml and can be replaced by 'set_default_fork_executor'.
+
+       3- 'ImageProcessingPipeline.aprocess' runs the pipelines off the event
+          loop on 'default_async_executor', a single thread, so the calls
+          run in the order of the events.
+"""
+import contextvars
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Mapping, Sequence
+
+from beenoculars.config import Config
+
+# logger
+log = logging.getLogger(__name__)
+
+__worker = threading.local()
+
+
+def _mark_fork_worker():
+    __worker.is_fork_worker = True
+
+
+def _is_fork_worker() -> bool:
+    return getattr(__worker, "is_fork_worker", False)
+
+
+class ForkExecutor(ABC):
+    """An abstract executor for the branches of a ProcessFork."""
+
+    @abstractmethod
+    def map(self,
+            branches: Sequence[Callable[..., Any]],
+            kwargs: Mapping[str, Any]) -> tuple:
+        """Call every branch with the same payload.
+
+        Parameters
+        ----------
+        branches : Sequence[Callable[..., Any]]
+            The forked processes or pipelines.
+        kwargs : Mapping[str, Any]
+            The payload that is passed to every branch.
+
+        Returns
+        -------
+        tuple
+            The returned payloads, in the same order as the branches.
+        """
+        pass
+
+    def shutdown(self) -> None:
+        pass
+
+
+class SequentialForkExecutor(ForkExecutor):
+    """Calls the branches one after the other in the calling thread."""
+
+    def map(self,
+            branches: Sequence[Callable[..., Any]],
+            kwargs: Mapping[str, Any]) -> tuple:
+        return tuple(branch(**kwargs) for branch in branches)
+
+
+class ThreadPoolForkExecutor(ForkExecutor):
+    def __init__(self, max_workers: int | None = None):
+        """Calls the branches concurrently on a thread pool.
+
+           OpenCV releases the GIL in most of its calls, so the independent
+           branches of a fork can run in parallel. The first branch always
+           runs in the calling thread and the rest are submitted to the pool.
+           Forks that are nested inside a branch that already runs on the
+           pool are called sequentially, so the pool can never dead-lock
+           waiting for itself.
+
+        Parameters
+        ----------
+        max_workers : int | None, optional
+            The size of the thread pool, by default None, which
+            means the number of CPUs.
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix="beenoculars-fork",
+                        initializer=_mark_fork_worker)
+        return self._pool
+
+    def map(self,
+            branches: Sequence[Callable[..., Any]],
+            kwargs: Mapping[str, Any]) -> tuple:
+        if len(branches) < 2 or _is_fork_worker():
+            return tuple(branch(**kwargs) for branch in branches)
+        #
+        # The context (e.g. the buffer pool of the pipeline) goes with the branches.
+        futures = [self.pool.submit(contextvars.copy_context().run, branch, **kwargs)
+                   for branch in branches[1:]]
+        try:
+            results = [branches[0](**kwargs)]
+            for future in futures:
+                results.append(future.result())
+        except BaseException:
+            # Same as the sequential loop: the branches after the
+            # failing one are not needed anymore.
+            for future in futures:
+                future.cancel()
+            raise
+        return tuple(results)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+                self._pool = None
+
+    def __getstate__(self):
+        # The pool is recreated lazily in other processes.
+        return {'max_workers': self.max_workers}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_workers'])
+
+
+__default_executor: ForkExecutor | None = None
+
+
+def default_fork_executor() -> ForkExecutor:
+    """The executor of the ProcessForks that did not set their own one.
+
+       It is created from the 'pipeline' section of config.toml:
+           fork_executor = "thread" | "sequential"
+           fork_workers = 0 (the number of CPUs)
+    """
+    global __default_executor
+    if __default_executor is None:
+        settings = Config.get("pipeline", {})
+        match settings.get("fork_executor", "thread").lower():
+            case "thread":
+                __default_executor = ThreadPoolForkExecutor(
+                    max_workers=settings.get("fork_workers", 0) or None)
+            case "sequential":
+                __default_executor = SequentialForkExecutor()
+            case _ as name:
+                raise ValueError(
+                    f"Unknown fork executor '{name}' in config.toml.")
+    return __default_executor
+
+
+def set_default_fork_executor(executor: ForkExecutor) -> None:
+    """Replace the executor of the ProcessForks that did not set their own one."""
+    global __default_executor
+    if not isinstance(executor, ForkExecutor):
+        raise ValueError(
+            f"The '{type(executor)}' must be a ForkExecutor.")
+    if __default_executor is not None and __default_executor is not executor:
+        __default_executor.shutdown()
+    __default_executor = executor
+
+
+__async_executor: ThreadPoolExecutor | None = None
+__async_lock = threading.Lock()
+
+
+def default_async_executor() -> ThreadPoolExecutor:
+    """The executor of the asynchronous pipeline calls (see 'aprocess')."""
+    global __async_executor
+    if __async_executor is None:
+        with __async_lock:
+            if __async_executor is None:
+                __async_executor = ThreadPoolExecutor(
+                    max_workers=1,
+                    thread_name_prefix="beenoculars-async")
+    return __async_executor
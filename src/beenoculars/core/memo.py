@@ -0,0 +1,141 @@
+"""Memoization of the stages of a pipeline by the payload they read.
+
+   Notes:
+   ------
+       1- The contract of a process (see beenoculars.core.contracts) names
+          the payload it reads. A memoized stage remembers its last results
+          by those values, so when one parameter changes (e.g. the
+          'contours_thickness'), only the stages that read it, directly
+          or through an upstream output that has changed, run again.
+
+       2- The scalars (and short lists/tuples of scalars) are compared by
+          value and everything else (e.g. images and contours) by identity.
+          Since a hit returns the same objects as before, the down-stream
+          stages hit, too. The arrays whose data can change (e.g. the
+          writeable arrays of the callers, which the plans view read-only,
+          see beenoculars.core.buffers) are compared by their content
+          (see beenoculars.core.caches.digest), since the callers can
+          change them in-place between the runs.
+
+       3- Only the processes that declare their 'outputs' and are 'pure'
+          are memoized: their returns must only depend on their named
+          arguments and they must not change them in-place.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Mapping
+
+import numpy as np
+
+from beenoculars.core.buffers import is_frozen
+from beenoculars.core.caches import digest
+from beenoculars.core.ragged import RaggedArray
+
+_SCALARS = (int, float, complex, str, bytes, bool, type(None), np.generic)
+
+
+class _Identity:
+    """Compares a value by its identity (and keeps it alive, so its id is not reused)."""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, _Identity) and other.value is self.value
+
+    def __hash__(self) -> int:
+        return id(self.value)
+
+
+def _array_key(array: np.ndarray) -> Any:
+    if is_frozen(array):
+        return _Identity(array)
+    key = digest(array)
+    return _Identity(array) if key is None else (np.ndarray, key)
+
+
+def _snapshot(value) -> Any:
+    if isinstance(value, _SCALARS):
+        return value
+    if isinstance(value, np.ndarray):
+        return _array_key(value)
+    if isinstance(value, RaggedArray):
+        return (RaggedArray, _array_key(value.values),
+                _array_key(value.starts), _array_key(value.ends))
+    if (isinstance(value, (list, tuple)) and len(value) <= 16 and
+            all(isinstance(v, _SCALARS) for v in value)):
+        return (type(value), tuple(value))
+    return _Identity(value)
+
+
+class StageMemo:
+    def __init__(self, size: int = 2):
+        """The memo of the stages of one or more pipelines.
+
+           The results are stored by process, so the pipelines that share
+           processes (e.g. the variations of a processFactory) share them too.
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of results that are kept for each process, by default 2.
+            They keep their inputs (e.g. images) alive, too.
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[Any, OrderedDict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_memoizable(process) -> bool:
+        from beenoculars.core.pipelines import AbstractProcess
+        if not isinstance(process, AbstractProcess) or not process.pure:
+            return False
+        contract = process.contract
+        return contract.outputs is not None and not contract.forwards
+
+    def call(self,
+             process,
+             reads: tuple[str, ...],
+             payload: Mapping[str, Any],
+             prepare: Callable[[Mapping[str, Any]], Mapping[str, Any]] | None = None):
+        """Call the process with the payload, unless it has been called by the same reads.
+
+        Parameters
+        ----------
+        process : AbstractProcess
+            A memoizable process.
+        reads : tuple[str, ...]
+            The names that the process reads.
+        payload : Mapping[str, Any]
+            The payload.
+        prepare : Callable[[Mapping[str, Any]], Mapping[str, Any]] | None, optional
+            Prepare the payload of a call, by default None (e.g. the copies
+            of the arrays that the process mutates).
+        """
+        key = tuple(_snapshot(payload.get(name)) for name in reads)
+        with self._lock:
+            entries = self._entries.setdefault(process, OrderedDict())
+            if key in entries:
+                entries.move_to_end(key)
+                self.hits += 1
+                return entries[key]
+            self.misses += 1
+        ret = process(**(payload if prepare is None else prepare(payload)))
+        with self._lock:
+            entries[key] = ret
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+        return ret
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __repr__(self) -> str:
+        return f"StageMemo(size={self.size}, hits={self.hits}, misses={self.misses})"
@@ -0,0 +1,87 @@
+"""The payload that the processes of a pipeline share.
+
+   Notes:
+   ------
+       1- 'beenoculars.config.Dict' (addict) hooks every value that is
+          set: the dicts become Dicts and the lists and tuples (e.g. the
+          contours) are rebuilt item by item. On small images, this copying
+          costs more than the OpenCV calls between the processes.
+
+       2- Payload is a plain dict with no extra state ('__slots__ = ()')
+          and the same reading behaviour as Dict: the missing names are
+          None and they can be read as attributes (payload.image). The
+          values are stored as they are.
+
+       3- The pipelines use Payload internally and convert it to a Dict
+          once, when the result is returned to the caller (see 'to_dict').
+"""
+from __future__ import annotations
+
+from typing import Any, Mapping
+
+from numpy import ndarray
+
+from beenoculars.config import Dict
+from beenoculars.core.ragged import RaggedArray
+
+
+class Payload(dict):
+    __slots__ = ()
+
+    def __missing__(self, key) -> None:
+        return None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        self[name] = value
+
+    def __delattr__(self, name: str) -> None:
+        del self[name]
+
+    def __or__(self, other: Mapping) -> Payload:
+        payload = Payload(self)
+        payload.update(other)
+        return payload
+
+    def __ior__(self, other: Mapping) -> Payload:
+        self.update(other)
+        return self
+
+    def copy(self) -> Payload:
+        return Payload(self)
+
+    def to_dict(self) -> Dict:
+        """Convert the payload to a Dict (see 'to_dict')."""
+        return to_dict(self)
+
+
+def to_dict(payload: Mapping[str, Any]) -> Dict:
+    """Convert a payload to a Dict for the callers of a pipeline.
+
+       Only the (nested) dict values are converted to Dicts. The other
+       values, e.g. a tuple of contours, are kept as they are instead of
+       being rebuilt by addict.
+    """
+    if isinstance(payload, Dict):
+        return payload
+    result = Dict()
+    for key, value in payload.items():
+        if type(value) is dict:
+            value = Dict(value)
+        dict.__setitem__(result, key, value)
+    return result
+
+
+def nbytes(payload: Mapping[str, Any]) -> int:
+    """The bytes of the ndarrays of a payload (and of lists/tuples of them)."""
+    total = 0
+    for value in payload.values():
+        if isinstance(value, (ndarray, RaggedArray)):
+            total += value.nbytes
+        elif isinstance(value, (list, tuple)):
+            total += sum(v.nbytes for v in value if isinstance(v, ndarray))
+    return total
@@ -1,8 +1,17 @@
+import contextvars
 import logging
+import os
 from abc import ABC, abstractmethod
-from typing import Any, Callable, Mapping, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Mapping, TypeVar
 
 from beenoculars.config import Dict
+from beenoculars.core.buffers import freeze, originals, own, read_only
+from beenoculars.core.cancellation import current_token
+from beenoculars.core.contracts import Contract, PipelineContract, validate_pipeline
+from beenoculars.core.executors import ForkExecutor, default_fork_executor
+from beenoculars.core.payloads import Payload
+from beenoculars.core.profiling import active_profiler
 
 _Self = TypeVar('_Self', bound='AbstractPipeline')
 
@@ -44,6 +53,22 @@ class AbstractPipeline(ABC):
 
 
 class AbstractProcess(ABC):
+    # The names of the returned payload, if they are known
+    # (e.g. outputs = ("image",)). They let the pipelines check
+    # the payload of the down-stream processes when they are built.
+    outputs: tuple[str, ...] | None = None
+    # The returns only depend on the named arguments, which are not
+    # changed in-place (see beenoculars.core.memo).
+    pure: bool = True
+    # It must run on the thread of the event loop (e.g. it creates
+    # GUI objects), see ImageProcessingPipeline.aprocess.
+    main_thread: bool = False
+    # The names of the arrays that it changes in-place (e.g. ("image",)).
+    # The other arrays are read-only (see beenoculars.core.buffers).
+    mutates: tuple[str, ...] = ()
+    # The outputs that are only computed when a later stage reads them
+    # (e.g. the 'hierarchy' of the contours), see 'without'.
+    lazy_outputs: tuple[str, ...] = ()
 
     @abstractmethod
     def __call__(self, **kwargs) -> Dict:
@@ -58,6 +83,46 @@ class AbstractProcess(ABC):
         """
         pass
 
+    @property
+    def contract(self) -> Contract:
+        """The payload names that the process reads and returns (see beenoculars.core.contracts)."""
+        return Contract.of_callable(self.__call__, outputs=self.outputs)
+
+    def without(self, names: frozenset) -> 'AbstractProcess':
+        """The process that does not compute the lazy outputs 'names'.
+
+           A plan that is compiled for its outputs calls it with the lazy
+           outputs that no later stage reads (see beenoculars.core.plans).
+
+        Parameters
+        ----------
+        names : frozenset
+            Some of the 'lazy_outputs'.
+
+        Returns
+        -------
+        AbstractProcess
+            An equivalent process without them, by default the process itself.
+        """
+        return self
+
+    def cached(self, cache=None) -> 'AbstractProcess':
+        """Cache the results of the process by the content of its payload.
+
+        Parameters
+        ----------
+        cache : ResultCache | None, optional
+            The cache, by default None, which creates a new one
+            (see beenoculars.core.caches).
+
+        Returns
+        -------
+        CachedProcess
+            The process with a cache.
+        """
+        from beenoculars.core.caches import CachedProcess, ResultCache
+        return CachedProcess(self, cache if cache is not None else ResultCache())
+
     def __rshift__(self, other) -> AbstractPipeline:
         """Appends the process to the end of an Process or ImageProcessingPipeline.
 
@@ -134,7 +199,8 @@ class AbstractProcess(ABC):
                 return ProcessFork([self] * other)
         if isinstance(other, ProcessFork):
             if isinstance(self, ProcessFork):
-                return ProcessFork(self.processes + other.processes)
+                return ProcessFork(self.processes + other.processes,
+                                   executor=self._executor)
             else:
                 return ProcessFork([self] + other.processes)
         if issubclass(type(other), AbstractProcess):
@@ -162,7 +228,11 @@ class Process(AbstractProcess):
 class ProcessPassThrough(Process):
     def __call__(self, **kwargs) -> Dict:
         """Payload is simplely pass to the next process."""
-        return Dict(**kwargs)
+        return Payload(kwargs)
+
+    @property
+    def contract(self) -> Contract:
+        return Contract(forwards=True)
 
 
 class ProcessJoined(AbstractProcess):
@@ -186,25 +256,62 @@ class ProcessJoined(AbstractProcess):
     def __call__(self, **kwargs) -> Dict:
         # First, calls all the sub-processes in the fork.
         tuple_return = self.forkedProcess(**kwargs)
+        profiler = active_profiler()
+        if profiler is not None:
+            with profiler.span("ProcessJoined.join", "fork"):
+                return self._join(tuple_return)
+        return self._join(tuple_return)
+
+    def _join(self, tuple_return) -> Dict:
         # Next, if there is any renaming requested in the
         # payloads of the forked sub-processes, we do it here
+        # (on copies, since a return can be a cached payload).
+        tuple_return = list(tuple_return)
         for index, names in self.kwargs_mapping.items():
-            ret = tuple_return[index]
+            ret = tuple_return[index] = Payload(tuple_return[index])
             for old_key, new_key in names:
                 ret[new_key] = ret.pop(old_key)
         # Finally, make a union of all the retuned payloads.
         # Note: the names from returns of higher rank  has precedence
-        new_kwargs = tuple_return[0]
-        for d in tuple_return[1:]:
-            new_kwargs |= d
+        new_kwargs = Payload()
+        for d in tuple_return:
+            new_kwargs.update(d)
         return new_kwargs
 
 
+def _copy_on_write(process: AbstractProcess) -> Callable[..., Dict]:
+    def call(**kwargs) -> Dict:
+        return process(**own(kwargs, process.mutates, reuse=False))
+    return call
+
+
 class ProcessFork(AbstractProcess):
     def __init__(self,
-                 processes: list):
+                 processes: list,
+                 executor: ForkExecutor | None = None):
+        """Fork the payload to two or more processes.
+
+        Parameters
+        ----------
+        processes : list
+            The forked processes or pipelines.
+        executor : ForkExecutor | None, optional
+            The executor that calls the branches, by default None,
+            which means the default executor (see 'default_fork_executor').
+        """
         assert len(processes) > 1, "The processes must be more than one."
         self.processes = processes
+        self._executor = executor
+
+    @property
+    def executor(self) -> ForkExecutor:
+        if self._executor is None:
+            return default_fork_executor()
+        return self._executor
+
+    @executor.setter
+    def executor(self, executor: ForkExecutor | None) -> None:
+        self._executor = executor
 
     def __getitem__(self, key: int) -> AbstractProcess | AbstractPipeline:
         return self.processes[key]
@@ -214,7 +321,16 @@ class ProcessFork(AbstractProcess):
 
     def __call__(self,  **kwargs) -> tuple[Dict, ...]:
         """It calles each sub-processes of the fork and returns thier payload as a tuple."""
-        return tuple(p(**kwargs) for p in self.processes)
+        branches = self.processes
+        if any(getattr(p, "mutates", ()) for p in branches):
+            # The branches share the payload, so they mutate copies.
+            branches = [_copy_on_write(p) if getattr(p, "mutates", ()) else p
+                        for p in branches]
+        profiler = active_profiler()
+        if profiler is not None:
+            with profiler.span("ProcessFork", "fork"):
+                return self.executor.map([profiler.wrap(p) for p in branches], kwargs)
+        return self.executor.map(branches, kwargs)
 
     def __rshift__(self, other) -> ProcessJoined:
         # It first join the forked instance, and next,
@@ -261,7 +377,205 @@ class ProcessFork(AbstractProcess):
 
 class ImageProcessingPipeline(AbstractPipeline):
     def __init__(self, processes=[]):
+        """A sequence of processes that share a payload.
+
+        Raises
+        ------
+        IncompatibleArgsException
+            Raises when a process can never accept the payload of its
+            previous process (see beenoculars.core.contracts).
+        """
         super(ImageProcessingPipeline, self).__init__(processes)
+        self._contract = validate_pipeline(self.processes)
+        self._plan = None
+        self._memo = None
+        self._outputs = None
+        self._buffers = None
+
+    @property
+    def contract(self) -> PipelineContract:
+        """The inputs and outputs of the pipeline, validated when it is built."""
+        return self._contract
+
+    def append_process(self, process) -> None:
+        self._contract = validate_pipeline(self.processes + [process])
+        super().append_process(process)
+        self._plan = None
+
+    def compile(self, outputs: Iterable[str] | None = None):
+        """Compile the pipeline to a flat ExecutionPlan.
+
+           The plan is cached in the pipeline and is used by 'process' from
+           now on. Since the pipelines are immutable, it stays valid unless
+           a process is appended by 'append_process' or a fork of the
+           pipeline is changed in-place (call 'compile' again afterwards).
+
+           Example:
+               pipeline.compile(outputs=("image", "masks"))
+
+        Parameters
+        ----------
+        outputs : Iterable[str] | None, optional
+            The names that the callers read from the returned payload, by
+            default None, which keeps the outputs of the previous compile
+            (all the names at first). When they are given, only they are
+            returned and the stages that they do not depend on are pruned.
+
+        Returns
+        -------
+        ExecutionPlan
+            The compiled plan (see beenoculars.core.plans).
+
+        Raises
+        ------
+        ValueError
+            Raises when the pipeline is not valid, e.g. a fork is not joined.
+        """
+        if outputs is not None and tuple(outputs) != self._outputs:
+            self._outputs = tuple(outputs)
+            self._plan = None
+        if self._plan is None:
+            from beenoculars.core.plans import compile_pipeline
+            self._plan = compile_pipeline(self, memo=self._memo, outputs=self._outputs,
+                                          buffers=self._buffers)
+        return self._plan
+
+    def recompile(self):
+        """Drop the cached plan and compile the pipeline again."""
+        self._plan = None
+        return self.compile()
+
+    def memoize(self, memo=None) -> 'ImageProcessingPipeline':
+        """Memoize the stages of the pipeline by the payload they read.
+
+           When the pipeline is called again with a changed parameter, only
+           the stages that depend on it run again (see beenoculars.core.memo).
+           The pipeline is compiled with the memo.
+
+        Parameters
+        ----------
+        memo : StageMemo | None, optional
+            The memo, which can be shared between pipelines, by default None,
+            which creates a new one.
+
+        Returns
+        -------
+        ImageProcessingPipeline
+            The pipeline itself.
+        """
+        if memo is None:
+            from beenoculars.core.memo import StageMemo
+            memo = StageMemo()
+        self._memo = memo
+        self.recompile()
+        return self
+
+    @property
+    def memo(self):
+        return self._memo
+
+    def use_buffers(self, pool=None) -> 'ImageProcessingPipeline':
+        """Draw the arrays of the image processes from a pool and recycle the dead ones.
+
+           The arrays that the caller, a memo or a cache keep are never recycled
+           (see beenoculars.core.buffers). The pipeline is compiled with the pool.
+
+        Parameters
+        ----------
+        pool : BufferPool | None, optional
+            The pool, which can be shared between pipelines, by default None,
+            which creates a new one.
+
+        Returns
+        -------
+        ImageProcessingPipeline
+            The pipeline itself.
+        """
+        if pool is None:
+            from beenoculars.core.buffers import BufferPool
+            pool = BufferPool()
+        self._buffers = pool
+        self.recompile()
+        return self
+
+    @property
+    def buffers(self):
+        return self._buffers
+
+    async def aprocess(self, /, **kwargs) -> Dict:
+        """Proccess the payload without blocking the event loop.
+
+           The (compiled) pipeline runs on 'default_async_executor', except the
+           processes whose 'main_thread' is True, which run on the thread of
+           the loop. The result is returned on the thread of the loop, too.
+           When the awaiting task is cancelled, the run stops at its next
+           stage (see beenoculars.core.cancellation).
+
+           Example:
+               results = await pipeline.aprocess(image=image)
+
+        Returns
+        -------
+        Dict
+            A dict object that conains the processed image and other parameters.
+
+        Raises
+        ------
+        IncompatibleArgsException
+            Raises when the payload lacks an input of the pipeline.
+        """
+        self._contract.check(kwargs)
+        return await self.compile().arun(kwargs)
+
+    def map(self,
+            payloads: Iterable[Mapping[str, Any]],
+            workers: int | None = None,
+            ordered: bool = True,
+            max_inflight: int | None = None) -> Iterator[Dict]:
+        """Stream many payloads through the (compiled) pipeline.
+
+           The results are yielded lazily, so an unbounded iterable (e.g. all
+           the frames of a folder) is processed with a bounded memory.
+
+           Example:
+               for result in pipeline.map(Dict(image=cv.imread(f)) for f in files):
+                   ...
+
+        Parameters
+        ----------
+        payloads : Iterable[Mapping[str, Any]]
+            The payloads, consumed lazily.
+        workers : int | None, optional
+            The number of threads that run the pipeline, by default None,
+            which means the number of CPUs. With 1 (or 0), the payloads
+            are processed one by one in the calling thread.
+        ordered : bool, optional
+            Yield the results in the order of the payloads, by default True.
+            Otherwise, they are yielded as soon as they are ready.
+        max_inflight : int | None, optional
+            The maximum number of payloads that are read ahead and not yielded,
+            by default None, which is twice the number of workers.
+
+        Yields
+        ------
+        Iterator[Dict]
+            The returned payloads.
+        """
+        self.compile()
+        workers = workers if workers is not None else os.cpu_count() or 1
+        if workers <= 1:
+            for payload in payloads:
+                yield self.process(**payload)
+            return
+        from beenoculars.core.runners import stream
+        with ThreadPoolExecutor(max_workers=workers,
+                                thread_name_prefix="beenoculars-map") as pool:
+            # The context (e.g. a cancellation token) goes with the payloads.
+            yield from stream(lambda payload: pool.submit(contextvars.copy_context().run,
+                                                          self.process, **payload),
+                              payloads,
+                              ordered=ordered,
+                              max_inflight=max_inflight or 2 * workers)
 
     def __rshift__(self, other) -> AbstractPipeline:
         """Appends the process to the end of an Process or ImageProcessingPipeline.
@@ -360,52 +674,85 @@ class ImageProcessingPipeline(AbstractPipeline):
         Raises
         ------
         IncompatibleArgsException
+            Raises when the payload lacks an input of the pipeline.
+        PipelineCancelledException
+            Raises when the current cancellation token is cancelled
+            (see beenoculars.core.cancellation).
         """
-        try:
-            payload_kwargs = Dict(**kwargs)
-            for index, process in enumerate(self.processes):
-                ret: Dict = process(**payload_kwargs)
-                # Unino the returned payload with previous ones.
-                # This will be passed to next process or return to the caller.
-                #
-                #  1- Process parameters have precedence over the kwargs.
-                #  2- The latest process parameters have precedence over the formeres.
-                payload_kwargs |= ret
-        except TypeError as e:
-            # The name of the class
-            def name(obj) -> str: return type(obj).__name__
-            if (len(e.args) > 0 and
-                    ("missing 1 required keyword-only argument" in e.args[0] or
-                     "missing 1 required positional argument" in e.args[0]
-                     )):
-                if index > 0:
-                    previous_process = name(self.processes[index - 1])
-                else:
-                    previous_process = "(input of the pipline)"
-                raise IncompatibleArgsException(
-                    f"The process '{name(process)}' received incompatible payload from "
-                    f"the previous process '{previous_process}'.")
+        # The payload between the processes has been checked when the
+        # pipeline was built, so only its inputs (and the processes after
+        # the ones with unknown outputs) are checked here.
+        self._contract.check(kwargs)
+        if self._plan is not None:
+            return self._plan.run(kwargs)
+        # The payload is a light-weight Payload between the processes
+        # and is converted to a Dict once, for the caller.
+        # The arrays of the caller are read-only and the processes
+        # that change them get copies (see beenoculars.core.buffers).
+        payload_kwargs = read_only(Payload(kwargs))
+        # The processes record their spans when profiling is on
+        # (see beenoculars.core.profiling).
+        profiler = active_profiler()
+        # The run can be cancelled between the processes
+        # (see beenoculars.core.cancellation).
+        token = current_token()
+        for process in self.processes:
+            if token is not None:
+                token.check()
+            self._contract.check_process(process, payload_kwargs)
+            payload = payload_kwargs
+            if getattr(process, "mutates", ()):
+                payload = own(payload_kwargs, process.mutates)
+            if profiler is None:
+                ret: Dict = process(**payload)
             else:
-                raise e
-        return payload_kwargs
+                ret = profiler.call(process, payload)
+            freeze(ret)
+            # Unino the returned payload with previous ones.
+            # This will be passed to next process or return to the caller.
+            #
+            #  1- Process parameters have precedence over the kwargs.
+            #  2- The latest process parameters have precedence over the formeres.
+            payload_kwargs.update(ret)
+        # The caller gets the arrays themselves, not their read-only views.
+        return originals(payload_kwargs).to_dict()
 
 
 class ProcessLogic(AbstractProcess):
-    def __init__(self, logic_callback: Callable[..., Dict]):
+    def __init__(self,
+                 logic_callback: Callable[..., Dict],
+                 outputs: tuple[str, ...] | None = None):
         self.logic_callback = logic_callback
+        self.outputs = outputs
 
     def __call__(self, **kwargs) -> Dict:
         return self.logic_callback(**kwargs)
 
+    @property
+    def contract(self) -> Contract:
+        return Contract.of_callable(self.logic_callback, outputs=self.outputs)
+
 
 class ProcessLogicProperty(AbstractProcess):
-    def __init__(self, logic_callback: Callable[..., Dict]):
+    # It depends on the state of its caller
+    pure = False
+
+    def __init__(self,
+                 logic_callback: Callable[..., Dict],
+                 outputs: tuple[str, ...] | None = None):
         self.logic_callback = logic_callback
+        self.outputs = outputs
         self.caller_class = None
 
     def __call__(self, **kwargs) -> Dict:
         return self.logic_callback(self.caller_class, **kwargs)
 
+    @property
+    def contract(self) -> Contract:
+        # The first argument is the caller (self)
+        return Contract.of_callable(self.logic_callback, outputs=self.outputs,
+                                    skip_first=True)
+
 
 class ProcessFactory:
     def __init__(self, factory_callback: Callable[..., AbstractProcess]):
@@ -0,0 +1,818 @@
+"""Compiled execution plans of pipelines.
+
+   Notes:
+   ------
+       1- 'ImageProcessingPipeline.compile()' turns the operator tree that is
+          built by '>>', '*' and '/' into an ExecutionPlan: a flat list of
+          stages. Nested pipelines are inlined and every fork/join becomes a
+          single ForkJoinStage whose branches are flat lists of stages, too.
+
+       2- The payloads live in numbered scopes (plain dicts). The scope of
+          each stage is bound at compile time: the top pipeline uses scope 0
+          and every branch of a fork gets its own scope. Running a plan is a
+          loop over the stages, without any recursive 'process' calls or the
+          intermediate payloads and unions of the interpreted pipeline.
+          The payload is converted to a Dict once, when it is returned.
+
+       3- When a Profiler is active, the stages are run through their
+          'profile' method, which records their spans (see
+          beenoculars.core.profiling). It is checked once per list of stages,
+          like the current cancellation token, which is checked before every
+          stage (see beenoculars.core.cancellation).
+
+       4- The flat chains of stages are rewritten by the rules that are
+          registered by 'register_rewrite', e.g. the image processing fuses
+          the redundant colour conversions (see beenoculars.image_processing.
+          rewrites). A rule replaces a sequence of processes, matched by
+          identity, that share a scope by an equivalent one.
+
+       5- The branches of a fork that start with the same pure processes
+          (e.g. the replicas of 'pipeline * n') compute their common prefix
+          once, in a shared scope, before the fork. Every branch then
+          continues from a shallow copy of it, so the arrays are shared.
+
+       6- A plan that is compiled for the outputs that the caller reads
+          (see 'ImageProcessingPipeline.compile') is pruned by a liveness
+          analysis: the pure stages and the branches whose outputs are never
+          read are removed, and the payload names are dropped from their
+          scope as soon as no later stage reads them. The processes are
+          called without their lazy outputs that no later stage reads
+          (e.g. ToContours does not build the 'hierarchy' of the contours,
+          see 'AbstractProcess.without').
+
+       7- A plan that uses a BufferPool gives the pooled arrays back when
+          they are dropped from a scope. The arrays are copy-on-write: the
+          returned ones are frozen and a process that declares 'mutates'
+          gets writeable ones (see beenoculars.core.buffers).
+
+       8- 'arun' runs the stages on an executor, except the stages of the
+          processes that must run on the thread of the event loop (their
+          'main_thread' is True, e.g. the conversions to the GUI images).
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Mapping, Sequence
+
+from numpy import ndarray
+
+from beenoculars.config import Dict
+from beenoculars.core.buffers import (
+    BufferPool,
+    freeze,
+    originals,
+    own,
+    read_only,
+    using_buffer_pool,
+)
+from beenoculars.core.cancellation import CancellationToken, current_token, using_token
+from beenoculars.core.contracts import Contract, PipelineContract, check_requires
+from beenoculars.core.executors import default_async_executor
+from beenoculars.core.memo import StageMemo
+from beenoculars.core.payloads import to_dict
+from beenoculars.core.profiling import Profiler, active_profiler
+from beenoculars.core.pipelines import (
+    AbstractPipeline,
+    AbstractProcess,
+    ImageProcessingPipeline,
+    ProcessFork,
+    ProcessJoined,
+    ProcessPassThrough,
+)
+
+# logger
+log = logging.getLogger(__name__)
+
+# The rewrite rules of the chains of stages, the longest patterns first
+_rewrites: list[tuple[tuple, tuple]] = []
+
+
+def register_rewrite(pattern: Sequence[AbstractProcess],
+                     replacement: Sequence[AbstractProcess]) -> None:
+    """Replace a sequence of processes by an equivalent one when the pipelines are compiled.
+
+       Example:
+           register_rewrite((ToGray, ToColor, ToBlackWhite), (ToBlackWhite,))
+
+    Parameters
+    ----------
+    pattern : Sequence[AbstractProcess]
+        The processes (e.g. the singletons of Process) that are called one
+        after the other on the same payload. They are matched by identity.
+    replacement : Sequence[AbstractProcess]
+        The fewer processes that return the same payload (it can be empty).
+
+    Raises
+    ------
+    ValueError
+        Raises when the replacement is not shorter than the pattern,
+        so the rewriting always ends.
+    """
+    if len(replacement) >= len(pattern):
+        raise ValueError("The replacement of a rewrite must be shorter than its pattern.")
+    _rewrites.append((tuple(pattern), tuple(replacement)))
+    _rewrites.sort(key=lambda rule: -len(rule[0]))
+
+
+def _name(obj) -> str:
+    return type(obj).__name__
+
+
+class Stage(ABC):
+    """A step of an ExecutionPlan."""
+    # The pool of the arrays that are dropped by the stage, if any
+    pool: BufferPool | None = None
+
+    @abstractmethod
+    def run(self, scopes: list) -> None:
+        pass
+
+    def profile(self, scopes: list, profiler: Profiler) -> None:
+        """Run the stage and record its span (only the calls of processes are recorded)."""
+        self.run(scopes)
+
+
+class CallStage(Stage):
+    def __init__(self,
+                 process: AbstractProcess | AbstractPipeline,
+                 scope: int,
+                 target: int | None = None):
+        """Call a process with the payload of a scope.
+
+        Parameters
+        ----------
+        process : AbstractProcess | AbstractPipeline
+            The process.
+        scope : int
+            The scope that is passed to the process.
+        target : int | None, optional
+            By default None, the returned payload is merged into the scope
+            (pipeline semantic). Otherwise, the returned payload becomes the
+            scope 'target' (a forked process).
+        """
+        self.process = process
+        self.scope = scope
+        self.target = target
+        self.mutates = tuple(getattr(process, "mutates", ()))
+        # The required names that are checked before the call, and the
+        # previous process (see PipelineContract.check_process).
+        self.deferred: tuple[frozenset, str] | None = None
+
+    def own(self, payload: Mapping[str, Any]) -> Mapping[str, Any]:
+        """The payload with writeable arrays of 'mutates' (see beenoculars.core.buffers)."""
+        # The scope of a forked process is shared with the other branches.
+        return own(payload, self.mutates, reuse=self.target is None)
+
+    def check(self, payload: Mapping[str, Any]) -> None:
+        if self.deferred is not None:
+            check_requires(self.process, *self.deferred, payload)
+
+    def call(self, payload: Mapping[str, Any]) -> Mapping[str, Any]:
+        self.check(payload)
+        if self.mutates:
+            payload = self.own(payload)
+        return self.process(**payload)
+
+    def store(self, scopes: list, ret: Mapping[str, Any]) -> None:
+        freeze(ret)
+        if self.target is None:
+            payload = scopes[self.scope]
+            if self.pool is not None:
+                # The overwritten arrays are dead, unless they are returned again
+                for name in [name for name in ret if isinstance(payload.get(name), ndarray)]:
+                    if payload[name] is not ret[name]:
+                        self.pool.release(payload.pop(name))
+            payload.update(ret)
+        else:
+            scopes[self.target] = ret
+
+    def run(self, scopes: list) -> None:
+        self.store(scopes, self.call(scopes[self.scope]))
+
+    def profile(self, scopes: list, profiler: Profiler) -> None:
+        self.store(scopes, profiler.call(self.process, scopes[self.scope], self.call))
+
+    def __repr__(self) -> str:
+        target = self.scope if self.target is None else self.target
+        return f"{_name(self.process)}[{self.scope}->{target}]"
+
+
+class MemoCallStage(CallStage):
+    def __init__(self,
+                 process: AbstractProcess,
+                 scope: int,
+                 memo: StageMemo,
+                 target: int | None = None):
+        """Call a process through a StageMemo (see beenoculars.core.memo)."""
+        super().__init__(process, scope, target)
+        self.memo = memo
+        self.reads = tuple(sorted(process.contract.reads))
+
+    def call(self, payload: Mapping[str, Any]) -> Mapping[str, Any]:
+        self.check(payload)
+        return self.memo.call(self.process, self.reads, payload,
+                              prepare=self.own if self.mutates else None)
+
+    def __repr__(self) -> str:
+        return "memo:" + super().__repr__()
+
+
+class CopyScopeStage(Stage):
+    """Start a branch with a (shallow) copy of the payload of the fork."""
+
+    def __init__(self, source: int, target: int):
+        self.source = source
+        self.target = target
+
+    def run(self, scopes: list) -> None:
+        scopes[self.target] = dict(scopes[self.source])
+
+    def __repr__(self) -> str:
+        return f"Copy[{self.source}->{self.target}]"
+
+
+class AliasScopeStage(Stage):
+    """A PassThrough branch: the payload of the fork itself is its result."""
+
+    def __init__(self, source: int, target: int):
+        self.source = source
+        self.target = target
+
+    def run(self, scopes: list) -> None:
+        scopes[self.target] = scopes[self.source]
+
+    def __repr__(self) -> str:
+        return f"PassThrough[{self.source}->{self.target}]"
+
+
+class RetainStage(Stage):
+    """Drop the names of a scope that no later stage reads."""
+
+    def __init__(self, scope: int, names: frozenset):
+        self.scope = scope
+        self.names = names
+
+    def run(self, scopes: list) -> None:
+        payload = scopes[self.scope]
+        for name in [name for name in payload if name not in self.names]:
+            if self.pool is not None:
+                self.pool.release(payload.pop(name))
+            else:
+                del payload[name]
+
+    def __repr__(self) -> str:
+        return f"Retain[{self.scope}]{{{', '.join(sorted(self.names))}}}"
+
+
+def run_stages(stages: list[Stage], scopes: list) -> None:
+    profiler = active_profiler()
+    token = current_token()
+    if profiler is None and token is None:
+        for stage in stages:
+            stage.run(scopes)
+    elif profiler is None:
+        for stage in stages:
+            token.check()  # type: ignore
+            stage.run(scopes)
+    else:
+        for stage in stages:
+            if token is not None:
+                token.check()
+            stage.profile(scopes, profiler)
+
+
+class ForkJoinStage(Stage):
+    def __init__(self,
+                 fork: ProcessFork,
+                 branches: list[list[Stage]],
+                 branch_scopes: list[int],
+                 kwargs_mapping: Mapping[int, list[tuple[str, str]]],
+                 scope: int,
+                 target: int | None = None,
+                 shared: list[Stage] | None = None,
+                 shared_scopes: list[int] | None = None):
+        """Run the branches of a fork and join their payloads.
+
+        Parameters
+        ----------
+        fork : ProcessFork
+            The fork, whose executor runs the branches.
+        branches : list[list[Stage]]
+            The flat stages of each branch.
+        branch_scopes : list[int]
+            The scope that holds the result of each branch.
+        kwargs_mapping : Mapping[int, list[tuple[str, str]]]
+            The renaming of the branches' outputs (see ProcessJoined).
+        scope : int
+            The scope of the fork's input payload.
+        target : int | None, optional
+            By default None, the joined payload is merged into the scope.
+            Otherwise, it becomes the scope 'target'.
+        shared : list[Stage] | None, optional
+            The common prefixes of the branches, which run before them,
+            by default None.
+        shared_scopes : list[int] | None, optional
+            The scopes of the shared prefixes, which are released after the join.
+        """
+        self.fork = fork
+        self.branches = branches
+        self.branch_scopes = branch_scopes
+        self.kwargs_mapping = kwargs_mapping
+        self.scope = scope
+        self.target = target
+        self.shared = shared or []
+        self.shared_scopes = shared_scopes or []
+
+    def run(self, scopes: list) -> None:
+        run_stages(self.shared, scopes)
+        # The branches that only move payloads around are not worth
+        # sending to the executor.
+        heavy = []
+        for stages in self.branches:
+            if all(isinstance(s, (CopyScopeStage, AliasScopeStage)) for s in stages):
+                run_stages(stages, scopes)
+            else:
+                heavy.append(partial(run_stages, stages, scopes))
+        if len(heavy) > 0:
+            self.fork.executor.map(heavy, {})
+        # Join: the names from returns of higher rank has precedence
+        joined = {}
+        for index, branch_scope in enumerate(self.branch_scopes):
+            ret = scopes[branch_scope]
+            if ret is None:
+                # The branch has been pruned (see '_Liveness')
+                continue
+            scopes[branch_scope] = None
+            if index in self.kwargs_mapping:
+                ret = dict(ret)
+                for old_key, new_key in self.kwargs_mapping[index]:
+                    ret[new_key] = ret.pop(old_key)
+            joined.update(ret)
+        for shared_scope in self.shared_scopes:
+            scopes[shared_scope] = None
+        if self.target is None:
+            scopes[self.scope].update(joined)
+        else:
+            scopes[self.target] = joined
+
+    def profile(self, scopes: list, profiler: Profiler) -> None:
+        with profiler.span("ForkJoin", "fork"):
+            self.run(scopes)
+
+    def __repr__(self) -> str:
+        branches = " * ".join("(" + " >> ".join(repr(s) for s in stages) + ")"
+                              for stages in self.branches)
+        target = self.scope if self.target is None else self.target
+        shared = ""
+        if len(self.shared) > 0:
+            shared = "(" + " >> ".join(repr(s) for s in self.shared) + ") >> "
+        return f"{shared}ForkJoin[{self.scope}->{target}]{{{branches}}}"
+
+
+def _on_main_thread(stage: Stage) -> bool:
+    match stage:
+        case CallStage():
+            return getattr(stage.process, "main_thread", False)
+        case ForkJoinStage():
+            return any(_on_main_thread(s)
+                       for stages in stage.branches + [stage.shared] for s in stages)
+        case _:
+            return False
+
+
+class ExecutionPlan:
+    def __init__(self,
+                 stages: list[Stage],
+                 scopes_count: int,
+                 outputs: tuple[str, ...] | None = None,
+                 buffers: BufferPool | None = None,
+                 memo: StageMemo | None = None):
+        """A flat list of stages, compiled from a pipeline.
+
+        Parameters
+        ----------
+        stages : list[Stage]
+            The stages, in the order of execution.
+        scopes_count : int
+            The number of payload scopes that a run needs.
+        outputs : tuple[str, ...] | None, optional
+            The names of the returned payload, by default None,
+            which returns the whole payload.
+        buffers : BufferPool | None, optional
+            The pool of the arrays of the stages, by default None.
+        memo : StageMemo | None, optional
+            The memo of the stages, by default None. The arrays that they
+            return are shared with the next runs, so the caller gets them
+            read-only.
+        """
+        self.stages = stages
+        self.scopes_count = scopes_count
+        self.outputs = outputs
+        self.buffers = buffers
+        self.memo = memo
+        self._segments = None
+
+    def _result(self, payload: dict) -> Dict:
+        if self.outputs is not None:
+            if self.buffers is not None:
+                for name in [name for name in payload if name not in self.outputs]:
+                    self.buffers.release(payload.pop(name))
+            payload = {name: payload[name] for name in self.outputs if name in payload}
+        # The caller gets the arrays themselves, not their read-only views.
+        return to_dict(originals(payload, returned=self.memo is None))
+
+    def run(self, kwargs: Mapping[str, Any]) -> Dict:
+        """Run the plan for a payload and return the resulting payload."""
+        scopes: list = [None] * self.scopes_count
+        scopes[0] = read_only(dict(kwargs))
+        if self.buffers is None:
+            run_stages(self.stages, scopes)
+        else:
+            with using_buffer_pool(self.buffers):
+                run_stages(self.stages, scopes)
+        return self._result(scopes[0])
+
+    @property
+    def segments(self) -> list[tuple[bool, list[Stage]]]:
+        """The stages, grouped by whether they run on the main thread."""
+        if self._segments is None:
+            segments = []
+            for stage in self.stages:
+                main = _on_main_thread(stage)
+                if len(segments) > 0 and segments[-1][0] == main:
+                    segments[-1][1].append(stage)
+                else:
+                    segments.append((main, [stage]))
+            self._segments = segments
+        return self._segments
+
+    async def arun(self,
+                   kwargs: Mapping[str, Any],
+                   executor: Executor | None = None) -> Dict:
+        """Run the plan off the event loop and return the resulting payload.
+
+        Parameters
+        ----------
+        kwargs : Mapping[str, Any]
+            The payload.
+        executor : Executor | None, optional
+            The executor of the stages, by default None, which is the
+            'default_async_executor'. The stages of the 'main_thread'
+            processes run on the thread of the event loop.
+
+        Raises
+        ------
+        PipelineCancelledException
+            Raises when the current cancellation token is cancelled. When the
+            awaiting task is cancelled, the stages on the executor stop at
+            the next stage, too (by a child token of the current one).
+        """
+        loop = asyncio.get_running_loop()
+        executor = executor or default_async_executor()
+        scopes: list = [None] * self.scopes_count
+        scopes[0] = read_only(dict(kwargs))
+        token = CancellationToken(parent=current_token())
+        with using_buffer_pool(self.buffers), using_token(token):
+            for main_thread, stages in self.segments:
+                if main_thread:
+                    run_stages(stages, scopes)
+                    continue
+                # The context (e.g. the token) goes with the stages.
+                context = contextvars.copy_context()
+                try:
+                    await loop.run_in_executor(executor, context.run,
+                                               run_stages, stages, scopes)
+                except asyncio.CancelledError:
+                    token.cancel("The awaiting task has been cancelled.")
+                    raise
+        return self._result(scopes[0])
+
+    def __len__(self) -> int:
+        return len(self.stages)
+
+    def __repr__(self) -> str:
+        return " >> ".join(repr(stage) for stage in self.stages)
+
+
+class _Compiler:
+    def __init__(self,
+                 memo: StageMemo | None = None,
+                 contract: PipelineContract | None = None):
+        self.scopes_count = 1
+        self.memo = memo
+        self.contract = contract
+
+    def call(self, process, scope: int, target: int | None = None) -> CallStage:
+        if self.memo is not None and StageMemo.is_memoizable(process):
+            stage = MemoCallStage(process, scope, self.memo, target)
+        else:
+            stage = CallStage(process, scope, target)
+        if self.contract is not None:
+            stage.deferred = self.contract.deferred_check(process)
+        return stage
+
+    def new_scope(self) -> int:
+        self.scopes_count += 1
+        return self.scopes_count - 1
+
+    def chain(self, processes: list, scope: int) -> list[Stage]:
+        """The stages of a sequence of processes that share a scope."""
+        stages = []
+        for process in processes:
+            match process:
+                case ImageProcessingPipeline():
+                    # Nested pipelines are inlined
+                    stages += self.chain(process.processes, scope)
+                case ProcessJoined(forkedProcess=ProcessFork()):
+                    stages.append(self.fork_join(process, scope))
+                case ProcessFork():
+                    raise ValueError(
+                        f"The '{_name(process)}' must be joined before it is "
+                        f"followed by other processes (use '>>' or '/').")
+                case AbstractProcess() | AbstractPipeline():
+                    stages.append(self.call(process, scope))
+                case _:
+                    raise ValueError(
+                        f"The '{type(process)}' must be a AbstractProcess or "
+                        f"ImageProcessingPipeline.")
+        return self.rewrite(stages)
+
+    def rewrite(self, stages: list[Stage]) -> list[Stage]:
+        """Apply the rewrite rules to a chain of stages until none matches."""
+        def matches(index: int, pattern: tuple) -> bool:
+            window = stages[index:index + len(pattern)]
+            return (len(window) == len(pattern) and
+                    all(type(stage) in (CallStage, MemoCallStage) and
+                        stage.target is None and stage.process is process
+                        for stage, process in zip(window, pattern)))
+        index = 0
+        while index < len(stages):
+            for pattern, replacement in _rewrites:
+                if matches(index, pattern):
+                    scope = stages[index].scope
+                    stages[index:index + len(pattern)] = [
+                        self.call(process, scope) for process in replacement]
+                    log.debug(f"Rewrote {pattern} to {replacement}.")
+                    # The replacement can complete a pattern that starts before it.
+                    index = max(index - max(len(p) for p, _ in _rewrites) + 1, 0)
+                    break
+            else:
+                index += 1
+        return stages
+
+    def fork_join(self,
+                  joined: ProcessJoined,
+                  scope: int,
+                  target: int | None = None) -> ForkJoinStage:
+        fork: ProcessFork = joined.forkedProcess  # type: ignore
+        for index in joined.kwargs_mapping:
+            if not isinstance(index, int) or not 0 <= index < len(fork.processes):
+                raise ValueError(
+                    f"The renaming index '{index}' is not a branch of the "
+                    f"fork (0 to {len(fork.processes) - 1}).")
+        branches = []
+        branch_scopes = []
+        for branch in fork.processes:
+            branch_scope = self.new_scope()
+            match branch:
+                case ImageProcessingPipeline():
+                    stages = ([CopyScopeStage(scope, branch_scope)] +
+                              self.chain(branch.processes, branch_scope))
+                case ProcessPassThrough():
+                    stages = [AliasScopeStage(scope, branch_scope)]
+                case ProcessJoined(forkedProcess=ProcessFork()):
+                    stages = [self.fork_join(branch, scope, target=branch_scope)]
+                case ProcessFork():
+                    raise ValueError(
+                        f"The branch '{_name(branch)}' of a fork must be joined.")
+                case AbstractProcess() | AbstractPipeline():
+                    stages = [self.call(branch, scope, target=branch_scope)]
+                case _:
+                    raise ValueError(
+                        f"The branch '{type(branch)}' must be a AbstractProcess or "
+                        f"ImageProcessingPipeline.")
+            branches.append(stages)
+            branch_scopes.append(branch_scope)
+        shared, shared_scopes = self.share_prefixes(branches, scope)
+        return ForkJoinStage(fork, branches, branch_scopes,
+                             joined.kwargs_mapping, scope, target,
+                             shared, shared_scopes)
+
+    def share_prefixes(self,
+                       branches: list[list[Stage]],
+                       scope: int) -> tuple[list[Stage], list[int]]:
+        """Compute the common prefixes of the branches once (in-place).
+
+           The branches are grouped by their first process. The pipelines
+           share their longest common chain of pure processes and the
+           processes that are branches by themselves share their return.
+
+        Returns
+        -------
+        tuple[list[Stage], list[int]]
+            The stages of the shared prefixes and their scopes.
+        """
+        def process_of(stage: Stage):
+            if (type(stage) in (CallStage, MemoCallStage) and
+                    getattr(stage.process, "pure", False)):
+                return stage.process
+            return None
+
+        groups: dict[tuple, list[int]] = {}
+        for index, stages in enumerate(branches):
+            match stages:
+                case [CopyScopeStage(), first, *_] if process_of(first) is not None:
+                    groups.setdefault(("chain", id(first.process)), []).append(index)
+                case [CallStage(target=int()) as call] if process_of(call) is not None:
+                    groups.setdefault(("call", id(call.process)), []).append(index)
+        shared, shared_scopes = [], []
+        for (kind, _), indexes in groups.items():
+            if len(indexes) < 2:
+                continue
+            shared_scope = self.new_scope()
+            shared_scopes.append(shared_scope)
+            if kind == "call":
+                shared.append(self.call(branches[indexes[0]][0].process,
+                                        scope, target=shared_scope))
+                for index in indexes:
+                    branches[index] = [AliasScopeStage(shared_scope,
+                                                       branches[index][0].target)]
+                continue
+            # The length of the common chain (after the copy)
+            chains = [branches[index][1:] for index in indexes]
+            length = 0
+            while all(length < len(chain) and
+                      process_of(chain[length]) is not None and
+                      chain[length].process is chains[0][length].process
+                      for chain in chains):
+                length += 1
+            shared.append(CopyScopeStage(scope, shared_scope))
+            shared += [self.call(stage.process, shared_scope)
+                       for stage in chains[0][:length]]
+            for index, chain in zip(indexes, chains):
+                branches[index] = ([CopyScopeStage(shared_scope, branches[index][0].target)] +
+                                   chain[length:])
+        return shared, shared_scopes
+
+
+def _effects(stage: CallStage) -> tuple[frozenset | None, frozenset | None, bool]:
+    """The names that a call reads and returns (None if unknown) and whether it is pure."""
+    contract = getattr(stage.process, "contract", None)
+    if not isinstance(contract, Contract) or contract.forwards:
+        return None, None, False
+    outputs = frozenset(contract.outputs) if contract.outputs is not None else None
+    return contract.reads, outputs, getattr(stage.process, "pure", False)
+
+
+def _union(*names: frozenset | None) -> frozenset | None:
+    """The union of the sets of names, where None is all of them."""
+    if any(n is None for n in names):
+        return None
+    return frozenset().union(*names)
+
+
+def _drop_lazy(stage: CallStage, unread: frozenset) -> None:
+    """Call the process without its lazy outputs that are not read."""
+    lazy = unread & frozenset(getattr(stage.process, "lazy_outputs", ()))
+    if lazy:
+        stage.process = stage.process.without(lazy)
+
+
+class _Liveness:
+    """Prune a plan by the names that are read after each stage (None is all of them)."""
+
+    def chain(self, stages: list[Stage], live: frozenset | None
+              ) -> tuple[list[Stage], frozenset | None]:
+        """The pruned chain of stages and the names it reads from its scope."""
+        pruned: list[Stage] = []
+        for stage in reversed(stages):
+            match stage:
+                case CallStage(target=None):
+                    reads, outputs, pure = _effects(stage)
+                    if (live is not None and outputs is not None and
+                            pure and not live & outputs):
+                        continue
+                    if live is not None and outputs is not None:
+                        _drop_lazy(stage, outputs - live)
+                        reads, outputs, pure = _effects(stage)
+                    touched = _union(reads, outputs)
+                    if live is not None and (touched is None or touched - live):
+                        pruned.append(RetainStage(stage.scope, live))
+                    pruned.append(stage)
+                    if outputs is not None and live is not None:
+                        live = live - outputs
+                    live = _union(live, reads)
+                case ForkJoinStage(target=None):
+                    if live is not None:
+                        pruned.append(RetainStage(stage.scope, live))
+                    fork, reads = self.fork_join(stage, live)
+                    pruned.append(fork)
+                    live = _union(live, reads)
+                case _:
+                    pruned.append(stage)
+                    live = None
+        pruned.reverse()
+        # The last retain is done by the returned outputs.
+        if len(pruned) > 0 and isinstance(pruned[-1], RetainStage) and pruned[-1].scope == 0:
+            pruned.pop()
+        return pruned, live
+
+    def fork_join(self, stage: ForkJoinStage, live: frozenset | None
+                  ) -> tuple[ForkJoinStage, frozenset | None]:
+        """Prune the branches of a fork, by the names read from its joined payload.
+
+        Returns
+        -------
+        tuple[ForkJoinStage, frozenset | None]
+            The fork and the names that it reads from its scope.
+        """
+        reads: frozenset | None = frozenset()
+        for shared in stage.shared:
+            if isinstance(shared, CallStage):
+                reads = _union(reads, _effects(shared)[0])
+        # The names of the later branches have precedence, so
+        # what they return is not read from the earlier ones.
+        remaining = live
+        for index in reversed(range(len(stage.branches))):
+            renames = dict(stage.kwargs_mapping.get(index, ()))
+            originals = {new: old for old, new in renames.items()}
+            need = None
+            if remaining is not None:
+                need = frozenset(originals.get(name, name) for name in remaining
+                                 if name in originals or name not in renames)
+            returns = None
+            match stage.branches[index]:
+                case [CopyScopeStage() as copy, *rest]:
+                    rest, branch_reads = self.chain(rest, need)
+                    stage.branches[index] = [copy] + rest
+                    returns = _union(*(_effects(s)[1] for s in rest
+                                       if isinstance(s, CallStage)))
+                case [CallStage(target=int()) as call]:
+                    branch_reads, returns, pure = _effects(call)
+                    if (need is not None and returns is not None and
+                            pure and not need & returns):
+                        stage.branches[index] = []
+                        continue
+                    if need is not None and returns is not None:
+                        _drop_lazy(call, returns - need)
+                        branch_reads, returns, pure = _effects(call)
+                case [ForkJoinStage() as fork]:
+                    stage.branches[index][0], branch_reads = self.fork_join(fork, need)
+                case _:
+                    branch_reads = need
+            reads = _union(reads, branch_reads)
+            if remaining is not None and returns is not None:
+                remaining = remaining - {renames.get(name, name) for name in returns}
+        if stage.target is None:
+            # The names that the join does not return are read from the scope.
+            reads = _union(reads, remaining)
+        return stage, reads
+
+
+def _use_pool(stages: list[Stage], pool: BufferPool) -> None:
+    for stage in stages:
+        stage.pool = pool
+        if isinstance(stage, ForkJoinStage):
+            _use_pool(stage.shared, pool)
+            for branch in stage.branches:
+                _use_pool(branch, pool)
+
+
+def compile_pipeline(pipeline: ImageProcessingPipeline,
+                     memo: StageMemo | None = None,
+                     outputs: Sequence[str] | None = None,
+                     buffers: BufferPool | None = None) -> ExecutionPlan:
+    """Compile a pipeline into a validated, flat ExecutionPlan.
+
+    Parameters
+    ----------
+    pipeline : ImageProcessingPipeline
+        The pipeline.
+    memo : StageMemo | None, optional
+        Memoize the stages of the memoizable processes, by default None.
+    outputs : Sequence[str] | None, optional
+        The names that the caller reads from the returned payload, by
+        default None, which returns all of them. Otherwise, the stages
+        and the names that they do not depend on are pruned.
+    buffers : BufferPool | None, optional
+        The pool of the arrays of the processes, by default None.
+
+    Raises
+    ------
+    ValueError
+        Raises when the pipeline contains an unjoined fork, a renaming of a
+        branch that does not exist or an object that is not a process.
+    """
+    compiler = _Compiler(memo, pipeline.contract)
+    stages = compiler.chain(pipeline.processes, 0)
+    if outputs is not None:
+        outputs = tuple(outputs)
+        stages, _ = _Liveness().chain(stages, frozenset(outputs))
+    if buffers is not None:
+        _use_pool(stages, buffers)
+    return ExecutionPlan(stages, compiler.scopes_count, outputs, buffers, memo)
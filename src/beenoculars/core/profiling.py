@@ -0,0 +1,234 @@
+"""Opt-in profiling of the stages of the pipelines.
+
+   Notes:
+   ------
+       1- A Profiler records a span for every process that a pipeline calls
+          (by the interpreted 'process', ProcessFork, ProcessJoined and the
+          stages of a compiled plan): its wall and CPU time, the bytes of the
+          arrays it reads and returns, and the thread it has run on.
+
+       2- The profiler is active inside its 'with' block, for all threads.
+          When no profiler is active, a pipeline run only checks it once (and
+          once per branch of a fork) and calls its processes directly.
+
+       3- The CPU time is the time of the calling thread ('time.thread_time'),
+          so the worker threads of OpenCV are not included: a CPU time much
+          shorter than the wall time hints at a parallel or a waiting process.
+
+       4- 'save_chrome_trace' writes the spans as a Chrome trace, which can be
+          opened in chrome://tracing or https://ui.perfetto.dev and 'summary'
+          aggregates them by process.
+
+   Example:
+       with Profiler() as profiler:
+           pipeline(image=image)
+       print(profiler.summary())
+       profiler.save_chrome_trace("pipeline.trace.json")
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, Mapping
+
+from beenoculars.core.payloads import nbytes
+
+# The profiler of the 'with' block that is running, if any
+_active: Profiler | None = None
+_lock = threading.Lock()
+
+
+def active_profiler() -> Profiler | None:
+    """The active profiler, or None when profiling is off."""
+    return _active
+
+
+def process_name(process) -> str:
+    """The name of a process in the profiles (e.g. the name of a logic function)."""
+    from beenoculars.core.caches import CachedProcess
+    if isinstance(process, CachedProcess):
+        return f"cached:{process_name(process.process)}"
+    callback = getattr(process, "logic_callback", None)
+    if callback is not None:
+        return getattr(callback, "__name__", type(process).__name__)
+    return type(process).__name__
+
+
+def _read_nbytes(process, payload: Mapping[str, Any]) -> int:
+    contract = getattr(process, "contract", None)
+    reads = getattr(contract, "reads", None)
+    if reads is None:
+        return nbytes(payload)
+    return nbytes({name: payload.get(name) for name in reads})
+
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    category: str
+    # time.perf_counter_ns at the start
+    start: int
+    # wall and CPU time in ns
+    wall: int
+    cpu: int
+    thread: int
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+
+@dataclass(slots=True)
+class SpanStats:
+    calls: int = 0
+    wall: int = 0
+    cpu: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+
+
+class Profiler:
+    def __init__(self):
+        """Record the spans of the processes of the pipelines in a 'with' block."""
+        self.spans: list[Span] = []
+        self._origin = time.perf_counter_ns()
+        self._threads: dict[int, str] = {}
+        self._previous: Profiler | None = None
+
+    def __enter__(self) -> Profiler:
+        global _active
+        with _lock:
+            self._previous = _active
+            _active = self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active
+        with _lock:
+            _active = self._previous
+            self._previous = None
+
+    def record(self,
+               name: str,
+               category: str,
+               start: int,
+               cpu_start: int,
+               bytes_in: int = 0,
+               bytes_out: int = 0) -> None:
+        """Record a span that started at 'start' (perf_counter_ns) and 'cpu_start' (thread_time_ns)."""
+        wall = time.perf_counter_ns() - start
+        cpu = time.thread_time_ns() - cpu_start
+        thread = threading.current_thread()
+        if thread.ident not in self._threads:
+            self._threads[thread.ident] = thread.name
+        # list.append is atomic, the branches of the forks record concurrently.
+        self.spans.append(Span(name, category, start, wall, cpu,
+                               thread.ident, bytes_in, bytes_out))
+
+    @contextmanager
+    def span(self, name: str, category: str = "pipeline") -> Iterator[None]:
+        """Record the block as a span (e.g. a fork with all its branches)."""
+        start, cpu_start = time.perf_counter_ns(), time.thread_time_ns()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, cpu_start)
+
+    def call(self,
+             process: Callable[..., Mapping[str, Any]],
+             payload: Mapping[str, Any],
+             call: Callable[[Mapping[str, Any]], Mapping[str, Any]] | None = None
+             ) -> Mapping[str, Any]:
+        """Call a process with a payload and record its span.
+
+        Parameters
+        ----------
+        process : Callable[..., Mapping[str, Any]]
+            The process, which is called by the payload (process(**payload)).
+        payload : Mapping[str, Any]
+            The payload.
+        call : Callable[[Mapping[str, Any]], Mapping[str, Any]] | None, optional
+            Call the process by 'call(payload)' instead, by default None
+            (e.g. through a memo).
+
+        Returns
+        -------
+        Mapping[str, Any]
+            The returned payload of the process.
+        """
+        bytes_in = _read_nbytes(process, payload)
+        ret = None
+        start, cpu_start = time.perf_counter_ns(), time.thread_time_ns()
+        try:
+            ret = process(**payload) if call is None else call(payload)
+            return ret
+        finally:
+            self.record(process_name(process), "process", start, cpu_start,
+                        bytes_in, nbytes(ret) if ret is not None else 0)
+
+    def wrap(self, process: Callable[..., Mapping[str, Any]]) -> Callable[..., Mapping[str, Any]]:
+        """The process, which records its span when it is called (e.g. the branch of a fork)."""
+        def profiled(**kwargs):
+            return self.call(process, kwargs)
+        return profiled
+
+    def stats(self) -> dict[str, SpanStats]:
+        """The spans aggregated by name, in the order of their first call."""
+        stats: dict[str, SpanStats] = {}
+        for span in list(self.spans):
+            s = stats.setdefault(span.name, SpanStats())
+            s.calls += 1
+            s.wall += span.wall
+            s.cpu += span.cpu
+            s.bytes_in += span.bytes_in
+            s.bytes_out += span.bytes_out
+        return stats
+
+    def summary(self) -> str:
+        """A table of the spans aggregated by name, the slowest first."""
+        header = (f"{'process':<32} {'calls':>6} {'wall ms':>10} {'mean ms':>9} "
+                  f"{'cpu ms':>10} {'in MB':>9} {'out MB':>9}")
+        lines = [header, "-" * len(header)]
+        stats = sorted(self.stats().items(), key=lambda item: -item[1].wall)
+        for name, s in stats:
+            lines.append(f"{name[:32]:<32} {s.calls:>6} {s.wall / 1e6:>10.3f} "
+                         f"{s.wall / 1e6 / s.calls:>9.3f} {s.cpu / 1e6:>10.3f} "
+                         f"{s.bytes_in / 2**20:>9.2f} {s.bytes_out / 2**20:>9.2f}")
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        """The spans in the Chrome trace event format (see 'save_chrome_trace')."""
+        pid = os.getpid()
+        events: list[dict] = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+             "args": {"name": name}}
+            for tid, name in list(self._threads.items())]
+        for span in list(self.spans):
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start - self._origin) / 1e3,
+                "dur": span.wall / 1e3,
+                "pid": pid,
+                "tid": span.thread,
+                "args": {"cpu_ms": span.cpu / 1e6,
+                         "bytes_in": span.bytes_in,
+                         "bytes_out": span.bytes_out},
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path: str | Path) -> None:
+        """Save the spans as a Chrome trace (JSON), for chrome://tracing or Perfetto."""
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def clear(self) -> None:
+        self.spans.clear()
+        self._origin = time.perf_counter_ns()
+
+    def __repr__(self) -> str:
+        return f"Profiler(spans={len(self.spans)})"
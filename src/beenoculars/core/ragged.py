@@ -0,0 +1,174 @@
+"""A ragged array: many arrays of different lengths (e.g. the contours) in one.
+
+   Notes:
+   ------
+       1- RaggedArray keeps all the items (e.g. the points of all the
+          contours) in one 'values' array, and every item is the slice
+          'values[starts[i]:ends[i]]'. An item is a view of the shape
+          (length, *values.shape[1:]), e.g. the (n, 1, 2) contours of
+          cv.findContours.
+
+       2- Selecting items (by a boolean mask, indices or a slice) only
+          selects their starts and ends, the values are shared (zero-copy).
+          'compact' gathers the values of the items, in order, into one
+          contiguous array (in O(values) NumPy time), for the computations
+          over all of them (e.g. beenoculars.image_processing.contour_stats).
+
+       3- It is a Sequence of its items, so it is iterated as a list of
+          arrays. 'to_list' returns the views that OpenCV takes (e.g.
+          cv.drawContours), at the cost of a view per item.
+
+       4- The caches, the buffers and the ProcessPoolRunner treat it as an
+          array: it is digested, frozen, stored and shared by its arrays.
+
+   Example:
+       contours = RaggedArray.from_arrays(cv.findContours(...)[0], item_shape=(1, 2))
+       large = contours[areas > 100]      # zero-copy
+       cv.drawContours(image, large.to_list(), -1, (0, 255, 0))
+"""
+from __future__ import annotations
+
+from collections.abc import Sequence
+from typing import Iterable, Iterator
+
+import numpy as np
+from numpy import ndarray
+
+
+def _offsets(lengths: ndarray) -> ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.intp)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def ranges(starts: ndarray, lengths: ndarray) -> ndarray:
+    """The indices of the ranges [start, start + length), concatenated."""
+    offsets = _offsets(lengths)
+    return np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+
+class RaggedArray(Sequence):
+    __slots__ = ("values", "starts", "ends", "__weakref__")
+
+    def __init__(self, values: ndarray, starts: ndarray, ends: ndarray):
+        """The items 'values[starts[i]:ends[i]]' (see the notes of the module).
+
+        Parameters
+        ----------
+        values : ndarray
+            The values of all the items, along the first axis.
+        starts : ndarray
+            The start of every item in the values.
+        ends : ndarray
+            The end of every item in the values.
+        """
+        self.values = values
+        self.starts = np.asarray(starts, dtype=np.intp)
+        self.ends = np.asarray(ends, dtype=np.intp)
+
+    @classmethod
+    def from_arrays(cls,
+                    arrays: Iterable[ndarray],
+                    item_shape: tuple[int, ...] = (),
+                    dtype=np.int32) -> RaggedArray:
+        """Concatenate the arrays into a RaggedArray.
+
+        Parameters
+        ----------
+        arrays : Iterable[ndarray]
+            The items, e.g. the contours of cv.findContours.
+        item_shape : tuple[int, ...], optional
+            The shape of the values of the items, after the first axis,
+            if there are no arrays, by default ().
+        dtype : optional
+            The dtype of the values, if there are no arrays, by default np.int32.
+        """
+        arrays = arrays if isinstance(arrays, (list, tuple)) else list(arrays)
+        lengths = np.fromiter(map(len, arrays), dtype=np.intp, count=len(arrays))
+        offsets = _offsets(lengths)
+        if len(arrays) == 0:
+            values = np.empty((0, *item_shape), dtype=dtype)
+        else:
+            values = np.concatenate(arrays)
+        return cls(values, offsets[:-1], offsets[1:])
+
+    @classmethod
+    def of(cls, items: RaggedArray | Iterable[ndarray], **kwargs) -> RaggedArray:
+        """The items themselves, if they are a RaggedArray, or a RaggedArray of them."""
+        if isinstance(items, RaggedArray):
+            return items
+        return cls.from_arrays(items, **kwargs)
+
+    @property
+    def lengths(self) -> ndarray:
+        return self.ends - self.starts
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.starts.nbytes + self.ends.nbytes
+
+    @property
+    def is_compact(self) -> bool:
+        """Whether the items are all the values, in order."""
+        if len(self) == 0:
+            return len(self.values) == 0
+        return (self.starts[0] == 0 and self.ends[-1] == len(self.values) and
+                bool(np.array_equal(self.starts[1:], self.ends[:-1])))
+
+    @property
+    def offsets(self) -> ndarray:
+        """The starts and the end of the last item (len + 1) of the compacted items."""
+        return _offsets(self.lengths)
+
+    def compact(self) -> RaggedArray:
+        """The items with their own contiguous values, in order (see the notes of the module)."""
+        if self.is_compact:
+            return self
+        lengths = self.lengths
+        offsets = _offsets(lengths)
+        return RaggedArray(self.values[ranges(self.starts, lengths)],
+                           offsets[:-1], offsets[1:])
+
+    def to_list(self) -> list[ndarray]:
+        """The items as a list of views, e.g. for cv.drawContours."""
+        values = self.values
+        return [values[start:end] for start, end in zip(self.starts.tolist(),
+                                                        self.ends.tolist())]
+
+    def copy(self) -> RaggedArray:
+        """A compact copy that does not share the values."""
+        compact = self.compact()
+        values = compact.values.copy() if compact is self else compact.values
+        return RaggedArray(values, compact.starts.copy(), compact.ends.copy())
+
+    def read_only(self) -> RaggedArray:
+        """The same items, over a read-only view of the values."""
+        if not self.values.flags.writeable:
+            return self
+        view = self.values.view()
+        view.flags.writeable = False
+        return RaggedArray(view, self.starts, self.ends)
+
+    def freeze(self) -> None:
+        """Make the arrays read-only."""
+        for array in (self.values, self.starts, self.ends):
+            array.flags.writeable = False
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.values[self.starts[key]:self.ends[key]]
+        if isinstance(key, (list, tuple)):
+            key = np.asarray(key)
+            if key.size == 0:
+                key = key.astype(np.intp)
+        return RaggedArray(self.values, self.starts[key], self.ends[key])
+
+    def __iter__(self) -> Iterator[ndarray]:
+        return iter(self.to_list())
+
+    def __repr__(self) -> str:
+        return (f"RaggedArray(len={len(self)}, values={self.values.shape}, "
+                f"dtype={self.values.dtype})")
@@ -0,0 +1,457 @@
+"""Runners that execute a pipeline outside of the calling process.
+
+   Notes:
+   ------
+       1- ProcessPoolRunner runs a pipeline on a pool of worker processes.
+          The ndarray values of the payloads (and lists or tuples of
+          ndarrays, or RaggedArrays, e.g. contours) are not pickled. They are written once
+          into 'multiprocessing.shared_memory' blocks and the workers
+          read them in place as zero-copy views.
+
+       2- The returned ndarrays travel back the same way and are copied
+          out of their shared block once in the caller's process, so
+          their life-time is not bound to the shared memory. Arrays that
+          a worker returns unchanged (e.g. through a PassThrough) are not
+          copied at all: the workers read them as read-only views, and the
+          processes that change them in-place get copies, like in the
+          pipelines, so the views that are still read-only are unchanged.
+
+       3- The pipeline is pickled once per worker, so all of its processes
+          must be picklable (module level classes and functions).
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Iterable, Iterator, Mapping
+
+import numpy as np
+from numpy import ndarray
+
+from beenoculars.config import Dict
+from beenoculars.core.buffers import own
+from beenoculars.core.payloads import to_dict
+from beenoculars.core.ragged import RaggedArray
+
+# logger
+log = logging.getLogger(__name__)
+
+
+class SharedNDArray:
+    """A picklable handle of an ndarray that is stored in a shared memory block."""
+
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    @staticmethod
+    def create(array: ndarray) -> tuple[SharedNDArray, SharedMemory]:
+        shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        view[...] = array
+        del view
+        return SharedNDArray(shm.name, array.shape, array.dtype.str), shm
+
+    def attach(self) -> tuple[ndarray, SharedMemory]:
+        shm = SharedMemory(name=self.name)
+        view = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=shm.buf)
+        # Like the arrays in the pipelines, they are read-only (copy-on-write),
+        # so the unchanged ones are recognized when they are returned.
+        view.flags.writeable = False
+        return view, shm
+
+
+class SharedNDArraySequence:
+    """A picklable handle of a list or a tuple of ndarrays.
+
+       All the arrays (e.g. contours) must have the same dtype and
+       are packed into one shared memory block.
+    """
+
+    def __init__(self, block: SharedNDArray, shapes: list[tuple], offsets: list[int],
+                 container: type):
+        self.block = block
+        self.shapes = shapes
+        self.offsets = offsets
+        self.container = container
+
+    @staticmethod
+    def create(arrays: list | tuple) -> tuple[SharedNDArraySequence, SharedMemory]:
+        flat = np.concatenate([a.ravel() for a in arrays])
+        block, shm = SharedNDArray.create(flat)
+        offsets = np.cumsum([0] + [a.size for a in arrays]).tolist()
+        return SharedNDArraySequence(block,
+                                     [a.shape for a in arrays],
+                                     offsets,
+                                     type(arrays)), shm
+
+    def attach(self) -> tuple[list | tuple, SharedMemory]:
+        flat, shm = self.block.attach()
+        arrays = [flat[start:end].reshape(shape)
+                  for shape, start, end in zip(self.shapes,
+                                               self.offsets[:-1],
+                                               self.offsets[1:])]
+        return self.container(arrays), shm
+
+
+class SharedRaggedArray:
+    """A picklable handle of a RaggedArray, whose values are in a shared memory block."""
+
+    def __init__(self, block: SharedNDArray, offsets: ndarray):
+        self.block = block
+        self.offsets = offsets
+
+    @staticmethod
+    def create(ragged: RaggedArray) -> tuple[SharedRaggedArray, SharedMemory]:
+        compact = ragged.compact()
+        block, shm = SharedNDArray.create(compact.values)
+        return SharedRaggedArray(block, compact.offsets), shm
+
+    def attach(self) -> tuple[RaggedArray, SharedMemory]:
+        values, shm = self.block.attach()
+        ragged = RaggedArray(values, self.offsets[:-1], self.offsets[1:])
+        ragged.freeze()
+        return ragged, shm
+
+
+def _is_array_sequence(value) -> bool:
+    return (isinstance(value, (list, tuple)) and
+            len(value) > 0 and
+            all(isinstance(v, ndarray) for v in value) and
+            len({v.dtype for v in value}) == 1)
+
+
+def _encode(payload: Mapping[str, Any],
+            known: Mapping[int, Any] = {}) -> tuple[dict, list[SharedMemory]]:
+    """Replace the ndarray values of the payload by shared memory handles.
+
+    Parameters
+    ----------
+    payload : Mapping[str, Any]
+        The payload.
+    known : Mapping[int, Any], optional
+        The handles of the values that are already in shared memory,
+        by the id of the value, by default {}.
+
+    Returns
+    -------
+    tuple[dict, list[SharedMemory]]
+        The encoded payload and the created shared memory blocks.
+    """
+    encoded = {}
+    blocks = []
+    for key, value in payload.items():
+        if id(value) in known:
+            encoded[key] = known[id(value)]
+        elif isinstance(value, ndarray) and value.dtype != object:
+            encoded[key], shm = SharedNDArray.create(value)
+            blocks.append(shm)
+        elif _is_array_sequence(value) and value[0].dtype != object:
+            encoded[key], shm = SharedNDArraySequence.create(value)
+            blocks.append(shm)
+        elif isinstance(value, RaggedArray) and value.values.dtype != object:
+            encoded[key], shm = SharedRaggedArray.create(value)
+            blocks.append(shm)
+        else:
+            encoded[key] = value
+    return encoded, blocks
+
+
+def _decode(encoded: Mapping[str, Any]) -> tuple[dict, list[SharedMemory], dict]:
+    """Attach the shared memory handles of an encoded payload as views.
+
+    Returns
+    -------
+    tuple[dict, list[SharedMemory], dict]
+        The decoded payload, the attached blocks and the handles by
+        the id of their views, with the views and their arrays.
+    """
+    payload = {}
+    blocks = []
+    handles = {}
+    for key, value in encoded.items():
+        if isinstance(value, (SharedNDArray, SharedNDArraySequence, SharedRaggedArray)):
+            payload[key], shm = value.attach()
+            blocks.append(shm)
+            handles[id(payload[key])] = (value, payload[key], _arrays_of(payload[key]))
+        else:
+            payload[key] = value
+    return payload, blocks, handles
+
+
+def _arrays_of(view) -> tuple[ndarray, ...]:
+    if isinstance(view, ndarray):
+        return (view,)
+    if isinstance(view, RaggedArray):
+        return (view.values, view.starts, view.ends)
+    return tuple(view)
+
+
+def _unchanged(handles: Mapping[int, tuple]) -> dict[int, Any]:
+    """The handles of the decoded views that are provably unchanged.
+
+       They still hold the same arrays (e.g. no item of a list has been
+       replaced) and they are still read-only, so they have not been
+       written to.
+    """
+    known = {}
+    for key, (handle, view, arrays) in handles.items():
+        current = _arrays_of(view)
+        if (len(current) == len(arrays) and
+                all(a is b and not a.flags.writeable for a, b in zip(current, arrays))):
+            known[key] = handle
+    return known
+
+
+def _close(blocks: list[SharedMemory], unlink: bool = False) -> None:
+    for shm in blocks:
+        try:
+            shm.close()
+        except BufferError:
+            # A view is still alive (e.g. kept by a process); the block
+            # is released with it.
+            pass
+        if unlink:
+            shm.unlink()
+
+
+def _name_of(value) -> str | None:
+    match value:
+        case SharedNDArray():
+            return value.name
+        case SharedNDArraySequence() | SharedRaggedArray():
+            return value.block.name
+        case _:
+            return None
+
+
+def _receive(encoded: Mapping[str, Any],
+             sent: Mapping[str, str],
+             sent_payload: Mapping[str, Any]) -> Dict:
+    """Decode a returned payload in the caller's process.
+
+    Parameters
+    ----------
+    encoded : Mapping[str, Any]
+        The encoded payload that the worker returned.
+    sent : Mapping[str, str]
+        The keys of the sent payload by the name of their blocks.
+    sent_payload : Mapping[str, Any]
+        The sent payload.
+    """
+    payload = {}
+    received = []
+    try:
+        for key, value in encoded.items():
+            name = _name_of(value)
+            if name is None:
+                payload[key] = value
+            elif name in sent:
+                # Returned unchanged by the worker.
+                payload[key] = sent_payload[sent[name]]
+            else:
+                view, shm = value.attach()
+                received.append(shm)
+                if isinstance(view, (ndarray, RaggedArray)):
+                    payload[key] = view.copy()
+                else:
+                    payload[key] = type(view)(v.copy() for v in view)
+                del view
+    finally:
+        _close(received, unlink=True)
+    return to_dict(payload)
+
+
+def stream(submit: Callable[[Mapping[str, Any]], Future],
+           payloads: Iterable[Mapping[str, Any]],
+           ordered: bool = True,
+           max_inflight: int = 1) -> Iterator[Any]:
+    """Submit the payloads lazily, with at most 'max_inflight' of them pending.
+
+    Parameters
+    ----------
+    submit : Callable[[Mapping[str, Any]], Future]
+        Sends one payload to an executor.
+    payloads : Iterable[Mapping[str, Any]]
+        The payloads, consumed lazily.
+    ordered : bool, optional
+        Yield the results in the order of the payloads, by default True.
+        Otherwise, they are yielded as soon as they are ready.
+    max_inflight : int, optional
+        The maximum number of submitted and not yielded payloads, by default 1.
+
+    Yields
+    ------
+    Iterator[Any]
+        The results. The pending payloads are cancelled when the
+        generator is closed or a result raises.
+    """
+    inflight: deque[Future] = deque()
+    iterator = iter(payloads)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(inflight) < max_inflight:
+                try:
+                    inflight.append(submit(next(iterator)))
+                except StopIteration:
+                    exhausted = True
+            if len(inflight) == 0:
+                return
+            if ordered:
+                yield inflight.popleft().result()
+            else:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    inflight.remove(future)
+                    yield future.result()
+    finally:
+        for future in inflight:
+            future.cancel()
+
+
+__worker_pipeline = None
+
+
+def _init_worker(pipeline) -> None:
+    global __worker_pipeline
+    __worker_pipeline = pipeline
+
+
+def _run_in_worker(encoded: Mapping[str, Any]) -> dict:
+    payload, blocks, handles = _decode(encoded)
+    try:
+        # Like in the pipelines, a process that changes its arrays
+        # in-place gets copies of them (see beenoculars.core.buffers).
+        mutates = getattr(__worker_pipeline, "mutates", ())
+        result = __worker_pipeline(**(own(payload, mutates, reuse=False)  # type: ignore
+                                      if mutates else payload))
+        # The unchanged inputs are sent back by their handles.
+        encoded_result, out_blocks = _encode(result, known=_unchanged(handles))
+        # The caller owns (and unlinks) the returned blocks.
+        _close(out_blocks)
+        return encoded_result
+    finally:
+        payload = result = handles = None
+        _close(blocks)
+
+
+class ProcessPoolRunner:
+    def __init__(self,
+                 pipeline,
+                 max_workers: int | None = None,
+                 mp_context: str = "spawn"):
+        """Run a pipeline on a pool of worker processes.
+
+           Example:
+               with ProcessPoolRunner(imp.ToBlackWhite >> imp.ToContours) as runner:
+                   for result in runner.map(Dict(image=img) for img in images):
+                       ...
+
+        Parameters
+        ----------
+        pipeline : AbstractPipeline | AbstractProcess
+            The (picklable) pipeline that each worker runs.
+        max_workers : int | None, optional
+            The number of worker processes, by default None, which
+            means the number of CPUs.
+        mp_context : str, optional
+            The multiprocessing start method, by default "spawn".
+        """
+        self.pipeline = pipeline
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context(mp_context),
+            initializer=_init_worker,
+            initargs=(pipeline,))
+
+    def submit(self, **kwargs) -> Future:
+        """Send one payload to the pool.
+
+        Returns
+        -------
+        Future
+            A future of the returned payload as a Dict.
+        """
+        encoded, blocks = _encode(kwargs)
+        # The names of the sent blocks, to recognise the unchanged inputs
+        sent = {_name_of(value): key for key, value in encoded.items()
+                if _name_of(value) is not None}
+        try:
+            future = self._executor.submit(_run_in_worker, encoded)
+        except BaseException:
+            _close(blocks, unlink=True)
+            raise
+        result = Future()
+        # Cancelling the result (e.g. when a stream is closed) withdraws the
+        # payload from the pool, if no worker has started it yet.
+        result.add_done_callback(lambda _: future.cancel() if result.cancelled() else None)
+
+        def done(worker_future: Future):
+            try:
+                if worker_future.cancelled():
+                    result.cancel()
+                if not result.set_running_or_notify_cancel():
+                    # The worker may have finished anyway: its returned
+                    # blocks are unlinked by '_receive'.
+                    if not worker_future.cancelled() and worker_future.exception() is None:
+                        _receive(worker_future.result(), sent, kwargs)
+                    return
+                try:
+                    result.set_result(_receive(worker_future.result(), sent, kwargs))
+                except BaseException as e:
+                    result.set_exception(e)
+            except Exception:
+                log.exception("Could not release the shared memory of a cancelled payload")
+            finally:
+                _close(blocks, unlink=True)
+
+        future.add_done_callback(done)
+        return result
+
+    def process(self, **kwargs) -> Dict:
+        """Run the pipeline for one payload and wait for the result."""
+        return self.submit(**kwargs).result()
+
+    def map(self,
+            payloads: Iterable[Mapping[str, Any]],
+            ordered: bool = True,
+            max_inflight: int | None = None) -> Iterator[Dict]:
+        """Stream the payloads through the pool.
+
+        Parameters
+        ----------
+        payloads : Iterable[Mapping[str, Any]]
+            The payloads, consumed lazily.
+        ordered : bool, optional
+            Yield the results in the order of the payloads, by default True.
+            Otherwise, they are yielded as soon as they are ready.
+        max_inflight : int | None, optional
+            The maximum number of payloads (and their shared memory) in the
+            pool at any time, by default None, which is twice the number of
+            workers.
+
+        Yields
+        ------
+        Iterator[Dict]
+            The returned payloads.
+        """
+        return stream(lambda payload: self.submit(**payload),
+                      payloads,
+                      ordered=ordered,
+                      max_inflight=max_inflight or 2 * self.max_workers)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def __enter__(self) -> ProcessPoolRunner:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
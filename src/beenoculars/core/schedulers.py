@@ -0,0 +1,145 @@
+"""Schedulers of the interactive runs of the services.
+
+   Notes:
+   ------
+       1- A slider sends its events faster than a pipeline processes an
+          image. If every event runs the pipeline, they queue up and the
+          shown image lags further and further behind the slider.
+
+       2- LatestWinsScheduler keeps at most one run in flight and one
+          pending run. A new event replaces the pending run, which is
+          dropped without running, so the run after the in-flight one is
+          always the one of the latest parameters.
+
+       3- With 'cancel_stale', the in-flight run is stale as soon as a newer
+          one is submitted, too: it is cancelled at its next stage (every run
+          has its own CancellationToken, see beenoculars.core.cancellation)
+          and its result is dropped. Otherwise (the default) it is shown, so
+          the image keeps following the slider while it is dragged.
+
+       4- A dropped run returns None to its caller and is counted in
+          'dropped'. The scheduler must be used from one event loop.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import logging
+from typing import Any, Awaitable, Callable
+
+from beenoculars.core.cancellation import CancellationToken, _current_token
+
+# logger
+log = logging.getLogger(__name__)
+
+
+class LatestWinsScheduler:
+    def __init__(self, cancel_stale: bool = False):
+        """Run the latest of the submitted runs, at most one at a time.
+
+           Example:
+               scheduler = LatestWinsScheduler()
+               results = await scheduler.submit(lambda: pipeline.aprocess(**payload))
+               if results is None:
+                   return  # A newer run has replaced it
+
+        Parameters
+        ----------
+        cancel_stale : bool, optional
+            Cancel the in-flight run and drop its result when a newer run
+            is submitted, by default False, which shows it.
+        """
+        self.cancel_stale = cancel_stale
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self._running: asyncio.Future | None = None
+        self._token: CancellationToken | None = None
+        self._stale = False
+        self._pending: tuple[Callable[[], Awaitable[Any]], asyncio.Future] | None = None
+
+    @property
+    def busy(self) -> bool:
+        """Whether a run is in flight."""
+        return self._running is not None
+
+    async def submit(self, run: Callable[[], Awaitable[Any]]) -> Any | None:
+        """Schedule a run and wait for its result.
+
+        Parameters
+        ----------
+        run : Callable[[], Awaitable[Any]]
+            Starts the run, e.g. lambda: pipeline.aprocess(**payload). It is
+            only called when the run starts, so a dropped run costs nothing.
+
+        Returns
+        -------
+        Any | None
+            The result of the run, or None if a newer run has replaced it.
+
+        Raises
+        ------
+        Exception
+            Raises the exception of the run.
+        """
+        result = asyncio.get_running_loop().create_future()
+        self.submitted += 1
+        if self._pending is not None:
+            self._drop(self._pending[1])
+        self._pending = (run, result)
+        if self._running is None:
+            self._start_next()
+        elif self.cancel_stale:
+            self._stale = True
+            self._token.cancel("A newer run has been submitted.")  # type: ignore
+        return await result
+
+    def _drop(self, result: asyncio.Future) -> None:
+        self.dropped += 1
+        if not result.done():
+            result.set_result(None)
+
+    def _start_next(self) -> None:
+        run, result = self._pending  # type: ignore
+        self._pending = None
+        self._stale = False
+        # The run (and the stages it sends to the executors) checks its token
+        self._token = CancellationToken(parent=_current_token.get())
+        context = contextvars.copy_context()
+        context.run(_current_token.set, self._token)
+        try:
+            awaitable = context.run(run)
+            if asyncio.iscoroutine(awaitable):
+                self._running = asyncio.get_running_loop().create_task(
+                    awaitable, context=context)
+            else:
+                self._running = asyncio.ensure_future(awaitable)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        self._running.add_done_callback(lambda task: self._finished(task, result))
+
+    def _finished(self, task: asyncio.Future, result: asyncio.Future) -> None:
+        self._running = None
+        self._token = None
+        # Retrieved even if it is not raised (e.g. a dropped run)
+        exception = None if task.cancelled() else task.exception()
+        if self._stale:
+            self._drop(result)
+        elif result.done():
+            # The caller does not wait for it anymore
+            pass
+        elif task.cancelled():
+            result.cancel()
+        elif exception is not None:
+            result.set_exception(exception)
+        else:
+            self.completed += 1
+            result.set_result(task.result())
+        if self._pending is not None:
+            self._start_next()
+
+    def __repr__(self) -> str:
+        return (f"LatestWinsScheduler(submitted={self.submitted}, "
+                f"completed={self.completed}, dropped={self.dropped}, "
+                f"cancel_stale={self.cancel_stale})")
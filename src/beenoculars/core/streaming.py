@@ -0,0 +1,310 @@
+"""A stage-pipelined executor for the streams of frames (e.g. a camera).
+
+   Notes:
+   ------
+       1- StreamingExecutor runs every stage of a compiled pipeline on its
+          own worker thread and connects them by bounded queues, so the
+          stages of successive frames overlap: frame N+1 is converted while
+          frame N is contoured. The throughput is bound by the slowest stage
+          instead of the sum of all of them; the latency of a frame is not
+          shorter.
+
+       2- The stages that only move the payload around (e.g. the 'Retain'
+          stages of the liveness, see beenoculars.core.plans) run on the
+          worker of the stage before them, and a fork/join runs on one
+          worker (its branches still run on the executor of the fork).
+
+       3- The queues are bounded ('queue_size'), so a slow stage blocks the
+          ones before it and, finally, the reading of the frames: the memory
+          of the frames in flight is bounded (backpressure). The results are
+          yielded in the order of the frames, since every stage processes
+          them in order.
+
+       4- The processes whose 'main_thread' is True (e.g. the conversions to
+          the GUI images) must be the last ones; they run on the thread that
+          iterates over the results.
+
+       5- 'stats' reports the depth of every queue when a frame is put in it
+          and how long the puts have been blocked, so the stage after the
+          fullest queue is the bottleneck.
+
+   Example:
+       with StreamingExecutor(imp.ToBlackWhite >> imp.ToContours) as executor:
+           for result in executor.map(Dict(image=frame) for frame in frames):
+               ...
+       print(executor.summary())
+"""
+from __future__ import annotations
+
+import contextvars
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, Mapping
+
+from beenoculars.config import Dict
+from beenoculars.core.buffers import read_only, using_buffer_pool
+from beenoculars.core.pipelines import ImageProcessingPipeline
+from beenoculars.core.plans import (
+    AliasScopeStage,
+    CallStage,
+    CopyScopeStage,
+    ExecutionPlan,
+    RetainStage,
+    Stage,
+    _on_main_thread,
+    run_stages,
+)
+from beenoculars.core.profiling import process_name
+
+# logger
+log = logging.getLogger(__name__)
+
+# The end of the stream, it is passed through all the queues
+_END = object()
+# How often a blocked worker checks whether the executor is closed (s)
+_POLL = 0.05
+
+
+@dataclass(slots=True)
+class QueueStats:
+    # The name of the stage that reads the queue
+    name: str
+    maxsize: int
+    puts: int = 0
+    # The depth of the queue when the frames are put in it
+    max_depth: int = 0
+    total_depth: int = 0
+    # The puts that have found the queue full and their waiting time in ns
+    blocked: int = 0
+    blocked_ns: int = 0
+
+    @property
+    def mean_depth(self) -> float:
+        return self.total_depth / self.puts if self.puts > 0 else 0.0
+
+
+class _Closed(Exception):
+    """The executor has been closed while a worker waits."""
+
+
+def _stage_name(stages: list[Stage]) -> str:
+    stage = stages[0]
+    if isinstance(stage, CallStage):
+        return process_name(stage.process)
+    return type(stage).__name__
+
+
+class StreamingExecutor:
+    def __init__(self,
+                 pipeline: ImageProcessingPipeline | ExecutionPlan,
+                 queue_size: int = 2):
+        """Run the stages of a pipeline on their own threads, connected by bounded queues.
+
+        Parameters
+        ----------
+        pipeline : ImageProcessingPipeline | ExecutionPlan
+            The pipeline, which is compiled, or its plan.
+        queue_size : int, optional
+            The number of frames that each queue holds, by default 2.
+
+        Raises
+        ------
+        ValueError
+            Raises when a 'main_thread' process is followed by the others.
+        """
+        if isinstance(pipeline, ImageProcessingPipeline):
+            self._contract = pipeline.contract
+            self.plan = pipeline.compile()
+        else:
+            self._contract = None
+            self.plan = pipeline
+        self.queue_size = max(queue_size, 1)
+        self.groups, self.main_stages = self._split(self.plan.stages)
+        self._queues = [queue.Queue(maxsize=self.queue_size)
+                        for _ in range(len(self.groups) + 1)]
+        names = [_stage_name(stages) for stages in self.groups] + ["results"]
+        self._stats = [QueueStats(name, self.queue_size) for name in names]
+        self._closed = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    @staticmethod
+    def _split(stages: list[Stage]) -> tuple[list[list[Stage]], list[Stage]]:
+        """The stages of every worker and the last ones, which run on the main thread."""
+        light = (CopyScopeStage, AliasScopeStage, RetainStage)
+        main = 0
+        while main < len(stages) and _on_main_thread(stages[len(stages) - main - 1]):
+            main += 1
+        workers, main_stages = stages[:len(stages) - main], stages[len(stages) - main:]
+        if any(_on_main_thread(stage) for stage in workers):
+            raise ValueError(
+                "The processes that run on the main thread must be the last "
+                "ones of a streamed pipeline.")
+        groups: list[list[Stage]] = []
+        for stage in workers:
+            if len(groups) > 0 and isinstance(stage, light):
+                groups[-1].append(stage)
+            else:
+                groups.append([stage])
+        return groups, list(main_stages)
+
+    def _put(self, index: int, item: Any) -> None:
+        q, stats = self._queues[index], self._stats[index]
+        depth = q.qsize()
+        stats.puts += 1
+        stats.total_depth += depth
+        stats.max_depth = max(stats.max_depth, depth)
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        # Backpressure: wait until the next stage takes a frame
+        start = time.perf_counter_ns()
+        stats.blocked += 1
+        try:
+            while True:
+                if self._closed.is_set():
+                    raise _Closed()
+                try:
+                    q.put(item, timeout=_POLL)
+                    return
+                except queue.Full:
+                    pass
+        finally:
+            stats.blocked_ns += time.perf_counter_ns() - start
+
+    def _get(self, index: int) -> Any:
+        q = self._queues[index]
+        while True:
+            if self._closed.is_set():
+                raise _Closed()
+            try:
+                return q.get(timeout=_POLL)
+            except queue.Empty:
+                pass
+
+    def _feed(self, payloads: Iterable[Mapping[str, Any]]) -> None:
+        try:
+            try:
+                for kwargs in payloads:
+                    if self._contract is not None:
+                        self._contract.check(kwargs)
+                    scopes: list = [None] * self.plan.scopes_count
+                    scopes[0] = read_only(dict(kwargs))
+                    self._put(0, (scopes, None))
+            except _Closed:
+                raise
+            except Exception as e:
+                # e.g. the reading of a frame or an incompatible payload
+                self._put(0, (None, e))
+            self._put(0, _END)
+        except _Closed:
+            pass
+
+    def _work(self, index: int) -> None:
+        stages = self.groups[index]
+        try:
+            with using_buffer_pool(self.plan.buffers):
+                while True:
+                    item = self._get(index)
+                    if item is not _END:
+                        scopes, error = item
+                        if error is None:
+                            try:
+                                run_stages(stages, scopes)
+                            except Exception as e:
+                                item = (None, e)
+                    self._put(index + 1, item)
+                    if item is _END:
+                        return
+        except _Closed:
+            pass
+
+    def map(self, payloads: Iterable[Mapping[str, Any]]) -> Iterator[Dict]:
+        """Stream the payloads through the stages.
+
+        Parameters
+        ----------
+        payloads : Iterable[Mapping[str, Any]]
+            The payloads (e.g. the frames of a camera), which are read
+            lazily on a thread, as fast as the stages take them.
+
+        Yields
+        ------
+        Iterator[Dict]
+            The returned payloads, in the order of the payloads.
+
+        Raises
+        ------
+        Exception
+            Raises the exception of a payload, when its result is reached.
+            The stream is closed.
+        """
+        if len(self._threads) > 0:
+            raise RuntimeError("The executor is already streaming.")
+        self._closed.clear()
+        # The context (e.g. a cancellation token) goes with the workers
+        targets = [(self._feed, (payloads,), "feed")] + [
+            (self._work, (index,), _stage_name(stages))
+            for index, stages in enumerate(self.groups)]
+        self._threads = [
+            threading.Thread(target=contextvars.copy_context().run,
+                             args=(target, *args),
+                             name=f"beenoculars-stream-{name}",
+                             daemon=True)
+            for target, args, name in targets]
+        for thread in self._threads:
+            thread.start()
+        last = len(self.groups)
+        try:
+            while True:
+                item = self._queues[last].get()
+                if item is _END:
+                    return
+                scopes, error = item
+                if error is not None:
+                    raise error
+                with using_buffer_pool(self.plan.buffers):
+                    run_stages(self.main_stages, scopes)
+                    result = self.plan._result(scopes[0])
+                yield result
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop the workers and drop the frames in flight."""
+        self._closed.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for q in self._queues:
+            while not q.empty():
+                q.get_nowait()
+
+    def stats(self) -> list[QueueStats]:
+        """The metrics of the queues, in the order of the stages that read them."""
+        return list(self._stats)
+
+    def summary(self) -> str:
+        """A table of the metrics of the queues."""
+        header = (f"{'queue of':<32} {'size':>5} {'puts':>7} {'mean':>6} {'max':>5} "
+                  f"{'blocked':>8} {'blocked ms':>11}")
+        lines = [header, "-" * len(header)]
+        for s in self._stats:
+            lines.append(f"{s.name[:32]:<32} {s.maxsize:>5} {s.puts:>7} "
+                         f"{s.mean_depth:>6.2f} {s.max_depth:>5} {s.blocked:>8} "
+                         f"{s.blocked_ns / 1e6:>11.3f}")
+        return "\n".join(lines)
+
+    def __enter__(self) -> StreamingExecutor:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return (f"StreamingExecutor(workers={len(self.groups)}, "
+                f"queue_size={self.queue_size})")
@@ -1,11 +1,18 @@
 from ..core import ProcessPassThrough as __PassThrough__  # noqa
+from .processes import ContourStatisticsProcess as __ContourStatisticsProcess__
+from .processes import MaskByAreaProcess as __MaskByAreaProcess__
 from .processes import MaskContoursByAreaProcess as __MaskContoursByAreaProcess__
+from .processes import OverlayComponentsOnProcess as __OverlayComponentsOnProcess__
 from .processes import OverlayContoursOnProcess as __OverlayContoursOnProcess__
 from .processes import ToBlackWhiteProcess as __ToBlackWhiteProcess__
 from .processes import ToColorProcess as __ToColorProcess__
+from .processes import ToComponentsProcess as __ToComponentsProcess__
+from .processes import ToContourAreasProcess as __ToContourAreasProcess__
 from .processes import ToContoursProcess as __ToContoursProcess__
 from .processes import ToConvexHullContoursProcess as __ToConvexHullContoursProcess__
 from .processes import ToGrayProcess as __ToGrayProcess__
+from .processes import ToPyramidLevelProcess as __ToPyramidLevelProcess__
+from .processes import UpscaleContoursProcess as __UpscaleContoursProcess__
 
 ToBlackWhite = __ToBlackWhiteProcess__()
 ToGray = __ToGrayProcess__()
@@ -13,5 +20,18 @@ ToColor = __ToColorProcess__()
 ToContours = __ToContoursProcess__()
 MaskContoursByArea = __MaskContoursByAreaProcess__()
 ToConvexHullContours = __ToConvexHullContoursProcess__()
+ContourStatistics = __ContourStatisticsProcess__()
 OverlayContoursOn = __OverlayContoursOnProcess__()
+ToComponents = __ToComponentsProcess__()
+MaskByArea = __MaskByAreaProcess__()
+# The areas of the components are masked as the ones of the contours
+MaskComponentsByArea = MaskByArea
+ToContourAreas = __ToContourAreasProcess__()
+OverlayComponentsOn = __OverlayComponentsOnProcess__()
+ToPyramidLevel = __ToPyramidLevelProcess__()
+UpscaleContours = __UpscaleContoursProcess__()
 PassThrough = __PassThrough__()
+
+from .tiling import TiledPipeline  # noqa
+
+from . import rewrites as __rewrites__  # noqa
@@ -0,0 +1,176 @@
+"""The statistics of many contours at once, by NumPy instead of Python loops.
+
+   Notes:
+   ------
+       1- The contours are a RaggedArray (see beenoculars.core.ragged): the
+          points of all of them are in one array and every statistic is a
+          sum (or a min/max) over the segments of the contours
+          ('np.add.reduceat'), so a scan with tens of thousands of contours
+          costs a few NumPy calls instead of an OpenCV call per contour. The
+          lists of contours are concatenated first.
+
+       2- They are the ones of OpenCV: 'area' is cv.contourArea, 'perimeter'
+          is cv.arcLength (closed), the box is cv.boundingRect and the
+          centroid is the one of cv.moments (the mean of the points of the
+          contours without area, whose moments are zero).
+
+       3- The hull of a convex contour is the contour itself (its edges turn
+          one way and once around), so cv.convexHull is only called for the
+          others (the loop can be cancelled, see
+          beenoculars.core.cancellation). The hulls share the points of the
+          convex contours.
+
+       4- 'solidity' is the area over the area of the hull, 0 for the
+          contours without area.
+
+   Example:
+       stats = contour_statistics(contours)
+       large = stats["area"] > 100
+       solid = stats["solidity"][large] > 0.9
+"""
+from __future__ import annotations
+
+from typing import Sequence
+
+import cv2 as cv
+import numpy as np
+from numpy import ndarray
+
+from beenoculars.core.cancellation import cancellable
+from beenoculars.core.ragged import RaggedArray
+
+# The columns of the statistics of the contours
+STATS_DTYPE = np.dtype([
+    ("area", np.float64),
+    ("perimeter", np.float64),
+    ("x", np.int32),
+    ("y", np.int32),
+    ("width", np.int32),
+    ("height", np.int32),
+    ("cx", np.float64),
+    ("cy", np.float64),
+    ("hull_area", np.float64),
+    ("solidity", np.float64),
+])
+
+
+def as_contours(contours: RaggedArray | Sequence[ndarray]) -> RaggedArray:
+    """The contours as a RaggedArray of (n, 1, 2) points."""
+    return RaggedArray.of(contours, item_shape=(1, 2), dtype=np.int32)
+
+
+def _flatten(contours: RaggedArray) -> tuple[ndarray, ndarray, ndarray]:
+    """The x and y of the points of all the contours and the offsets (len + 1) of every contour."""
+    compact = contours.compact()
+    points = compact.values.reshape(-1, 2)
+    # Contiguous columns, the strided ones are slower to compute on
+    return points[:, 0].astype(np.float64), points[:, 1].astype(np.float64), compact.offsets
+
+
+def _following(values: ndarray, offsets: ndarray) -> ndarray:
+    """The values of the next point of every point, the first one after the last one."""
+    starts, ends = offsets[:-1], offsets[1:]
+    nonempty = ends > starts
+    following = np.empty_like(values)
+    following[:-1] = values[1:]
+    following[ends[nonempty] - 1] = values[starts[nonempty]]
+    return following
+
+
+def _segment_sum(values: ndarray, offsets: ndarray, ufunc=np.add, empty=0) -> ndarray:
+    """Reduce the values of every contour, the empty contours are 'empty'."""
+    result = np.full(len(offsets) - 1, empty, dtype=values.dtype)
+    nonempty = offsets[1:] > offsets[:-1]
+    if np.any(nonempty):
+        result[nonempty] = ufunc.reduceat(values, offsets[:-1][nonempty])
+    return result
+
+
+def _shoelace(xs: ndarray, ys: ndarray, offsets: ndarray) -> tuple[ndarray, ndarray]:
+    """The twice signed area of every contour and the cross products of its points."""
+    cross = xs * _following(ys, offsets) - _following(xs, offsets) * ys
+    return _segment_sum(cross, offsets), cross
+
+
+def _convex(xs: ndarray, ys: ndarray, offsets: ndarray) -> ndarray:
+    """Whether every contour turns one way, once around (or has less than 3 points)."""
+    ex, ey = _following(xs, offsets) - xs, _following(ys, offsets) - ys
+    ax, ay = _following(ex, offsets), _following(ey, offsets)
+    turns = ex * ay - ey * ax
+    left = _segment_sum(turns > 0, offsets, np.logical_or, False)
+    right = _segment_sum(turns < 0, offsets, np.logical_or, False)
+    # The contours of the thin objects go back on themselves (or repeat points)
+    back = (turns == 0) & (ex * ax + ey * ay <= 0)
+    back = _segment_sum(back, offsets, np.logical_or, False)
+    # The edges of a contour that turns one way point up after pointing down
+    # once per turn around
+    up = (ey > 0) | ((ey == 0) & (ex > 0))
+    windings = _segment_sum((~up & _following(up, offsets)).astype(np.intp), offsets)
+    return (~(left & right) & ~back & (windings == 1)) | (np.diff(offsets) < 3)
+
+
+def convex_hulls(contours: RaggedArray | Sequence[ndarray]) -> RaggedArray:
+    """The convex hulls of the contours, the convex contours are their own hulls."""
+    contours = as_contours(contours)
+    concave = np.flatnonzero(~_convex(*_flatten(contours)))
+    if len(concave) == 0:
+        return contours
+    hulls = [cv.convexHull(contours[index]) for index in cancellable(concave)]
+    # The hulls are appended to the points, the convex contours keep theirs
+    lengths = np.fromiter(map(len, hulls), dtype=np.intp, count=len(hulls))
+    starts, ends = contours.starts.copy(), contours.ends.copy()
+    starts[concave] = len(contours.values) + np.cumsum(lengths) - lengths
+    ends[concave] = starts[concave] + lengths
+    values = np.concatenate([contours.values, *hulls]).astype(contours.values.dtype,
+                                                              copy=False)
+    return RaggedArray(values, starts, ends)
+
+
+def contour_areas(contours: RaggedArray | Sequence[ndarray]) -> ndarray:
+    """The areas of the contours, as cv.contourArea."""
+    twice, _ = _shoelace(*_flatten(as_contours(contours)))
+    return np.abs(twice) / 2
+
+
+def contour_statistics(contours: RaggedArray | Sequence[ndarray]) -> ndarray:
+    """Compute the statistics of all the contours at once.
+
+    Parameters
+    ----------
+    contours : RaggedArray | Sequence[ndarray]
+        The contours, as returned by ToContours (or cv.findContours).
+
+    Returns
+    -------
+    ndarray
+        A structured array (see STATS_DTYPE) with a row per contour.
+    """
+    stats = np.zeros(len(contours), dtype=STATS_DTYPE)
+    if len(contours) == 0:
+        return stats
+    contours = as_contours(contours)
+    xs, ys, offsets = _flatten(contours)
+    lengths = np.diff(offsets)
+    twice, cross = _shoelace(xs, ys, offsets)
+    stats["area"] = np.abs(twice) / 2
+    nx, ny = _following(xs, offsets), _following(ys, offsets)
+    stats["perimeter"] = _segment_sum(np.hypot(nx - xs, ny - ys), offsets)
+    # The boxes are the ones of the pixels, so they are one larger than the spans
+    for low, size, values in (("x", "width", xs), ("y", "height", ys)):
+        stats[low] = _segment_sum(values, offsets, np.minimum)
+        high = _segment_sum(values, offsets, np.maximum)
+        stats[size] = np.where(lengths > 0, high - stats[low] + 1, 0)
+    # The centroids of the polygons (Green's theorem), or of their points
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for column, values, following in (("cx", xs, nx), ("cy", ys, ny)):
+            moment = _segment_sum((values + following) * cross, offsets)
+            mean = _segment_sum(values, offsets) / np.maximum(lengths, 1)
+            stats[column] = np.where(twice != 0, moment / (3 * twice), mean)
+    # The hulls of the convex contours are the contours
+    hull_area = stats["area"].copy()
+    for index in cancellable(np.flatnonzero(~_convex(xs, ys, offsets))):
+        hull_area[index] = cv.contourArea(cv.convexHull(contours[index]))
+    stats["hull_area"] = hull_area
+    stats["solidity"] = np.divide(stats["area"], hull_area,
+                                  out=np.zeros(len(contours)), where=hull_area > 0)
+    return stats
@@ -36,7 +36,8 @@ def triple_choice_background(is_gray: bool, is_bw: bool) -> ImageProcessingPipel
 
 @processFactory(cache=True)
 def overlay_pipeline(has_contour: bool,
-                     contoursMasksLogic: Process | ImageProcessingPipeline
+                     contoursMasksLogic: Process | ImageProcessingPipeline,
+                     counting: str = "contours"
                      ) -> ImageProcessingPipeline:
     """Create an image processing pipeline to overlay and count the cotours.
 
@@ -46,18 +47,41 @@ def overlay_pipeline(has_contour: bool,
         If it is true, contour overlays will be plotted on the image.
     contoursMasksLogic : Process | ImageProcessingPipeline
         The logic for filtering cotours.
-        It must be a process that takes litss of contours and masks
-        and returns a Dict of filtered contours.
+        It must be a process that takes the contours (a RaggedArray, see
+        beenoculars.core.ragged) and their masks and returns a Dict of
+        filtered contours, e.g. 'contours[masks]'.
+    counting : str, optional
+        "contours" (the default) counts the convex hulls of the contours.
+        "components" counts the connected components of the black and
+        white image, whose areas are their pixels: it is faster when only
+        the areas and the counts are needed, and the outlines of the
+        selected components are drawn instead of their hulls
+        ('contoursMasksLogic' is not used).
 
     Returns
     -------
     ImageProcessingPipeline
         An image processing pipeline.
+
+    Raises
+    ------
+    ValueError
+        Raises when the counting is unknown.
     """
+    if counting not in ("contours", "components"):
+        raise ValueError(f"Unknown counting '{counting}'.")
     toFramework = registry[ToFrameworkImage]
     if not has_contour:
         return toFramework
 
+    if counting == "components":
+        pl_components = (imp.ToBlackWhite >>
+                         imp.ToComponents >>
+                         imp.MaskComponentsByArea)
+        return ((pl_components * imp.PassThrough) >>
+                imp.OverlayComponentsOn >>
+                toFramework)
+
     pl_counters = (imp.ToBlackWhite >>
                    imp.ToContours >>
                    imp.ToConvexHullContours >>
@@ -3,80 +3,257 @@ import cv2 as cv
 import numpy as np
 from numpy import ndarray
 
-from beenoculars.config import Dict
-from beenoculars.core import Process
+from beenoculars.core import Payload, Process
+from beenoculars.core.buffers import out_buffer
+from beenoculars.core.ragged import RaggedArray
+
+from .contour_stats import as_contours, contour_areas, contour_statistics, convex_hulls
+from .pyramid import preview_level_of, pyramid_down, upscale_contours
 
 
 class ToGrayProcess(Process):
-    def __call__(self, *, image: ndarray, **kwargs) -> Dict:
-        return Dict(image=cv.cvtColor(image, cv.COLOR_BGR2GRAY))
+    outputs = ("image",)
+
+    def __call__(self, *, image: ndarray, **kwargs) -> Payload:
+        # It is already gray
+        if image.ndim == 2:
+            return Payload(image=image)
+        gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY,
+                           dst=out_buffer(image.shape[:2], image.dtype))
+        return Payload(image=gray)
 
 
 class ToColorProcess(Process):
-    def __call__(self, *, image: ndarray, **kwargs) -> Dict:
-        return Dict(image=cv.cvtColor(image, cv.COLOR_GRAY2BGR))
+    outputs = ("image",)
+
+    def __call__(self, *, image: ndarray, **kwargs) -> Payload:
+        color = cv.cvtColor(image, cv.COLOR_GRAY2BGR,
+                            dst=out_buffer((*image.shape[:2], 3), image.dtype))
+        return Payload(image=color)
 
 
 class ToBlackWhiteProcess(Process):
+    outputs = ("image",)
+
     def __call__(self,
                  *,
                  image: ndarray,
                  threshold: int = 127,
-                 **kwargs) -> Dict:
-        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+                 **kwargs) -> Payload:
+        if image.ndim == 3:
+            # The gray image is a temporary, so it is thresholded in-place.
+            gray = cv.cvtColor(image, cv.COLOR_BGR2GRAY,
+                               dst=out_buffer(image.shape[:2], image.dtype))
+            dst = gray
+        else:
+            gray, dst = image, out_buffer(image.shape, image.dtype)
         _, thresh_image = cv.threshold(
-            image, threshold, 255, cv.THRESH_BINARY)
-        return Dict(image=thresh_image)
+            gray, threshold, 255, cv.THRESH_BINARY, dst=dst)
+        return Payload(image=thresh_image)
+
+
+class ToPyramidLevelProcess(Process):
+    outputs = ("image", "preview_level")
+
+    def __call__(self,
+                 *,
+                 image: ndarray,
+                 preview_level: int | None = None,
+                 **kwargs) -> Payload:
+        # The previews of the sliders, see beenoculars.image_processing.pyramid
+        if preview_level is None:
+            preview_level = preview_level_of(image.shape)
+        return Payload(image=pyramid_down(image, preview_level),
+                       preview_level=preview_level)
 
 
 class ToContoursProcess(Process):
+    outputs = ("contours", "hierarchy")
+    # The pipelines that do not read the 'hierarchy' do not build it
+    lazy_outputs = ("hierarchy",)
+
     def __call__(self,
                  *,
                  image: ndarray,
-                 **kwargs) -> Dict:
-        contours, hierarchy = cv.findContours(image,
-                                              cv.RETR_TREE,
-                                              cv.CHAIN_APPROX_SIMPLE)
-        return Dict(contours=contours, hierarchy=hierarchy)
+                 contours_mode: int = cv.RETR_TREE,
+                 contours_method: int = cv.CHAIN_APPROX_SIMPLE,
+                 **kwargs) -> Payload:
+        contours, hierarchy = cv.findContours(image, contours_mode, contours_method)
+        # One array of all the points, see beenoculars.core.ragged
+        return Payload(contours=as_contours(contours), hierarchy=hierarchy)
+
+    def without(self, names: frozenset) -> Process:
+        if "hierarchy" in names:
+            return ToContoursWithoutHierarchyProcess()
+        return self
+
+
+class ToContoursWithoutHierarchyProcess(Process):
+    """ToContours in the compiled pipelines that do not read the 'hierarchy'."""
+    outputs = ("contours",)
+
+    def __call__(self,
+                 *,
+                 image: ndarray,
+                 contours_mode: int = cv.RETR_TREE,
+                 contours_method: int = cv.CHAIN_APPROX_SIMPLE,
+                 **kwargs) -> Payload:
+        # The same contours (in another order) without linking them into
+        # a tree, which costs more than finding them on the large images
+        if contours_mode in (cv.RETR_TREE, cv.RETR_CCOMP):
+            contours_mode = cv.RETR_LIST
+        contours, _ = cv.findContours(image, contours_mode, contours_method)
+        return Payload(contours=as_contours(contours))
+
+
+def _masks_by_area(areas: ndarray, percentages) -> ndarray | tuple:
+    """The areas between the percentiles 'percentages' of the areas."""
+    if len(areas) == 0:
+        return ()
+    # max_areas = np.max(areas)
+    # min_areas = np.min(areas)
+    # bar = (max_areas - min_areas) * percentage
+    bar_1 = np.percentile(areas, percentages[0])
+    bar_2 = np.percentile(areas, percentages[1])
+    return np.where((areas > bar_1) & (areas < bar_2), True, False)
+
+
+class ToComponentsProcess(Process):
+    outputs = ("labels", "areas", "centroids", "boxes")
+
+    def __call__(self,
+                 *,
+                 image: ndarray,
+                 connectivity: int = 8,
+                 **kwargs) -> Payload:
+        # The objects of a black and white image, with their areas (in
+        # pixels), centroids and boxes, in one pass. The label 0 is the
+        # background, it is not an object. The block-based algorithm (BBDT)
+        # is about twice as fast as the default one on the photos.
+        _, labels, stats, centroids = cv.connectedComponentsWithStatsWithAlgorithm(
+            image,
+            connectivity,
+            cv.CV_32S,
+            cv.CCL_GRANA,
+            labels=out_buffer(image.shape[:2], np.int32))
+        return Payload(labels=labels,
+                       areas=stats[1:, cv.CC_STAT_AREA].astype(np.float64),
+                       centroids=centroids[1:],
+                       boxes=stats[1:, :cv.CC_STAT_AREA])
+
+
+class ToContourAreasProcess(Process):
+    outputs = ("areas",)
+
+    def __call__(self,
+                 *,
+                 contours: RaggedArray,
+                 **kwargs) -> Payload:
+        return Payload(areas=contour_areas(contours))
+
+
+class MaskByAreaProcess(Process):
+    outputs = ("masks",)
+
+    def __call__(self,
+                 *,
+                 areas: ndarray,
+                 percentages=(40, 60),
+                 **kwargs) -> Payload:
+        return Payload(masks=_masks_by_area(areas, percentages))
 
 
 class MaskContoursByAreaProcess(Process):
+    outputs = ("areas", "masks")
+
     def __call__(self,
                  *,
-                 contours: list,
+                 contours: RaggedArray,
                  percentages=(40, 60),
-                 **kwargs) -> Dict:
+                 **kwargs) -> Payload:
 
-        areas = np.array([cv.contourArea(cnt) for cnt in contours])
-        if len(areas) == 0:
-            return Dict(areas=areas, masks=())
-        # max_areas = np.max(areas)
-        # min_areas = np.min(areas)
-        # bar = (max_areas - min_areas) * percentage
-        bar_1 = np.percentile(areas, percentages[0])
-        bar_2 = np.percentile(areas, percentages[1])
-        masks = np.where((areas > bar_1) & (areas < bar_2), True, False)
-        return Dict(areas=areas, masks=masks)
+        # The contours of a large scan can be many, see contour_stats.
+        areas = contour_areas(contours)
+        return Payload(areas=areas, masks=_masks_by_area(areas, percentages))
 
 
 class ToConvexHullContoursProcess(Process):
+    outputs = ("contours",)
+
+    def __call__(self,
+                 *,
+                 contours: RaggedArray,
+                 **kwargs) -> Payload:
+        # The convex contours are their own hulls, see contour_stats.
+        return Payload(contours=convex_hulls(contours))
+
+
+class UpscaleContoursProcess(Process):
+    outputs = ("contours",)
+
     def __call__(self,
                  *,
-                 contours: list,
-                 **kwargs) -> Dict:
-        return Dict(contours=[cv.convexHull(cnt) for cnt in contours])
+                 contours: RaggedArray,
+                 preview_level: int = 0,
+                 **kwargs) -> Payload:
+        return Payload(contours=upscale_contours(as_contours(contours), preview_level))
+
+
+class ContourStatisticsProcess(Process):
+    outputs = ("contours_stats",)
+
+    def __call__(self,
+                 *,
+                 contours: RaggedArray,
+                 **kwargs) -> Payload:
+        # A structured array, a column per statistic (see contour_stats)
+        return Payload(contours_stats=contour_statistics(contours))
 
 
 class OverlayContoursOnProcess(Process):
+    outputs = ("image",)
+    # It draws on the image
+    mutates = ("image",)
+
     def __call__(self,
                  *,
                  image: ndarray,
-                 contours: list,
+                 contours: RaggedArray | list,
                  contours_thickness: int = 1,
                  contours_color=(0, 255, 0),
-                 **kwargs) -> Dict:
+                 **kwargs) -> Payload:
+        # The image is a copy, if it is shared by other stages
+        # (e.g. a memoized one), see beenoculars.core.buffers.
+        if isinstance(contours, RaggedArray):
+            contours = contours.to_list()
         overlay_image = cv.drawContours(image, contours,
                                         contourIdx=-1,
                                         color=contours_color,
                                         thickness=contours_thickness)
-        return Dict(image=overlay_image)
+        return Payload(image=overlay_image)
+
+
+class OverlayComponentsOnProcess(Process):
+    outputs = ("image",)
+    # It draws on the image
+    mutates = ("image",)
+
+    def __call__(self,
+                 *,
+                 image: ndarray,
+                 labels: ndarray,
+                 masks,
+                 contours_thickness: int = 1,
+                 contours_color=(0, 255, 0),
+                 **kwargs) -> Payload:
+        # The selected objects, by a lookup of their labels
+        lut = np.zeros(len(masks) + 1, dtype=np.uint8)
+        lut[1:][np.asarray(masks, dtype=bool)] = 255
+        selected = lut[labels]
+        if contours_thickness >= 0:
+            # Their outlines, about as thick as the drawn contours
+            kernel = np.ones((contours_thickness + 1,) * 2, dtype=np.uint8)
+            selected = cv.morphologyEx(selected, cv.MORPH_GRADIENT, kernel)
+        color = contours_color if image.ndim == 3 else contours_color[0]
+        image[selected > 0] = color
+        return Payload(image=image)
@@ -0,0 +1,100 @@
+"""The downscaled previews of the images, while the sliders are dragged.
+
+   Notes:
+   ------
+       1- A preview is a level of the image pyramid: every level is the
+          previous one blurred and halved by cv.pyrDown, so the level 'L'
+          has 4^L times fewer pixels. 'preview_level_of' is the first level
+          that is not larger than the 'preview_megapixels' of the
+          'pipeline' section of config.toml.
+
+       2- The contours of a preview are scaled back to the image, so the
+          overlay is drawn on the image (at full resolution) and the layouts
+          do not see the difference, but their details are the ones of the
+          preview.
+
+       3- The preview does not see the objects that are smaller than one
+          of its pixels (4^L pixels of the image), e.g. the specks of noise,
+          which can be most of the contours of a photo. The percentiles of
+          the areas are rescaled to the objects that it sees, by the
+          fraction of the smaller ones in the last full resolution run, so
+          the counts of the preview are close to the final ones.
+
+   Example:
+       level = preview_level_of(image.shape)
+       percentages = rescale_percentages((40, 100), small_fraction(areas, level))
+"""
+from __future__ import annotations
+
+import math
+
+import cv2 as cv
+import numpy as np
+from numpy import ndarray
+
+from beenoculars.config import Config
+from beenoculars.core.ragged import RaggedArray
+
+
+def preview_level_of(shape: tuple[int, ...], max_pixels: float | None = None) -> int:
+    """The first level of the pyramid of an image that has at most 'max_pixels' pixels.
+
+    Parameters
+    ----------
+    shape : tuple[int, ...]
+        The shape of the image.
+    max_pixels : float | None, optional
+        The size of the preview, by default None, which is the
+        'preview_megapixels' of the 'pipeline' section of config.toml.
+    """
+    if max_pixels is None:
+        max_pixels = Config.get("pipeline", {}).get("preview_megapixels", 1.0) * 1e6
+    pixels = shape[0] * shape[1]
+    if pixels <= max_pixels or max_pixels <= 0:
+        return 0
+    return math.ceil(math.log(pixels / max_pixels, 4))
+
+
+def pyramid_down(image: ndarray, level: int) -> ndarray:
+    """The level 'level' of the pyramid of the image (the image itself for 0)."""
+    for _ in range(level):
+        image = cv.pyrDown(image)
+    return image
+
+
+def upscale_contours(contours: RaggedArray, level: int) -> RaggedArray:
+    """The contours of the level 'level' of the pyramid in the pixels of the image."""
+    if level == 0:
+        return contours
+    scale = 2 ** level
+    # At the centres of the pixels that a pixel of the level covers
+    values = contours.values * scale + (scale - 1) // 2
+    return RaggedArray(values.astype(contours.values.dtype, copy=False),
+                       contours.starts, contours.ends)
+
+
+def small_fraction(areas: ndarray, level: int) -> float:
+    """The fraction of the areas (in the pixels of the image) that the level does not see."""
+    if level == 0 or len(areas) == 0:
+        return 0.0
+    return float(np.mean(np.asarray(areas) <= 4 ** level))
+
+
+def rescale_percentages(percentages, fraction: float) -> tuple[float, float]:
+    """The percentiles of the seen objects that are the 'percentages' of all of them.
+
+    Parameters
+    ----------
+    percentages : tuple[float, float]
+        The percentiles of the areas of all the objects.
+    fraction : float
+        The fraction of the objects that are not seen, which are the
+        smallest ones (see 'small_fraction').
+    """
+    if fraction <= 0:
+        return tuple(percentages)  # type: ignore
+    if fraction >= 1:
+        return (0.0, 100.0)
+    seen = 100 * (np.asarray(percentages, dtype=np.float64) / 100 - fraction) / (1 - fraction)
+    low, high = np.clip(seen, 0, 100).tolist()
+    return (low, high)
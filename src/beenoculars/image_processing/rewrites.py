@@ -0,0 +1,23 @@
+"""The fusions of the redundant colour conversions of the pipelines.
+
+   Notes:
+   ------
+       1- The rules are applied when a pipeline is compiled (see
+          beenoculars.core.plans.register_rewrite), so the chains like
+          'ToGray >> ToColor >> ToBlackWhite' call OpenCV once per image.
+
+       2- They are exact: the gray of a gray image that has been converted
+          to BGR is the same gray image, since the weights of the channels
+          sum up to one. ToGray and ToBlackWhite take gray images as they are.
+"""
+from beenoculars.core import register_rewrite
+
+from . import ToBlackWhite, ToColor, ToGray
+
+# The gray of the gray (as BGR) is the gray itself
+register_rewrite((ToGray, ToColor, ToBlackWhite), (ToBlackWhite,))
+register_rewrite((ToGray, ToBlackWhite), (ToBlackWhite,))
+register_rewrite((ToGray, ToGray), (ToGray,))
+# A gray image, converted to BGR and back
+register_rewrite((ToColor, ToGray), ())
+register_rewrite((ToColor, ToBlackWhite), (ToBlackWhite,))
@@ -0,0 +1,427 @@
+"""Tiled execution of the image pipelines, for very large images.
+
+   Notes:
+   ------
+       1- TiledPipeline runs a pipeline on overlapping tiles of the image
+          instead of the whole of it, so the intermediate images (e.g. the
+          gray, the black and white and the overlay ones) only live for a
+          tile at a time. Every tile is its 'core' (the tiles' cores
+          partition the image) grown by a 'halo' on every side.
+
+       2- The pipeline must only contain point and neighbourhood stages
+          (e.g. ToGray, ToBlackWhite, a blur), whose radius is not larger
+          than the halo, and may end by finding the contours. The cores of
+          the stitched images are then exactly the ones of the whole image.
+          The stages that need all the contours (e.g. MaskContoursByArea,
+          whose bars are percentiles) must come after the TiledPipeline.
+
+       3- The arrays that a tile returns with the size of the tile are
+          stitched from the cores of the tiles. The contours that are inside
+          the core of their tile are kept and the ones that cross its border
+          are merged: their pieces are painted, clipped to the core of their
+          tile, into a mask of the region and their contours are found again.
+          The 'hierarchy' of the stitched contours is not known, so it is
+          None. The holes are found again with the 'contours_mode' and the
+          'contours_method' of the payload, and a hole that crosses a border
+          is only kept if the pipeline returns the black and white image or
+          the tree (RETR_TREE or RETR_CCOMP) of the contours of the tiles.
+          With RETR_EXTERNAL, the objects in the holes of the merged contours
+          are dropped. Without the whole tree (RETR_LIST, RETR_CCOMP), the
+          holes and the objects in a crossing object that are inside a core
+          are not known to be in it, so the ones that its merging finds
+          again are dropped.
+
+       4- The tiles are as large as the peak memory target allows: the
+          'tile_memory_mb' of the 'pipeline' section of config.toml, less the
+          stitched result (estimated as large as the image, which belongs to
+          the caller). Every running tile is estimated to hold 'copies'
+          arrays of the size of the tile.
+
+       5- The tiles can run in parallel ('workers'), with at most 'workers'
+          of them in flight, and a cancelled run stops between the tiles
+          (see beenoculars.core.cancellation).
+
+   Example:
+       tiled = TiledPipeline(imp.ToBlackWhite >> imp.ToContours, halo=8, workers=4)
+       pipeline = tiled >> imp.ToConvexHullContours >> imp.MaskContoursByArea
+"""
+from __future__ import annotations
+
+import contextvars
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Iterator, Mapping
+
+import cv2 as cv
+import numpy as np
+from numpy import ndarray
+
+from beenoculars.config import Config, Dict
+from beenoculars.core.buffers import out_buffer
+from beenoculars.core.cancellation import cancellable
+from beenoculars.core.contracts import Contract
+from beenoculars.core.payloads import Payload
+from beenoculars.core.pipelines import AbstractProcess, ImageProcessingPipeline
+from beenoculars.core.runners import stream
+
+from .contour_stats import as_contours
+
+# The smallest side of the core of a tile
+MIN_TILE_SIZE = 64
+
+
+@dataclass(slots=True)
+class Tile:
+    # The rows and columns of the core and of the tile (the core and its halo)
+    # in the image, as (start, stop).
+    core_rows: tuple[int, int]
+    core_cols: tuple[int, int]
+    rows: tuple[int, int]
+    cols: tuple[int, int]
+
+    def of(self, image: ndarray) -> ndarray:
+        """The view of the tile in the image."""
+        return image[self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]]
+
+    @property
+    def core(self) -> tuple[slice, slice]:
+        """The slices of the core in the tile."""
+        return (slice(self.core_rows[0] - self.rows[0], self.core_rows[1] - self.rows[0]),
+                slice(self.core_cols[0] - self.cols[0], self.core_cols[1] - self.cols[0]))
+
+
+def split(shape: tuple[int, ...], tile_size: int, halo: int) -> list[Tile]:
+    """Split an image of the shape into tiles, whose cores are at most tile_size square."""
+    height, width = shape[:2]
+    tiles = []
+    for r0 in range(0, height, tile_size):
+        r1 = min(r0 + tile_size, height)
+        for c0 in range(0, width, tile_size):
+            c1 = min(c0 + tile_size, width)
+            tiles.append(Tile((r0, r1), (c0, c1),
+                              (max(r0 - halo, 0), min(r1 + halo, height)),
+                              (max(c0 - halo, 0), min(c1 + halo, width))))
+    return tiles
+
+
+def _depths(parents: ndarray) -> ndarray:
+    """The depth of every contour in its tree (0 is an outer border, 1 a hole, ...)."""
+    depths = np.zeros(len(parents), dtype=np.int32)
+    parent = parents.copy()
+    while np.any(parent >= 0):
+        has_parent = parent >= 0
+        depths[has_parent] += 1
+        parent = np.where(has_parent, parents[np.maximum(parent, 0)], -1)
+    return depths
+
+
+@dataclass(slots=True)
+class _Piece:
+    # A contour (in the image) that crosses the border of the core of its tile
+    contour: ndarray
+    depth: int
+    # Its bounding box and the core of its tile, as (x0, y0, x1, y1)
+    box: tuple[int, int, int, int]
+    core: tuple[int, int, int, int]
+
+
+def _groups(pieces: list[_Piece]) -> list[list[_Piece]]:
+    """Group the pieces whose bounding boxes overlap or touch (a sweep over x)."""
+    parent = list(range(len(pieces)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    order = sorted(range(len(pieces)), key=lambda i: pieces[i].box[0])
+    active: list[int] = []
+    for i in order:
+        x0, y0, x1, y1 = pieces[i].box
+        active = [j for j in active if pieces[j].box[2] >= x0]
+        for j in active:
+            if pieces[j].box[1] <= y1 and y0 <= pieces[j].box[3]:
+                parent[find(j)] = find(i)
+        active.append(i)
+    groups: dict[int, list[_Piece]] = {}
+    for i in range(len(pieces)):
+        groups.setdefault(find(i), []).append(pieces[i])
+    return list(groups.values())
+
+
+def _merge(group: list[_Piece],
+           with_holes: bool,
+           source: ndarray | None,
+           method: int = cv.CHAIN_APPROX_SIMPLE) -> list[ndarray]:
+    """The contours of the pieces of a group, painted clipped to the cores of their tiles.
+
+       The painted contours cover the pixels of the objects, and a few more at
+       their 1 pixel wide notches, so they are cut by the stitched image that
+       the contours have been found on, if there is one.
+    """
+    # With an empty border, so the contours that touch the region are not clipped
+    x0 = min(p.box[0] for p in group) - 1
+    y0 = min(p.box[1] for p in group) - 1
+    x1 = max(p.box[2] for p in group) + 1
+    y1 = max(p.box[3] for p in group) + 1
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    # The outer borders first and the holes over them, by their depth. With
+    # the source, the holes are cut by it.
+    for piece in sorted(group, key=lambda p: p.depth):
+        if source is not None and piece.depth % 2 == 1:
+            continue
+        cx0, cy0 = max(piece.core[0], x0), max(piece.core[1], y0)
+        cx1, cy1 = min(piece.core[2], x1), min(piece.core[3], y1)
+        if cx0 >= cx1 or cy0 >= cy1:
+            continue
+        core = mask[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+        hole = piece.depth % 2 == 1
+        cv.drawContours(core, [piece.contour], -1,
+                        color=0 if hole else 255,
+                        thickness=cv.FILLED,
+                        offset=(-cx0, -cy0))
+        if hole:
+            # The border of a hole is on the pixels around it
+            cv.drawContours(core, [piece.contour], -1, color=255, thickness=1,
+                            offset=(-cx0, -cy0))
+    if source is not None:
+        inside = mask[1:-1, 1:-1]
+        cv.bitwise_and(inside, source[y0 + 1:y1 - 1, x0 + 1:x1 - 1], dst=inside)
+    # The merged contours are a list, their tree is not needed
+    contours, _ = cv.findContours(mask,
+                                  cv.RETR_LIST if with_holes else cv.RETR_EXTERNAL,
+                                  method)
+    return [c + np.array([x0, y0], dtype=c.dtype) for c in contours]
+
+
+def _outside(contours: list[ndarray], outer: list[ndarray]) -> list[ndarray]:
+    """The contours that are not in the holes of the outer contours.
+
+       A tile does not see the whole of an object that crosses its border,
+       so the objects in its holes are outer contours (RETR_EXTERNAL) there.
+    """
+    if len(contours) == 0 or len(outer) == 0:
+        return contours
+    firsts = np.array([contour[0, 0] for contour in contours])
+    keep = np.ones(len(contours), dtype=bool)
+    for contour in outer:
+        x, y, w, h = cv.boundingRect(contour)
+        candidates = np.flatnonzero(keep &
+                                    (firsts[:, 0] >= x) & (firsts[:, 0] < x + w) &
+                                    (firsts[:, 1] >= y) & (firsts[:, 1] < y + h))
+        for i in candidates:
+            point = (float(firsts[i, 0]), float(firsts[i, 1]))
+            keep[i] = cv.pointPolygonTest(contour, point, False) <= 0
+    return [contour for contour, kept in zip(contours, keep) if kept]
+
+
+def _not_merged(contours: list[ndarray], merged: list[ndarray]) -> list[ndarray]:
+    """The contours that have not been found again by merging the crossing ones.
+
+       Without the trees of the contours (RETR_LIST, or the objects in the
+       holes with RETR_CCOMP), the holes of a crossing object and the objects
+       in them are not known to be in it, so the ones inside the core of
+       their tile are kept and found again when it is merged, on the same
+       pixels of the stitched image.
+    """
+    if len(contours) == 0 or len(merged) == 0:
+        return contours
+    found = {(c.shape, c.tobytes()) for c in merged}
+    return [contour for contour in contours
+            if (contour.shape, contour.tobytes()) not in found]
+
+
+class TiledPipeline(AbstractProcess):
+    def __init__(self,
+                 pipeline: ImageProcessingPipeline | AbstractProcess,
+                 halo: int = 16,
+                 tile_size: int | None = None,
+                 max_bytes: int | None = None,
+                 copies: int = 4,
+                 workers: int = 1):
+        """Run a pipeline on the overlapping tiles of the image (see the notes of the module).
+
+        Parameters
+        ----------
+        pipeline : ImageProcessingPipeline | AbstractProcess
+            The point and neighbourhood stages, which may end by finding
+            the contours.
+        halo : int, optional
+            The overlap of the tiles on every side, by default 16. It must
+            not be smaller than the radius of the neighbourhood stages.
+        tile_size : int | None, optional
+            The side of the cores of the tiles, by default None, which
+            is computed from the peak memory target.
+        max_bytes : int | None, optional
+            The peak memory target, by default None, which is the
+            'tile_memory_mb' of the 'pipeline' section of config.toml.
+        copies : int, optional
+            The estimated number of the arrays of the size of a tile that a
+            running tile holds, by default 4.
+        workers : int, optional
+            The number of tiles that run in parallel, by default 1.
+        """
+        if halo < 0:
+            raise ValueError(f"The halo ({halo}) must not be negative.")
+        if max_bytes is None:
+            max_bytes = int(Config.get("pipeline", {}).get("tile_memory_mb", 512) * 2**20)
+        self.pipeline = pipeline
+        self.halo = halo
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.copies = copies
+        self.workers = max(workers, 1)
+        contract = pipeline.contract
+        self.outputs = tuple(contract.outputs) if contract.outputs is not None else None
+        self.pure = getattr(pipeline, "pure", True)
+        # Like a pipeline, it returns the whole payload
+        self._contract = Contract(requires=contract.requires | {"image"},
+                                  outputs=self.outputs,
+                                  forwards=True)
+
+    @property
+    def contract(self) -> Contract:
+        return self._contract
+
+    def tile_size_for(self, image: ndarray) -> int:
+        """The side of the cores of the tiles of an image (see the notes of the module)."""
+        if self.tile_size is not None:
+            return max(self.tile_size, 1)
+        # The stitched result (estimated as large as the image) is alive all along
+        budget = self.max_bytes - image.nbytes
+        pixel_bytes = image.itemsize * (image.shape[2] if image.ndim == 3 else 1)
+        tile_pixels = budget / (self.workers * self.copies * pixel_bytes)
+        side = int(math.sqrt(max(tile_pixels, 0))) - 2 * self.halo
+        return max(side, MIN_TILE_SIZE)
+
+    def tiles(self, image: ndarray) -> list[Tile]:
+        return split(image.shape, self.tile_size_for(image), self.halo)
+
+    def _run_tiles(self, tiles: list[Tile], image: ndarray,
+                   kwargs: Mapping[str, Any]) -> Iterator[tuple[Tile, Mapping[str, Any]]]:
+        def run(tile: Tile) -> tuple[Tile, Mapping[str, Any]]:
+            return tile, self.pipeline(**{**kwargs, "image": tile.of(image)})
+
+        tiles = cancellable(tiles, every=1)
+        if self.workers == 1:
+            yield from map(run, tiles)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix="beenoculars-tile") as pool:
+            # The context (e.g. a cancellation token) goes with the tiles.
+            yield from stream(lambda tile: pool.submit(contextvars.copy_context().run, run, tile),
+                              tiles,
+                              max_inflight=self.workers)
+
+    def __call__(self, *, image: ndarray, **kwargs) -> Dict:
+        tiles = self.tiles(image)
+        if len(tiles) == 1:
+            return Payload(self.pipeline(image=image, **kwargs))
+        height, width = image.shape[:2]
+        stitched: dict[str, ndarray] = {}
+        first: Mapping[str, Any] | None = None
+        inside: list[ndarray] = []
+        pieces: list[_Piece] = []
+        mode = kwargs.get("contours_mode", cv.RETR_TREE)
+        with_holes = False
+        # Whether the contours in the crossing ones are known by their trees
+        nested = mode == cv.RETR_TREE
+        for tile, ret in self._run_tiles(tiles, image, kwargs):
+            if first is None:
+                first = ret
+            shape = (tile.rows[1] - tile.rows[0], tile.cols[1] - tile.cols[0])
+            for name, value in ret.items():
+                if not isinstance(value, ndarray) or value.shape[:2] != shape:
+                    continue
+                if name not in stitched:
+                    stitched[name] = self._output((height, width) + value.shape[2:],
+                                                  value.dtype)
+                tile.of(stitched[name])[tile.core] = value[tile.core]
+            if "contours" in ret:
+                # Only the trees tell the holes from the objects
+                hierarchy = ret.get("hierarchy") if mode in (cv.RETR_TREE, cv.RETR_CCOMP) else None
+                with_holes = with_holes or hierarchy is not None
+                nested = nested and (hierarchy is not None or len(ret["contours"]) == 0)
+                self._split_contours(tile, (height, width), ret["contours"], hierarchy,
+                                     inside, pieces)
+        # The contours have been found on the stitched (black and white) image
+        source = stitched.get("image")
+        if source is not None and source.ndim != 2:
+            source = None
+        # The source cuts the holes out of the painted objects
+        with_holes = with_holes or (source is not None and mode != cv.RETR_EXTERNAL)
+        method = kwargs.get("contours_method", cv.CHAIN_APPROX_SIMPLE)
+        merged = [c for group in _groups(pieces)
+                  for c in _merge(group, with_holes, source, method)]
+        if mode == cv.RETR_EXTERNAL:
+            inside = _outside(inside, merged)
+        elif with_holes and not nested:
+            # The contours in the crossing ones may have been found again
+            inside = _not_merged(inside, merged)
+        joined = Payload(first)  # type: ignore
+        joined.update(stitched)
+        if "contours" in joined:
+            joined["contours"] = as_contours(inside + merged)
+            if "hierarchy" in joined:
+                joined["hierarchy"] = None
+        return joined
+
+    @staticmethod
+    def _output(shape: tuple[int, ...], dtype) -> ndarray:
+        array = out_buffer(shape, dtype)
+        return np.empty(shape, dtype) if array is None else array
+
+    def _split_contours(self,
+                        tile: Tile,
+                        shape: tuple[int, int],
+                        contours,
+                        hierarchy: ndarray | None,
+                        inside: list[ndarray],
+                        pieces: list[_Piece]) -> None:
+        """Keep the contours inside the core of the tile and collect the crossing ones.
+
+           The contours inside a crossing one (its holes and the objects in them)
+           are collected with it, since they are found again when it is merged.
+        """
+        rows, cols = tile.core
+        core = (cols.start, rows.start, cols.stop, rows.stop)
+        # A contour is complete if it does not touch the edges of the tile
+        # that are inside the image, too (e.g. when the halo is 0).
+        height, width = tile.rows[1] - tile.rows[0], tile.cols[1] - tile.cols[0]
+        edges = (0 if tile.cols[0] > 0 else -1,
+                 0 if tile.rows[0] > 0 else -1,
+                 width if tile.cols[1] < shape[1] else width + 1,
+                 height if tile.rows[1] < shape[0] else height + 1)
+        offset = np.array([tile.cols[0], tile.rows[0]], dtype=np.int32)
+        image_core = (tile.core_cols[0], tile.core_rows[0], tile.core_cols[1], tile.core_rows[1])
+        count = len(contours)
+        parents = (hierarchy.reshape(-1, 4)[:, 3] if hierarchy is not None
+                   else np.full(count, -1))
+        depths = _depths(parents)
+        boxes = [cv.boundingRect(contour) for contour in contours]
+        crossing = np.zeros(count, dtype=bool)
+        # The parents first, so the crossing ones are inherited
+        for i in np.argsort(depths, kind="stable"):
+            x, y, w, h = boxes[i]
+            crossing[i] = ((parents[i] >= 0 and crossing[parents[i]]) or
+                           not (x >= core[0] and y >= core[1] and
+                                x + w <= core[2] and y + h <= core[3] and
+                                x > edges[0] and y > edges[1] and
+                                x + w < edges[2] and y + h < edges[3]))
+        for contour, (x, y, w, h), depth, cross in zip(contours, boxes, depths, crossing):
+            if x >= core[2] or y >= core[3] or x + w <= core[0] or y + h <= core[1]:
+                # It is in the core of another tile
+                continue
+            if not cross:
+                inside.append(contour + offset)
+            else:
+                pieces.append(_Piece(contour + offset, int(depth),
+                                     (x + int(offset[0]), y + int(offset[1]),
+                                      x + w + int(offset[0]), y + h + int(offset[1])),
+                                     image_core))
+
+    def __repr__(self) -> str:
+        return (f"TiledPipeline(halo={self.halo}, tile_size={self.tile_size}, "
+                f"workers={self.workers})")
@@ -7,6 +7,7 @@ from PIL import Image as PILImage
 
 from beenoculars.config import Dict
 from beenoculars.core import Process, safe_call
+from beenoculars.core.buffers import borrowed, out_buffer
 
 # logger
 log = logging.getLogger(__name__)
@@ -45,6 +46,10 @@ def to_texture(frame, flip_x=False, flip_y=False):
 
 
 class ToOpenCVImageProcess(Process):
+    outputs = ("image",)
+    # It uses the GUI objects
+    main_thread = True
+
     @safe_call(log)
     def __call__(self, image: Texture, **kwargs) -> Dict:
         """Converts a given toga Image to a numpy array (opencv) Image.
@@ -65,11 +70,16 @@ class ToOpenCVImageProcess(Process):
 
         # image = PILImage.open(io.BytesIO(image.pixels))
         image = asarray(image, dtype='uint8')
-        image = cv.cvtColor(image, cv.COLOR_RGB2BGR)
+        image = cv.cvtColor(image, cv.COLOR_RGB2BGR,
+                            dst=out_buffer((*image.shape[:2], 3), image.dtype))
         return Dict(image=image)
 
 
 class ToKivyImageProcess(Process):
+    outputs = ("image",)
+    # It uses the GUI objects
+    main_thread = True
+
     def __call__(self,
                  image: ndarray,
                  flip_x=False,
@@ -91,5 +101,7 @@ class ToKivyImageProcess(Process):
         kivy.graphics.texture.Texture
             The resulting kivy Image.
         """
-        image = cv.cvtColor(image, cv.COLOR_BGR2RGB)
-        return Dict(image=to_texture(image, flip_x, flip_y))
+        # The texture copies the bytes of the RGB image.
+        with borrowed(image.shape, image.dtype) as rgb:
+            cv.cvtColor(image, cv.COLOR_BGR2RGB, dst=rgb)
+            return Dict(image=to_texture(rgb, flip_x, flip_y))
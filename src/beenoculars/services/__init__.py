@@ -1 +1,5 @@
-from .images import OverlayContoursService  # noqa
+from .images import (  # noqa
+    AsyncOverlayContoursService,
+    AsyncOverlayPreviewService,
+    OverlayContoursService,
+)
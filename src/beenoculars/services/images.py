@@ -1,17 +1,73 @@
+import asyncio
 import logging
-from typing import Any
+from typing import Any, Awaitable, Callable
+
+import numpy as np
 
 import beenoculars.core as core
 import beenoculars.image_processing as imp
-from beenoculars.config import Dict
-from beenoculars.core import ServiceCallback, processFactory, processLogicProperty
-from beenoculars.core.__image_services__ import SyncImageService
+from beenoculars.config import Config, Dict
+from beenoculars.core import Payload, ServiceCallback, processFactory, processLogicProperty
+from beenoculars.core.__image_services__ import AsyncImageService, SyncImageService
 from beenoculars.image_processing.edge_detections import triple_choice_background
+from beenoculars.image_processing.pyramid import rescale_percentages, small_fraction
 
 log = logging.getLogger(__name__)
 
 
-class OverlayContoursService(SyncImageService):
+class OverlayContoursLogic:
+    """The pipelines of the overlay services, which are shared by the
+       sync and async services (the 'toFramework' comes from the service).
+    """
+    # The layouts bind a new service to each control, so the memo
+    # is shared by all of them: changing a control only re-runs the
+    # stages that depend on it (see beenoculars.core.memo).
+    memo = core.StageMemo()
+    # The thresholds and contours of the recent images, by their content,
+    # so flipping back to a threshold does not find the contours again.
+    cache = core.ResultCache()
+    cachedBlackWhite = imp.ToBlackWhite.cached(cache)
+    cachedContours = imp.ToContours.cached(cache)
+    # The analysis (contours and areas) by the image and the threshold,
+    # which is also persisted in the app data folder (see
+    # 'open_analysis_cache'), so reopening an image is instant. The masks
+    # of the percentages are cheap, so they are not persisted.
+    # No stage reads the 'hierarchy', so the contours are not linked
+    # into a tree (see beenoculars.core.plans).
+    analysis_cache = core.ResultCache()
+    analysis_outputs = ("contours", "areas")
+    analysis_pipeline = (cachedBlackWhite >>
+                         cachedContours >>
+                         imp.ToConvexHullContours >>
+                         imp.ToContourAreas)
+    analysis_pipeline.compile(outputs=analysis_outputs)
+    analysis = core.CachedProcess(
+        analysis_pipeline,
+        analysis_cache,
+        namespace="OverlayContoursService.analysis.v4",
+        reads=("image", "threshold", "contours_mode", "contours_method"),
+        outputs=analysis_outputs)
+    # The analysis of the previews of the sliders, only in memory: they
+    # are many and small, and must not evict the full resolution ones.
+    preview_analysis = core.CachedProcess(
+        analysis_pipeline,
+        cache,
+        namespace="OverlayContoursService.preview_analysis",
+        reads=("image", "threshold", "contours_mode", "contours_method"),
+        outputs=analysis_outputs)
+    # The objects of the black and white images, for the 'components'
+    # counting: they are cheap to mask again, so they are kept in memory.
+    cachedComponents = imp.ToComponents.cached(cache)
+    # The levels of the pyramids of the recent images, for the previews
+    # (see beenoculars.image_processing.pyramid).
+    cachedPyramidLevel = imp.ToPyramidLevel.cached(cache)
+
+    # The results that the layouts read, the pipelines are pruned for them
+    # (e.g. the 'hierarchy' is not built). The 'areas' rescale the
+    # percentages of the previews.
+    results = ("image", "masks", "areas")
+    # The input image and the areas of the last full resolution run
+    full_areas: tuple[Any, np.ndarray] | None = None
 
     #########################################################
     # Define te pipelines logic
@@ -20,29 +76,58 @@ class OverlayContoursService(SyncImageService):
     # of the pipeline based on the parameters, it impliment
     # the process method of the pipeline
 
-    @processLogicProperty
+    @processLogicProperty(outputs=("contours",))
     def contoursMasksPipeline(self,
-                              contours,
+                              contours: core.RaggedArray,
                               masks,
-                              **kwargs) -> Dict:
-        selected_contours = tuple(
-            c for c, mask in zip(contours, masks) if mask)
-        return Dict(contours=selected_contours)
+                              **kwargs) -> Payload:
+        # The selection shares the points of the contours
+        return Payload(contours=contours[np.asarray(masks, dtype=bool)])
+
+    @processLogicProperty(outputs=("percentages",))
+    def previewPercentagesPipeline(self,
+                                   percentages,
+                                   preview_level: int = 0,
+                                   full_areas=None,
+                                   **kwargs) -> Payload:
+        # The percentiles of the objects that the preview sees
+        fraction = 0.0 if full_areas is None else small_fraction(full_areas, preview_level)
+        return Payload(percentages=rescale_percentages(percentages, fraction))
 
     # An example of processFactory: it creates a pipline based on the
     # parameters
     @processFactory(cache=True)
-    def createPipeline(self, is_gray: bool, is_bw: bool, has_contour: bool):
+    def createPipeline(self, is_gray: bool, is_bw: bool, has_contour: bool,
+                       counting: str = "contours", preview: bool = False):
         pl_background = triple_choice_background(is_gray, is_bw)
         if not has_contour:
-            return pl_background >> self.toFramework
-
-        pl_counters = (imp.ToBlackWhite >>
-                       imp.ToContours >>
-                       imp.ToConvexHullContours >>
-                       imp.MaskContoursByArea >>
-                       self.contoursMasksPipeline
-                       )
+            pipeline = (pl_background >> self.toFramework).memoize(self.memo)
+            pipeline.compile(outputs=self.results)
+            return pipeline
+
+        if counting == "components":
+            # The areas and the counts of the objects without their
+            # contours, see beenoculars.image_processing.edge_detections
+            pl_components = (self.cachedBlackWhite >>
+                             self.cachedComponents >>
+                             imp.MaskComponentsByArea)
+            pipeline = (pl_background >>
+                        (pl_components * imp.PassThrough) >>
+                        imp.OverlayComponentsOn >>
+                        self.toFramework)
+            pipeline.memoize(self.memo).compile(outputs=self.results)
+            return pipeline
+
+        pl_counters = self.analysis >> imp.MaskByArea >> self.contoursMasksPipeline
+        if preview:
+            # The contours of a level of the pyramid of the image, drawn on
+            # the image (see beenoculars.image_processing.pyramid)
+            pl_counters = (self.cachedPyramidLevel >>
+                           self.previewPercentagesPipeline >>
+                           self.preview_analysis >>
+                           imp.MaskByArea >>
+                           self.contoursMasksPipeline >>
+                           imp.UpscaleContours)
         ####################################################################
         #                      pl_counters
         #                  /                \(counters)
@@ -55,8 +140,82 @@ class OverlayContoursService(SyncImageService):
                    imp.OverlayContoursOn >>
                    self.toFramework)
 
+        pipline.memoize(self.memo).compile(outputs=self.results)
         return pipline
 
+    @staticmethod
+    def remember_areas(input_image, results: Dict) -> None:
+        """Keep the areas of a full resolution run, for the previews of its image."""
+        # Shared by the services, so it is only set on this class
+        if results.get("areas") is not None:
+            OverlayContoursLogic.full_areas = (input_image, results.areas)
+
+    @classmethod
+    def areas_of(cls, input_image) -> np.ndarray | None:
+        """The areas of the last full resolution run of the image, if any."""
+        if cls.full_areas is not None and cls.full_areas[0] is input_image:
+            return cls.full_areas[1]
+        return None
+
+    @classmethod
+    def open_analysis_cache(cls, app: core.AbstractApp | None) -> None:
+        """Persist the analysis cache in the data folder of the app."""
+        if cls.analysis_cache.store is None and app is not None:
+            cls.analysis_cache.store = core.DiskResultCache(
+                app.data_path / "analysis_cache")
+
+    def parametrise(self,
+                    app: core.AbstractApp | None,
+                    input_image,
+                    threshold: int = 127,
+                    percentages=(40, 100),
+                    contours_thickness=5,
+                    is_gray=False,
+                    is_bw=False,
+                    has_contour=False,
+                    counting="contours",
+                    preview=False,
+                    ) -> tuple[core.ImageProcessingPipeline, Dict] | None:
+        """Create the pipeline and its payload for the user's settings.
+
+           'counting' is "contours" or "components" (faster, when only the
+           areas and the counts are needed, see 'overlay_pipeline').
+           'preview' finds the contours on a downscaled image (see
+           AsyncOverlayPreviewService).
+
+        Returns
+        -------
+        tuple[ImageProcessingPipeline, Dict] | None
+            The pipeline and its payload, or None when there is no image.
+        """
+        #########################################################
+        # Parametrise the pipelines
+        #########################################################
+        pipeline = self.createPipeline(is_gray=is_gray,
+                                       is_bw=is_bw,
+                                       has_contour=has_contour,
+                                       counting=counting,
+                                       preview=preview)
+        # If there is no image, do nothing
+        if input_image is None:
+            return None
+        self.open_analysis_cache(app)
+        #########################################################
+        # Initilise the pipline based on user's settings
+        init_params = Dict(image=input_image,
+                           threshold=threshold,
+                           has_contour=has_contour,
+                           percentages=percentages,
+                           contours_thickness=contours_thickness,
+                           contours_color=(0, 0, 255),)
+        if preview:
+            init_params.full_areas = self.areas_of(input_image)
+        return pipeline, init_params
+
+
+class OverlayContoursService(OverlayContoursLogic, SyncImageService):
+    """Runs the overlay pipeline on the thread of the event."""
+
     counter = 0
 
     @core.safe_call(log)
@@ -71,32 +230,155 @@ class OverlayContoursService(SyncImageService):
                      is_gray=False,
                      is_bw=False,
                      has_contour=False,
+                     counting="contours",
                      *args,
                      **kwargs):
-        #########################################################
-        # Parametrise the pipelines
-        #########################################################
-        pipeline = self.createPipeline(is_gray=is_gray,
-                                       is_bw=is_bw,
-                                       has_contour=has_contour)
+        parametrised = self.parametrise(app, input_image, threshold, percentages,
+                                        contours_thickness, is_gray, is_bw, has_contour,
+                                        counting)
+        if parametrised is None:
+            return
+        pipeline, init_params = parametrised
         #########################################################
         # Run the pipeline
+        results = pipeline(**init_params)
+        self.remember_areas(input_image, results)
         #########################################################
-        # If there is no image, do nothing
-        if input_image is None:
+        # If the contours are searched, call the callback
+        if service_callback is not None:
+            service_callback(results)
+
+
+class AsyncOverlayContoursService(OverlayContoursLogic, AsyncImageService):
+    """Runs the overlay pipeline off the event loop, so the UI stays responsive.
+
+       The result is passed to the 'service_callback' on the thread of the loop.
+    """
+    # The layouts bind a new service to each control, but they all show the
+    # same image, so they share the scheduler: while a run is in flight, only
+    # the latest event runs after it and the ones in between are dropped.
+    scheduler = core.LatestWinsScheduler()
+    # The full resolution run after the previews of the sliders (see
+    # AsyncOverlayPreviewService), which a newer event replaces. It is
+    # shared by the services, so it is only set on this class.
+    _full: Callable[[], Awaitable] | None = None
+    _idle: asyncio.TimerHandle | None = None
+    _task: asyncio.Future | None = None
+
+    @core.safe_async_call(log)
+    async def handle_event(self,
+                           widget: Any,
+                           app: core.AbstractApp,
+                           service_callback: ServiceCallback | None,
+                           input_image,
+                           threshold: int = 127,
+                           percentages=(40, 100),
+                           contours_thickness=5,
+                           is_gray=False,
+                           is_bw=False,
+                           has_contour=False,
+                           counting="contours",
+                           *args,
+                           **kwargs):
+        self.cancel_full()
+        await self.overlay(widget, app, service_callback, input_image, threshold,
+                           percentages, contours_thickness, is_gray, is_bw, has_contour,
+                           counting)
+
+    @core.safe_async_call(log)
+    async def overlay(self,
+                      widget: Any,
+                      app: core.AbstractApp,
+                      service_callback: ServiceCallback | None,
+                      input_image,
+                      threshold: int = 127,
+                      percentages=(40, 100),
+                      contours_thickness=5,
+                      is_gray=False,
+                      is_bw=False,
+                      has_contour=False,
+                      counting="contours",
+                      preview=False):
+        parametrised = self.parametrise(app, input_image, threshold, percentages,
+                                        contours_thickness, is_gray, is_bw, has_contour,
+                                        counting, preview)
+        if parametrised is None:
             return
-        #########################################################
-        # Initilise the pipline based on user's settings
-        init_params = Dict(image=input_image,
-                           threshold=threshold,
-                           has_contour=has_contour,
-                           percentages=percentages,
-                           contours_thickness=contours_thickness,
-                           contours_color=(0, 0, 255),)
+        pipeline, init_params = parametrised
         #########################################################
         # Run the pipeline
-        results = pipeline(**init_params)
+        results = await self.scheduler.submit(
+            lambda: pipeline.aprocess(**init_params))
+        if results is None:
+            # Replaced by a newer event
+            log.debug(f"{self.scheduler}")
+            return
+        if not preview:
+            self.remember_areas(input_image, results)
         #########################################################
         # If the contours are searched, call the callback
         if service_callback is not None:
             service_callback(results)
+
+    @staticmethod
+    def schedule_full(run: Callable[[], Awaitable]) -> None:
+        """Replace the pending full resolution run, which starts when the sliders rest."""
+        base = AsyncOverlayContoursService
+        base.cancel_full()
+        base._full = run
+        delay = Config.get("pipeline", {}).get("preview_idle_ms", 300) / 1000
+        base._idle = asyncio.get_running_loop().call_later(delay, base.release)
+
+    @staticmethod
+    def cancel_full() -> None:
+        """Drop the pending full resolution run, if any."""
+        base = AsyncOverlayContoursService
+        if base._idle is not None:
+            base._idle.cancel()
+        base._idle = None
+        base._full = None
+
+    @staticmethod
+    def release(*args, **kwargs) -> None:
+        """Start the pending full resolution run now (e.g. the 'on_release' of a slider)."""
+        base = AsyncOverlayContoursService
+        run = base._full
+        base.cancel_full()
+        if run is not None:
+            # Kept, since the loop only keeps a weak reference to its tasks
+            base._task = asyncio.ensure_future(run())
+
+
+class AsyncOverlayPreviewService(AsyncOverlayContoursService):
+    """Runs the overlay on a preview while a slider is dragged (ON_CHANGE).
+
+       The contours are found on a downscaled copy of the image (see
+       beenoculars.image_processing.pyramid) and the full resolution run
+       starts when the sliders rest for 'preview_idle_ms' (the 'pipeline'
+       section of config.toml), or at once on 'release'. Without the
+       contours, or with the "components" counting, which are fast enough,
+       it runs at full resolution at once.
+    """
+
+    @core.safe_async_call(log)
+    async def handle_event(self,
+                           widget: Any,
+                           app: core.AbstractApp,
+                           service_callback: ServiceCallback | None,
+                           input_image,
+                           threshold: int = 127,
+                           percentages=(40, 100),
+                           contours_thickness=5,
+                           is_gray=False,
+                           is_bw=False,
+                           has_contour=False,
+                           counting="contours",
+                           *args,
+                           **kwargs):
+        arguments = (widget, app, service_callback, input_image, threshold, percentages,
+                     contours_thickness, is_gray, is_bw, has_contour, counting)
+        if not has_contour or counting != "contours":
+            await super().handle_event(*arguments)
+            return
+        self.schedule_full(lambda: self.overlay(*arguments))
+        await self.overlay(*arguments, preview=True)
@@ -8,9 +8,14 @@ from PIL import Image as PILImage
 
 from beenoculars.config import Dict
 from beenoculars.core import Process
+from beenoculars.core.buffers import out_buffer
 
 
 class ToOpenCVImageProcess(Process):
+    outputs = ("image",)
+    # It uses the GUI objects
+    main_thread = True
+
     def __call__(self, *, image: toga.Image, **kwargs) -> Dict:
         """Converts a given toga Image to a numpy array (opencv) Image.
 
@@ -26,11 +31,16 @@ class ToOpenCVImageProcess(Process):
         """
         cv_image = PILImage.open(io.BytesIO(image.data))
         cv_image = asarray(cv_image, dtype='uint8')
-        cv_image = cv.cvtColor(cv_image, cv.COLOR_RGB2BGR)
+        cv_image = cv.cvtColor(cv_image, cv.COLOR_RGB2BGR,
+                               dst=out_buffer((*cv_image.shape[:2], 3), cv_image.dtype))
         return Dict(image=cv_image)
 
 
 class ToTogaImageProcess(Process):
+    outputs = ("image",)
+    # It uses the GUI objects
+    main_thread = True
+
     def __call__(self, *, image: ndarray, **kwargs) -> Dict:
         """Converts a given numpy array (opencv) to a toga Image.
 
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 import numpy as np
@@ -8,7 +9,8 @@ from toga.style.pack import CENTER, COLUMN, ROW  # type: ignore
 import beenoculars.core as core
 from beenoculars.config import Config, Dict
 from beenoculars.core import Event, EventType, ServiceRegistry, silence_crossed_events
-from beenoculars.services import OverlayContoursService as OverlayContours
+from beenoculars.services import AsyncOverlayContoursService as OverlayContours
+from beenoculars.services import AsyncOverlayPreviewService as OverlayPreview
 from beenoculars.toga import (
     TogaComponent,
     TogaLayout,
@@ -352,19 +354,25 @@ class OverlayComponent(TogaComponent):
                       service=OverlayContours(),
                       service_callback=self.contour_callback,
                       extra_kwargs=args_dict)
+        # The sliders show the previews while they are dragged and the full
+        # resolution when they are released (or rest)
+        for slider in (self.slider_threshold_level,
+                       self.slider_percentage_level_1,
+                       self.slider_percentage_level_2):
+            slider.on_release = OverlayPreview.release
         registry.bind(id="change_overlay_threshold",
-                      eventType=EventType.ON_RELEASE,
-                      service=OverlayContours(),
+                      eventType=EventType.ON_CHANGE,
+                      service=OverlayPreview(),
                       service_callback=self.contour_callback,
                       extra_kwargs=args_dict)
         registry.bind(id="change_overlay_percentage_1",
-                      eventType=EventType.ON_RELEASE,
-                      service=OverlayContours(),
+                      eventType=EventType.ON_CHANGE,
+                      service=OverlayPreview(),
                       service_callback=self.contour_callback,
                       extra_kwargs=args_dict)
         registry.bind(id="change_overlay_percentage_2",
-                      eventType=EventType.ON_RELEASE,
-                      service=OverlayContours(),
+                      eventType=EventType.ON_CHANGE,
+                      service=OverlayPreview(),
                       service_callback=self.contour_callback,
                       extra_kwargs=args_dict)
         registry.bind(id="change_line_thickness",
@@ -398,6 +406,8 @@ class TopToolbarLayout(TogaStackedLayout):
                          OverlayComponent,
                          ImageViewComponent)
         self._original_image = None
+        # The running overlay tasks, so they are not garbage collected
+        self._tasks: set[asyncio.Future] = set()
 
     @property
     def original_image(self):
@@ -425,8 +435,11 @@ class TopToolbarLayout(TogaStackedLayout):
     def image_loaded(self, toga_image):
         self.original_image = toga_image.image
         registry = ServiceRegistry()
-        registry.fire_event("draw_contours",
-                            self.ml_app)
+        # The overlay service is async, so it runs as a task of the loop.
+        task = asyncio.ensure_future(registry.fire_async_event("draw_contours",
+                                                               self.ml_app))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
 
 class LogViewLayout(TogaLayout):
@@ -0,0 +1,131 @@
+"""Benchmark of the two countings of the overlay: contours vs. connected components.
+
+   Notes:
+   ------
+       1- The "contours" counting finds the contours of the black and white
+          image ('--mode', their tree is not built since the pipeline is
+          compiled for the areas and the masks), their convex hulls and their
+          areas. The "components" counting labels the objects with their
+          areas (in pixels), centroids and boxes in one OpenCV call.
+
+       2- The images are of the size of the photos of a phone (12 MP) by
+          default: synthetic scenes, or the given photo. The "cells" are
+          sparse blurred discs, some of them touching; the "comb" is a noisy
+          honeycomb with tens of thousands of cells, whose contours are many
+          and ragged, as in the photos of the frames.
+
+   Usage (from the 'src' folder):
+       python -m benchmarks.bench_counting
+       python -m benchmarks.bench_counting --image comb.jpg --repeat 10
+       python -m benchmarks.bench_counting --mode external
+"""
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+import cv2 as cv
+import numpy as np
+
+import beenoculars.image_processing as imp
+
+
+# The retrieval modes of the contours
+MODES = {"tree": cv.RETR_TREE,
+         "ccomp": cv.RETR_CCOMP,
+         "list": cv.RETR_LIST,
+         "external": cv.RETR_EXTERNAL}
+
+
+def synthetic_cells(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """A BGR image of bright cells on a dark background."""
+    rng = np.random.default_rng(seed)
+    image = np.zeros((height, width), dtype=np.uint8)
+    count = width * height // 1500
+    centers = rng.integers(0, (width, height), size=(count, 2))
+    radii = rng.integers(6, 18, size=count)
+    for (x, y), r in zip(centers.tolist(), radii.tolist()):
+        cv.circle(image, (x, y), r, 200, -1)
+    image = cv.GaussianBlur(image, (5, 5), 0)
+    noise = rng.normal(0, 12, size=image.shape)
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+    return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+
+
+def synthetic_comb(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """A BGR image of a honeycomb: bright cells and dark walls, with noise."""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width), 190, dtype=np.uint8)
+    # The hexagonal cells, 'pitch' pixels apart
+    pitch = 30
+    angles = np.deg2rad(np.arange(30, 390, 60))
+    hexagon = np.stack([np.cos(angles), np.sin(angles)], axis=1) * pitch / np.sqrt(3)
+    walls = []
+    for row, y in enumerate(np.arange(0, height + pitch, pitch * np.sqrt(3) / 2)):
+        for x in np.arange((row % 2) * pitch / 2, width + pitch, pitch):
+            walls.append((hexagon + (x, y)).astype(np.int32))
+    cv.polylines(image, walls, isClosed=True, color=40, thickness=3)
+    noise = rng.normal(0, 25, size=image.shape)
+    image = np.clip(cv.GaussianBlur(image, (3, 3), 0) + noise, 0, 255).astype(np.uint8)
+    return cv.cvtColor(image, cv.COLOR_GRAY2BGR)
+
+
+def _time(pipeline, payload: dict, repeat: int) -> tuple[list[float], dict]:
+    result = pipeline(**payload)  # warm up (and compile)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = pipeline(**payload)
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", help="a photo, instead of the synthetic scenes")
+    parser.add_argument("--scene", choices=("cells", "comb"), default="comb")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--threshold", type=int, default=127)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mode", choices=tuple(MODES), default="tree",
+                        help="the retrieval mode of the contours")
+    args = parser.parse_args()
+
+    if args.image is not None:
+        image = cv.imread(args.image)
+        if image is None:
+            raise SystemExit(f"Cannot read '{args.image}'.")
+    elif args.scene == "cells":
+        image = synthetic_cells(args.width, args.height)
+    else:
+        image = synthetic_comb(args.width, args.height)
+    payload = dict(image=image, threshold=args.threshold, percentages=(40, 100),
+                   contours_mode=MODES[args.mode])
+
+    contours = (imp.ToBlackWhite >>
+                imp.ToContours >>
+                imp.ToConvexHullContours >>
+                imp.MaskContoursByArea)
+    components = (imp.ToBlackWhite >>
+                  imp.ToComponents >>
+                  imp.MaskComponentsByArea)
+    contours.compile(outputs=("areas", "masks"))
+    components.compile(outputs=("areas", "masks"))
+
+    height, width = image.shape[:2]
+    print(f"image {width}x{height} ({width * height / 1e6:.1f} MP), "
+          f"{args.repeat} runs")
+    print(f"{'counting':<12} {'median ms':>10} {'min ms':>10} {'objects':>8} {'counted':>8}")
+    medians = {}
+    for name, pipeline in (("contours", contours), ("components", components)):
+        times, result = _time(pipeline, payload, args.repeat)
+        medians[name] = statistics.median(times)
+        print(f"{name:<12} {medians[name] * 1e3:>10.1f} {min(times) * 1e3:>10.1f} "
+              f"{len(result.areas):>8} {int(np.sum(result.masks)):>8}")
+    print(f"speed-up: {medians['contours'] / medians['components']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+import beenoculars.image_processing as imp
+from beenoculars.core import BufferPool, Process, RaggedArray, ResultCache, StageMemo, register_rewrite
+from beenoculars.core.pipelines import ProcessPassThrough
+from beenoculars.core.runners import ProcessPoolRunner
+from beenoculars.image_processing.contour_stats import contour_statistics
+from beenoculars.image_processing.pyramid import preview_level_of, rescale_percentages, small_fraction
+
+rng = np.random.default_rng(0)
+COLOR_IMAGE = rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)
+GRAY_IMAGE = rng.integers(0, 256, (48, 64), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("processes, image, fused", [
+    ((imp.ToGray, imp.ToColor, imp.ToBlackWhite), COLOR_IMAGE, 1),
+    ((imp.ToGray, imp.ToBlackWhite), COLOR_IMAGE, 1),
+    ((imp.ToGray, imp.ToGray), COLOR_IMAGE, 1),
+    ((imp.ToColor, imp.ToGray), GRAY_IMAGE, 0),
+    ((imp.ToColor, imp.ToBlackWhite), GRAY_IMAGE, 1),
+    # The fusions are repeated: ToColor >> ToGray goes first.
+    ((imp.ToGray, imp.ToColor, imp.ToGray, imp.ToBlackWhite), COLOR_IMAGE, 1),
+])
+def test_fused_colour_conversions(processes, image, fused):
+    pipeline = processes[0] >> processes[1]
+    for process in processes[2:]:
+        pipeline = pipeline >> process
+    # The interpreted pipeline runs every conversion
+    expected = pipeline(image=image, threshold=100)
+    plan = pipeline.compile()
+    assert len(plan) == fused
+    result = pipeline(image=image, threshold=100)
+    np.testing.assert_array_equal(result.image, expected.image)
+
+
+def test_fused_inside_a_fork_branch():
+    pipeline = imp.ToGray >> ((imp.ToColor >> imp.ToBlackWhite) * imp.PassThrough / {
+        0: [("image", "bw")]})
+    expected = pipeline(image=COLOR_IMAGE)
+    assert "ToColorProcess" not in repr(pipeline.compile())
+    result = pipeline(image=COLOR_IMAGE)
+    np.testing.assert_array_equal(result.bw, expected.bw)
+    np.testing.assert_array_equal(result.image, expected.image)
+
+
+def test_gray_images_are_not_converted_again():
+    gray = imp.ToGray(image=COLOR_IMAGE).image
+    assert imp.ToGray(image=gray).image is gray
+    np.testing.assert_array_equal(imp.ToBlackWhite(image=gray, threshold=100).image,
+                                  imp.ToBlackWhite(image=COLOR_IMAGE, threshold=100).image)
+
+
+def test_rewrite_must_be_shorter():
+    class NoOpProcess(Process):
+        def __call__(self, **kwargs):
+            return {}
+
+    with pytest.raises(ValueError):
+        register_rewrite((NoOpProcess(),), (NoOpProcess(),))
+
+
+def test_buffer_pool_recycles_dead_arrays():
+    pool = BufferPool()
+    pipeline = (imp.ToGray >> imp.ToColor >> imp.ToGray >> imp.ToColor).use_buffers(pool)
+    images = [rng.integers(0, 256, (48, 64, 3), dtype=np.uint8) for _ in range(4)]
+    results = [pipeline(image=image).image for image in images]
+    # The intermediate arrays are reused, the returned ones are kept by the caller
+    assert pool.hits > 0
+    assert len({id(result) for result in results}) == len(results)
+    for image, result in zip(images, results):
+        gray = imp.ToGray(image=image).image
+        np.testing.assert_array_equal(result, imp.ToColor(image=gray).image)
+
+
+def test_buffer_pool_keeps_referenced_arrays():
+    pool = BufferPool()
+    array = pool.acquire((4, 4))
+    payload = {"image": array}
+    # 'array' still references it (the asserts of pytest keep references, too)
+    released = pool.release(payload.pop("image"))
+    assert not released
+    del array
+    payload = {"image": pool.acquire((4, 4))}
+    released = pool.release(payload.pop("image"))
+    assert released
+    assert pool.acquire((4, 4)) is not None and pool.hits == 1
+    frozen = pool.acquire((4, 4))
+    frozen.flags.writeable = False
+    assert not pool.release(frozen)
+
+
+def test_copy_on_write_of_mutated_images():
+    contours = (np.array([[[5, 5]], [[5, 30]], [[30, 30]]], dtype=np.int32),)
+    image = COLOR_IMAGE.copy()
+    pipeline = imp.PassThrough >> imp.OverlayContoursOn
+    result = pipeline(image=image, contours=contours, contours_thickness=2)
+    # The image of the caller is not drawn on
+    np.testing.assert_array_equal(image, COLOR_IMAGE)
+    assert result.image.sum() != image.sum()
+    # An image that nothing else references is drawn on in-place
+    pipeline = imp.ToGray >> imp.ToColor >> imp.OverlayContoursOn
+    for compiled in (False, True):
+        if compiled:
+            pipeline.compile()
+        expected = imp.ToColor(image=imp.ToGray(image=image).image).image.copy()
+        cv.drawContours(expected, contours, -1, (0, 255, 0), 1)
+        np.testing.assert_array_equal(pipeline(image=image, contours=contours).image,
+                                      expected)
+    # A memoized image is copied before it is drawn on
+    memo = StageMemo()
+    pipeline = (imp.ToGray >> imp.ToColor >> imp.OverlayContoursOn).memoize(memo)
+    first = pipeline(image=image, contours=contours, contours_color=(255, 0, 0))
+    second = pipeline(image=image, contours=contours, contours_color=(0, 0, 255))
+    assert not np.array_equal(first.image, second.image)
+    np.testing.assert_array_equal(first.image[0, 0], second.image[0, 0])
+
+
+def test_arrays_are_read_only_in_pipelines():
+    class UndeclaredInplaceProcess(Process):
+        def __call__(self, *, image, **kwargs):
+            image[0, 0] = 0
+            return {}
+
+    pipeline = imp.ToGray >> UndeclaredInplaceProcess()
+    with pytest.raises(ValueError):
+        pipeline(image=COLOR_IMAGE)
+    with pytest.raises(ValueError):
+        pipeline.compile()
+        pipeline(image=COLOR_IMAGE)
+    assert COLOR_IMAGE.flags.writeable
+
+
+def test_pipelines_do_not_freeze_the_arrays_they_do_not_own():
+    frame = np.zeros((4, 5), dtype=np.uint8)
+
+    class ExternalFrameProcess(Process):
+        outputs = ("frame",)
+
+        def __call__(self, **kwargs):
+            # e.g. a frame that a camera reuses
+            return {"frame": frame}
+
+    image = COLOR_IMAGE.copy()
+    for compiled in (False, True):
+        pipeline = ExternalFrameProcess() >> imp.PassThrough >> imp.ToGray
+        if compiled:
+            pipeline.compile()
+        result = pipeline(image=image)
+        assert frame.flags.writeable and image.flags.writeable
+        # The caller gets the arrays themselves, writeable
+        assert result.frame is frame
+        assert result.image.flags.writeable
+    # The results of a memoized pipeline are shared with the next runs
+    pipeline = (imp.ToGray >> imp.ToBlackWhite).memoize(StageMemo())
+    result = pipeline(image=image, threshold=100)
+    assert not result.image.flags.writeable
+    assert result.image is pipeline(image=image, threshold=100).image
+    # The cached results do not share the writeable arrays of the pipeline
+    # (the gray image is passed through)
+    pipeline = imp.ToGray >> imp.ToGray.cached(ResultCache())
+    pipeline.compile()
+    for _ in range(2):
+        cached = pipeline(image=image).image
+        assert not cached.flags.writeable and cached.flags.owndata
+
+
+def test_cached_results_do_not_freeze_the_inputs():
+    gray = np.full((4, 5), 7, dtype=np.uint8)
+    cache = ResultCache()
+    first = imp.ToGray.cached(cache)(image=gray)
+    # The passed through image is copied into the cache
+    assert gray.flags.writeable
+    assert not first.image.flags.writeable and first.image is not gray
+    gray[0, 0] = 0
+    assert first.image[0, 0] == 7
+    assert imp.ToGray.cached(cache)(image=gray.copy()).image[0, 0] == 0
+
+
+class ThawingProcess(Process):
+    def __call__(self, *, image, **kwargs):
+        # It writes to its (read-only) input, without declaring it
+        image.flags.writeable = True
+        image[0, 0] = 9
+        return {"image": image}
+
+
+def test_process_pool_runner_changes_copies():
+    image = np.zeros((40, 50, 3), dtype=np.uint8)
+    contours = RaggedArray.from_arrays([np.array([[[5, 5]], [[30, 5]], [[30, 30]]],
+                                                 dtype=np.int32)])
+    expected = imp.OverlayContoursOn(image=image.copy(), contours=contours).image
+    with ProcessPoolRunner(imp.OverlayContoursOn, max_workers=1) as runner:
+        np.testing.assert_array_equal(runner.process(image=image, contours=contours).image,
+                                      expected)
+    with ProcessPoolRunner(ProcessPassThrough() >> imp.OverlayContoursOn, max_workers=1) as runner:
+        result = runner.process(image=image, contours=contours)
+    np.testing.assert_array_equal(result.image, expected)
+    # The unchanged inputs are not sent back
+    assert result.contours is contours
+    assert not image.any()
+    # The arrays that have been written to are returned, even if they are the inputs
+    with ProcessPoolRunner(ThawingProcess(), max_workers=1) as runner:
+        assert runner.process(image=image).image[0, 0, 0] == 9
+
+
+def _blobs(shape=(300, 400)) -> np.ndarray:
+    image = np.zeros((*shape, 3), dtype=np.uint8)
+    for _ in range(40):
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        radius = int(rng.integers(3, 40))
+        cv.circle(image, center, radius, (200, 200, 200), -1)
+        # A hole, with an object in it
+        cv.circle(image, center, radius // 2, (0, 0, 0), -1)
+        cv.circle(image, center, radius // 6, (200, 200, 200), -1)
+    return image
+
+
+def _contours_key(contours) -> list:
+    return sorted((cv.boundingRect(c), len(c), cv.contourArea(c)) for c in contours)
+
+
+@pytest.mark.parametrize("halo, tile_size, workers", [(0, 64, 1), (4, 50, 3), (8, 128, 2)])
+def test_tiled_pipeline_matches_whole_image(halo, tile_size, workers):
+    image = _blobs()
+    pipeline = imp.ToBlackWhite >> imp.ToContours
+    expected = pipeline(image=image, threshold=100)
+    tiled = imp.TiledPipeline(pipeline, halo=halo, tile_size=tile_size, workers=workers)
+    assert len(tiled.tiles(image)) > 4
+    result = tiled(image=image, threshold=100)
+    np.testing.assert_array_equal(result.image, expected.image)
+    # The contours that cross the tiles are merged
+    assert _contours_key(result.contours) == _contours_key(expected.contours)
+    assert result.hierarchy is None
+
+
+def test_tiled_pipeline_in_a_pipeline():
+    image = _blobs()
+    tiled = imp.TiledPipeline(imp.ToBlackWhite >> imp.ToContours, tile_size=64)
+    pipeline = tiled >> imp.ToConvexHullContours >> imp.MaskContoursByArea
+    expected = (imp.ToBlackWhite >> imp.ToContours >> imp.ToConvexHullContours >>
+                imp.MaskContoursByArea)(image=image, threshold=100)
+    pipeline.compile()
+    result = pipeline(image=image, threshold=100)
+    assert sorted(result.areas) == sorted(expected.areas)
+    # The peak memory target sets the size of the tiles
+    small = imp.TiledPipeline(imp.ToGray, halo=2, max_bytes=image.nbytes + 2**20)
+    large = imp.TiledPipeline(imp.ToGray, halo=2, max_bytes=image.nbytes + 2**24)
+    assert len(small.tiles(image)) > len(large.tiles(image)) == 1
+
+
+def test_contour_statistics_match_opencv():
+    image = _blobs()
+    # The noise makes thin, degenerate and concave contours
+    image[rng.random(image.shape[:2]) > 0.97] = 200
+    contours = (imp.ToBlackWhite >> imp.ToContours)(image=image, threshold=100).contours
+    stats = imp.ContourStatistics(contours=contours).contours_stats
+    assert len(stats) == len(contours) > 100
+    np.testing.assert_array_equal(stats["area"], [cv.contourArea(c) for c in contours])
+    np.testing.assert_allclose(stats["perimeter"], [cv.arcLength(c, True) for c in contours])
+    np.testing.assert_array_equal(
+        np.stack([stats[k] for k in ("x", "y", "width", "height")], axis=1),
+        [cv.boundingRect(c) for c in contours])
+    moments = [cv.moments(c) for c in contours]
+    solid = np.array([m["m00"] != 0 for m in moments])
+    np.testing.assert_allclose(stats["cx"][solid],
+                               [m["m10"] / m["m00"] for m in moments if m["m00"] != 0])
+    hull_areas = [cv.contourArea(cv.convexHull(c)) for c in contours]
+    np.testing.assert_array_equal(stats["hull_area"], hull_areas)
+    assert np.all(stats["solidity"] <= 1)
+    # The hulls of the convex contours are the contours themselves
+    assert isinstance(contours, RaggedArray)
+    hulls = imp.ToConvexHullContours(contours=contours).contours
+    np.testing.assert_array_equal([cv.contourArea(h) for h in hulls], hull_areas)
+    convex = stats["solidity"] == 1
+    assert np.array_equal(hulls.starts[convex], contours.starts[convex])
+    # The selected contours are drawn as the list of them
+    masks = imp.MaskContoursByArea(contours=hulls).masks
+    expected = cv.drawContours(np.zeros_like(image),
+                               [hulls[i] for i in np.flatnonzero(masks)], -1, 255)
+    drawn = imp.OverlayContoursOn(image=np.zeros_like(image), contours=hulls[masks],
+                                  contours_color=255).image
+    np.testing.assert_array_equal(drawn, expected)
+    assert len(imp.ContourStatistics(contours=()).contours_stats) == 0
+
+
+def test_components_counting():
+    image = _blobs()
+    pipeline = imp.ToBlackWhite >> imp.ToComponents >> imp.MaskComponentsByArea
+    result = pipeline(image=image, threshold=100, percentages=(40, 100))
+    bw = imp.ToBlackWhite(image=image, threshold=100).image
+    count, labels = cv.connectedComponents(bw, connectivity=8)
+    assert len(result.areas) == len(result.boxes) == count - 1
+    np.testing.assert_array_equal(np.bincount(labels.ravel())[1:], result.areas)
+    assert result.masks.sum() > 0
+    # Filled, the selected objects are drawn exactly
+    selected = np.isin(result.labels, np.flatnonzero(result.masks) + 1)
+    filled = imp.OverlayComponentsOn(image=np.zeros_like(image), labels=result.labels,
+                                     masks=result.masks, contours_thickness=-1,
+                                     contours_color=(0, 0, 255)).image
+    np.testing.assert_array_equal(filled[..., 2] > 0, selected)
+    # Outlined, only around them
+    outlined = imp.OverlayComponentsOn(image=np.zeros_like(image), labels=result.labels,
+                                       masks=result.masks, contours_color=(0, 0, 255)).image
+    around = cv.dilate(selected.astype(np.uint8), np.ones((3, 3), dtype=np.uint8)) > 0
+    drawn = outlined[..., 2] > 0
+    assert drawn.any() and not (drawn & ~around).any() and (drawn.sum() < selected.sum())
+
+
+def test_contours_modes_and_lazy_hierarchy():
+    image = _blobs()
+    pipeline = imp.ToBlackWhite >> imp.ToContours
+    tree = pipeline(image=image, threshold=100)
+    assert tree.hierarchy is not None
+    external = pipeline(image=image, threshold=100, contours_mode=cv.RETR_EXTERNAL)
+    assert 0 < len(external.contours) < len(tree.contours)
+    every_point = pipeline(image=image, threshold=100, contours_mode=cv.RETR_EXTERNAL,
+                           contours_method=cv.CHAIN_APPROX_NONE)
+    assert len(every_point.contours.values) > len(external.contours.values)
+    # Compiled for the contours only, they are listed without their tree
+    pipeline.compile(outputs=("contours",))
+    listed = pipeline(image=image, threshold=100)
+    assert "hierarchy" not in listed
+    assert _contours_key(listed.contours) == _contours_key(tree.contours)
+    listed = pipeline(image=image, threshold=100, contours_mode=cv.RETR_EXTERNAL)
+    assert _contours_key(listed.contours) == _contours_key(external.contours)
+    # The tiles find the same outer contours
+    tiled = imp.TiledPipeline(imp.ToBlackWhite >> imp.ToContours, halo=4, tile_size=50)
+    result = tiled(image=image, threshold=100, contours_mode=cv.RETR_EXTERNAL)
+    assert _contours_key(result.contours) == _contours_key(external.contours)
+
+
+@pytest.mark.parametrize("mode", [cv.RETR_LIST, cv.RETR_CCOMP])
+@pytest.mark.parametrize("halo, tile_size", [(4, 64), (4, 128), (0, 50)])
+def test_tiled_contours_without_trees(mode, halo, tile_size):
+    image = _blobs((700, 900))
+    pipeline = imp.ToBlackWhite >> imp.ToContours
+    expected = pipeline(image=image, threshold=100, contours_mode=mode)
+    tiled = imp.TiledPipeline(pipeline, halo=halo, tile_size=tile_size)
+    result = tiled(image=image, threshold=100, contours_mode=mode)
+    # The holes of the crossing objects (and the objects in them) are not duplicated
+    assert _contours_key(result.contours) == _contours_key(expected.contours)
+
+
+def test_pyramid_preview():
+    image = cv.resize(_blobs(), None, fx=4, fy=4, interpolation=cv.INTER_NEAREST)
+    assert preview_level_of(image.shape, max_pixels=image.shape[0] * image.shape[1]) == 0
+    assert preview_level_of(image.shape, max_pixels=image.shape[0] * image.shape[1] / 16) == 2
+    pipeline = (imp.ToPyramidLevel >> imp.ToBlackWhite >> imp.ToContours >>
+                imp.UpscaleContours)
+    full = (imp.ToBlackWhite >> imp.ToContours)(image=image, threshold=100)
+    preview = pipeline(image=image, threshold=100, preview_level=2)
+    assert preview.preview_level == 2
+    # The contours of the preview are in the pixels of the image
+    full_outer = contour_statistics(full.contours[full.hierarchy[0, :, 3] < 0])
+    preview_outer = contour_statistics(preview.contours[preview.hierarchy[0, :, 3] < 0])
+    assert len(preview_outer) == len(full_outer)
+    # The small objects lose the most (the contours are on the centres of the pixels)
+    np.testing.assert_allclose(preview_outer["area"].sum(), full_outer["area"].sum(), rtol=0.1)
+    # The percentiles of the seen objects
+    areas = np.array([1, 2, 8, 20, 30, 40, 50, 60, 70, 80], dtype=np.float64)
+    fraction = small_fraction(areas, 1)
+    assert fraction == 0.2
+    low, high = rescale_percentages((40, 100), fraction)
+    assert (low, high) == (25.0, 100.0)
+    assert rescale_percentages((10, 100), fraction)[0] == 0
+    assert rescale_percentages((40, 100), 0.0) == (40, 100)
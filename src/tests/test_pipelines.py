@@ -1,6 +1,18 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
 import pytest
 
-from beenoculars.core import processFactory, processLogic, processLogicProperty
+from beenoculars.core import processFactory, processLogic, processLogicProperty, safe_call
+from beenoculars.core.executors import (
+    SequentialForkExecutor,
+    ThreadPoolForkExecutor,
+)
 from beenoculars.core.pipelines import (
     AbstractProcess,
     Dict,
@@ -12,6 +24,20 @@ from beenoculars.core.pipelines import (
     ProcessLogicProperty,
     ProcessPassThrough,
 )
+from beenoculars.core.caches import CachedProcess, DiskResultCache, ResultCache, digest
+from beenoculars.core.cancellation import (
+    CancellationToken,
+    PipelineCancelledException,
+    cancellable,
+    using_token,
+)
+from beenoculars.core.memo import StageMemo
+from beenoculars.core.payloads import Payload
+from beenoculars.core.profiling import Profiler, active_profiler
+from beenoculars.core.ragged import RaggedArray
+from beenoculars.core.runners import ProcessPoolRunner
+from beenoculars.core.schedulers import LatestWinsScheduler
+from beenoculars.core.streaming import StreamingExecutor
 
 # filepath: beenoculars/src/beenoculars/image_processing/test_pipelines.py
 
@@ -22,6 +48,22 @@ def test_dict_missing_key():
     assert d.missing_key is None
 
 
+def test_payload():
+    contours = (np.zeros((3, 1, 2)), np.ones((4, 1, 2)))
+    payload = Payload(contours=contours)
+    assert payload['missing_key'] is None
+    assert payload.missing_key is None
+    assert payload.contours is contours
+    payload.image = 1
+    assert payload | {"image": 2} == Payload(contours=contours, image=2)
+    # The values are not rebuilt by the conversion
+    d = payload.to_dict()
+    assert isinstance(d, Dict)
+    assert d.contours is contours
+    # The pipelines return a Dict
+    assert isinstance((ProcessPassThrough() >> ProcessPassThrough())(value=1), Dict)
+
+
 class TestIncompatibleProcess1(AbstractProcess):
     def __call__(self, image, **kwargs) -> Dict:
         return Dict(image=image, result="test1")
@@ -43,6 +85,68 @@ def test_incompatible_args_exception():
             " payload from the previous process 'TestIncompatibleProcess1'.")
 
 
+class StrictProcess(AbstractProcess):
+    outputs = ("value",)
+
+    def __call__(self, *, value, scale=1):
+        return Dict(value=value * scale)
+
+
+def test_contract_from_signature():
+    contract = StrictProcess().contract
+    assert contract.requires == {"value"}
+    assert contract.optional == {"scale"}
+    assert contract.outputs == {"value"}
+    assert not contract.accepts_any
+    assert TestProcess().contract.outputs is None
+    assert ProcessPassThrough().contract.reads is None
+
+
+def test_pipeline_validated_when_built():
+    # The 'image' and 'result' cannot be passed to StrictProcess
+    with pytest.raises(IncompatibleArgsException):
+        _ = TestIncompatibleProcess1() >> StrictProcess()
+    # Renaming a name that the branch never returns
+    with pytest.raises(IncompatibleArgsException):
+        _ = TestProcess() >> (StrictProcess() * StrictProcess()) / {0: [("image", "other")]}
+    # The 'contour' input of the pipeline is passed to StrictProcess, too
+    with pytest.raises(IncompatibleArgsException):
+        _ = StrictProcess() >> TestIncompatibleProcess2()
+    # The inputs of the pipeline
+    pipeline = DeclaredProcess() >> TestIncompatibleProcess2()
+    assert pipeline.contract.requires == {"image", "contour"}
+    assert pipeline(image=1, contour=2) == Dict(image=1, contour=2, result="test2")
+
+
+class DeclaredProcess(TestIncompatibleProcess1):
+    outputs = ("image", "result")
+
+
+class TypeErrorProcess(AbstractProcess):
+    def __call__(self, *, result, **kwargs) -> Dict:
+        return Dict(result=result + 1)
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_payload_checked_after_unknown_outputs(compiled):
+    # TestProcess does not declare its outputs, so 'contour' is
+    # checked when TestIncompatibleProcess2 is called.
+    pipeline = TestProcess() >> TestIncompatibleProcess2()
+    assert pipeline.contract.requires == set()
+    if compiled:
+        pipeline.compile()
+    with pytest.raises(IncompatibleArgsException, match="'TestIncompatibleProcess2' received"
+                       " incompatible payload from the previous process 'TestProcess'"):
+        pipeline()
+    assert pipeline(contour=1) == Dict(contour=1, result="test2")
+    # The TypeErrors raised by the processes are not hidden
+    pipeline = TestProcess() >> TypeErrorProcess()
+    if compiled:
+        pipeline.compile()
+    with pytest.raises(TypeError):
+        pipeline()
+
+
 class TestProcess(AbstractProcess):
     def __call__(self, **kwargs) -> Dict:
         return Dict(result="test")
@@ -209,3 +313,600 @@ def test_image_processing_pipeline_mul():
     assert isinstance(fork, ProcessFork)
     result = fork()
     assert result == (Dict(result="test"), Dict(result="test"))
+
+
+class SleepyProcess(AbstractProcess):
+    def __init__(self, name, delay):
+        self.name = name
+        self.delay = delay
+
+    def __call__(self, **kwargs) -> Dict:
+        time.sleep(self.delay)
+        return Dict(**{self.name: threading.current_thread().name})
+
+
+class FailingProcess(AbstractProcess):
+    def __init__(self, message):
+        self.message = message
+
+    def __call__(self, **kwargs) -> Dict:
+        raise RuntimeError(self.message)
+
+
+def test_thread_pool_fork_keeps_order():
+    fork = ProcessFork([SleepyProcess("first", 0.05),
+                        SleepyProcess("second", 0.0),
+                        SleepyProcess("third", 0.02)],
+                       executor=ThreadPoolForkExecutor(max_workers=2))
+    result = fork()
+    assert [list(d.keys()) for d in result] == [["first"], ["second"], ["third"]]
+    # The first branch runs in the calling thread, the rest on the pool.
+    assert result[0].first == threading.current_thread().name
+    assert result[1].second != result[0].first
+
+
+def test_thread_pool_fork_raises_first_failing_branch():
+    fork = ProcessFork([SleepyProcess("first", 0.0),
+                        FailingProcess("second"),
+                        FailingProcess("third")],
+                       executor=ThreadPoolForkExecutor(max_workers=2))
+    with pytest.raises(RuntimeError, match="second"):
+        fork()
+
+
+def test_sequential_fork_executor():
+    fork = ProcessFork([TestProcess(), FailingProcess("second")],
+                       executor=SequentialForkExecutor())
+    with pytest.raises(RuntimeError, match="second"):
+        fork()
+    fork[1] = TestAlternativeProcess()
+    assert fork() == (Dict(result="test"), Dict(result="test"))
+
+
+class InvertProcess(AbstractProcess):
+    def __call__(self, *, image, **kwargs) -> Dict:
+        return Dict(image=255 - image, sizes=[len(c) for c in kwargs["contours"]])
+
+
+def test_process_pool_runner_shares_arrays():
+    images = [np.full((4, 5, 3), i, dtype=np.uint8) for i in range(6)]
+    contours = [np.zeros((3, 1, 2), dtype=np.int32),
+                np.ones((5, 1, 2), dtype=np.int32)]
+    mask = np.arange(10)
+    pipeline = InvertProcess() >> ProcessPassThrough()
+    shm_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    with ProcessPoolRunner(pipeline, max_workers=2) as runner:
+        results = list(runner.map(Dict(image=image, contours=contours, mask=mask)
+                                  for image in images))
+    assert [int(r.image[0, 0, 0]) for r in results] == [255 - i for i in range(6)]
+    assert results[0].sizes == [3, 5]
+    assert [c.shape for c in results[0].contours] == [(3, 1, 2), (5, 1, 2)]
+    # Returned unchanged, so it is not copied back.
+    assert results[0].mask is mask
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) - shm_before == set()
+
+
+def test_process_pool_runner_cancels_when_the_stream_is_closed(caplog):
+    images = [np.full((4, 5, 3), i, dtype=np.uint8) for i in range(8)]
+    contours = [np.zeros((3, 1, 2), dtype=np.int32)]
+    shm_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+    with ProcessPoolRunner(InvertProcess(), max_workers=1) as runner:
+        results = runner.map((Dict(image=image, contours=contours) for image in images),
+                             max_inflight=4)
+        assert int(next(results).image[0, 0, 0]) == 255
+        results.close()
+        # The cancelled payloads are not received (nor logged) when they finish.
+        futures = [runner.submit(image=image, contours=contours) for image in images]
+        for future in futures[1:]:
+            future.cancel()
+        assert int(futures[0].result().image[0, 0, 0]) == 255
+    assert "exception calling callback" not in caplog.text
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) - shm_before == set()
+
+
+def test_ragged_array_selection_and_sharing(tmp_path):
+    arrays = [np.full((n, 1, 2), n, dtype=np.int32) for n in (3, 1, 4, 2)]
+    ragged = RaggedArray.from_arrays(arrays)
+    assert len(ragged) == 4 and ragged.is_compact
+    assert np.array_equal(ragged[2], arrays[2])
+    # The selection shares the values
+    selected = ragged[np.array([True, False, True, False])]
+    assert selected.values is ragged.values and not selected.is_compact
+    assert [len(a) for a in selected] == [3, 4]
+    assert selected.compact().values.shape == (7, 1, 2)
+    assert len(ragged[()]) == 0 and len(ragged[1:]) == 3
+    # The digest is the one of the items
+    assert digest(selected) == digest(RaggedArray.from_arrays([arrays[0], arrays[2]]))
+    assert digest(selected) != digest(ragged)
+    store = DiskResultCache(tmp_path / "analysis_cache", max_bytes=10**6)
+    assert store.put("key", Payload(contours=selected))
+    loaded = store.get("key").contours
+    assert isinstance(loaded, RaggedArray)
+    assert [a.tolist() for a in loaded] == [a.tolist() for a in selected]
+    with ProcessPoolRunner(InvertProcess() >> ProcessPassThrough(), max_workers=1) as runner:
+        results = list(runner.map([Dict(image=np.zeros((2, 2, 3), dtype=np.uint8),
+                                        contours=selected)]))
+    assert results[0].sizes == [3, 4]
+    assert results[0].contours is selected
+
+
+class ScaleProcess(AbstractProcess):
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __call__(self, *, value, **kwargs) -> Dict:
+        return Dict(value=value * self.factor)
+
+
+def _forked_pipeline():
+    double = ScaleProcess(2)
+    triple = ScaleProcess(3)
+    fork = ProcessFork([double >> triple, triple, ProcessPassThrough()]) / {
+        1: [("value", "tripled")]}
+    return double >> fork >> (ScaleProcess(10) * ProcessPassThrough())
+
+
+def test_compiled_pipeline_matches_interpreted():
+    expected = _forked_pipeline()(value=1, other="o")
+    pipeline = _forked_pipeline()
+    plan = pipeline.compile()
+    assert pipeline.compile() is plan
+    assert pipeline(value=1, other="o") == expected
+    assert expected == Dict(value=2, tripled=6, other="o")
+    # Nested pipelines are inlined; each fork/join is one stage.
+    assert len(plan) == 3
+    assert repr(plan).startswith("ScaleProcess[0->0] >> ForkJoin[0->0]")
+
+
+def test_compile_rejects_unjoined_fork():
+    pipeline = ImageProcessingPipeline([TestProcess(), TestProcess() * TestProcess()])
+    with pytest.raises(ValueError):
+        pipeline.compile()
+    joined = (TestProcess() * TestProcess()) / {2: [("result", "result2")]}
+    with pytest.raises(ValueError):
+        ImageProcessingPipeline([joined]).compile()
+
+
+def test_cached_process_factory_compiles_pipeline():
+    @processFactory(cache=True)
+    def factory_func(factor: int):
+        return ScaleProcess(factor) >> ScaleProcess(factor)
+
+    pipeline = factory_func(3)
+    assert pipeline._plan is not None
+    assert factory_func(3) is pipeline
+    assert pipeline(value=1) == Dict(value=9)
+
+
+class CountingProcess(AbstractProcess):
+    outputs = ("value",)
+
+    def __init__(self, factor=1):
+        self.factor = factor
+        self.calls = 0
+
+    def __call__(self, *, value, **kwargs):
+        self.calls += 1
+        return Dict(value=value * self.factor)
+
+
+class CountingOffsetProcess(AbstractProcess):
+    outputs = ("value",)
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, *, value, offset=0, **kwargs):
+        self.calls += 1
+        return Dict(value=value + offset)
+
+
+def test_memoized_pipeline_reruns_dependent_stages():
+    double = CountingProcess(2)
+    add = CountingOffsetProcess()
+    memo = StageMemo()
+    pipeline = (double >> add).memoize(memo)
+    assert pipeline(value=1, offset=1).value == 3
+    assert pipeline(value=1, offset=1).value == 3
+    assert (double.calls, add.calls) == (1, 1)
+    # Only the stage that reads 'offset' runs again
+    assert pipeline(value=1, offset=5).value == 7
+    assert (double.calls, add.calls) == (1, 2)
+    assert pipeline(value=2, offset=5).value == 9
+    assert (double.calls, add.calls) == (2, 3)
+    assert (memo.hits, memo.misses) == (3, 5)
+    # Impure processes are never memoized
+    assert not StageMemo.is_memoizable(ProcessLogicProperty(lambda caller, **kwargs: Dict()))
+
+
+def test_memoized_pipeline_hits_with_writeable_arrays():
+    scale = ProcessLogic(lambda value, contours, **kwargs: Dict(value=value * len(contours)),
+                         outputs=("value",))
+    add = CountingOffsetProcess()
+    memo = StageMemo()
+    pipeline = (scale >> add).memoize(memo)
+    value = np.ones((4, 4), dtype=np.float32)
+    contours = RaggedArray.from_arrays([np.zeros((2, 1, 2), dtype=np.int32)])
+    # Every run views the writeable arrays read-only, the views are new ones
+    for offset in (1, 1, 5):
+        pipeline(value=value, offset=offset, contours=contours)
+    assert (memo.hits, memo.misses) == (3, 3)
+    assert value.flags.writeable and contours.values.flags.writeable
+    # They are compared by their content
+    pipeline(value=value.copy(), offset=5, contours=contours)
+    assert (memo.hits, memo.misses) == (5, 3)
+    # So the changes in-place are not missed
+    value[0, 0] = 2
+    assert pipeline(value=value, offset=5, contours=contours).value[0, 0] == 7
+    assert (memo.hits, memo.misses) == (5, 5)
+
+
+def test_cached_process_by_content():
+    scale = ScaleProcess(3)
+    cache = ResultCache(max_bytes=2 * 400)
+    cached = scale.cached(cache)
+    value = np.ones((10, 10), dtype=np.float32)
+    first = cached(value=value)
+    # Another array with the same content is a hit
+    second = cached(value=value.copy())
+    assert second is first
+    assert not first["value"].flags.writeable
+    assert (cache.hits, cache.misses) == (1, 1)
+    # Another instance with other parameters does not share the results
+    assert ScaleProcess(4).cached(cache)(value=value)["value"][0, 0] == 4
+    # A result of 400 bytes per array: the oldest is evicted
+    cached(value=value * 2)
+    assert len(cache) == 2 and cache.evictions == 1
+    assert cache.nbytes <= cache.max_bytes
+    # The cached process keeps the contract of the process
+    assert isinstance(cached, CachedProcess)
+    assert cached.contract.requires == scale.contract.requires
+
+
+def test_disk_result_cache(tmp_path):
+    contours = (np.arange(6, dtype=np.int32).reshape(3, 1, 2),
+                np.arange(8, dtype=np.int32).reshape(4, 1, 2))
+    result = Payload(contours=contours,
+                     areas=np.array([1.0, 2.0]),
+                     masks=(),
+                     count=2)
+    store = DiskResultCache(tmp_path / "analysis_cache", max_bytes=10**6)
+    assert store.put("key", result)
+    # The store survives a restart of the app
+    store = DiskResultCache(tmp_path / "analysis_cache", max_bytes=10**6)
+    loaded = store.get("key")
+    assert isinstance(loaded.contours, tuple)
+    assert all(np.array_equal(a, b) for a, b in zip(loaded.contours, contours))
+    assert not loaded.contours[0].flags.writeable
+    assert np.array_equal(loaded.areas, result.areas)
+    assert loaded.masks == () and loaded.count == 2
+    assert store.get("other") is None
+    assert (store.hits, store.misses) == (1, 1)
+    # Values that cannot be stored
+    assert not store.put("object", Payload(value=object()))
+    # The least recently used results are deleted
+    store.max_bytes = store.nbytes + 1
+    store.put("key2", result)
+    assert len(store) == 1 and store.evictions == 1
+    # A memory cache reads its misses from the store
+    cache = ResultCache(store=store)
+    assert cache.get("key2").count == 2
+    assert cache.hits == 1 and len(cache) == 1
+
+
+def test_pipeline_map_streams_payloads():
+    pipeline = ScaleProcess(2) >> ScaleProcess(3)
+    pulled = []
+
+    def payloads():
+        for i in range(20):
+            pulled.append(i)
+            yield Dict(value=i)
+
+    results = pipeline.map(payloads(), workers=2, max_inflight=3)
+    assert next(results).value == 0
+    # Only a bounded number of payloads are read ahead
+    assert len(pulled) <= 4
+    assert [r.value for r in results] == [6 * i for i in range(1, 20)]
+    unordered = pipeline.map((Dict(value=i) for i in range(20)), workers=4, ordered=False)
+    assert sorted(r.value for r in unordered) == [6 * i for i in range(20)]
+    assert [r.value for r in pipeline.map([Dict(value=1)], workers=1)] == [6]
+
+
+def test_fork_branches_share_common_prefixes():
+    double = CountingProcess(2)
+    triple = CountingProcess(3)
+    replicated = (double >> triple) * 3 / {1: [("value", "second")],
+                                           2: [("value", "third")]}
+    pipeline = CountingProcess() >> replicated
+    expected = pipeline(value=1)
+    assert (double.calls, triple.calls) == (3, 3)
+    plan = pipeline.compile()
+    assert pipeline(value=1) == expected == Dict(value=6, second=6, third=6)
+    assert (double.calls, triple.calls) == (4, 4)
+    # The branches only copy the shared scope
+    assert all(len(stages) == 1 for stages in plan.stages[1].branches)
+    # Only the common prefix is shared
+    branches = ProcessFork([double >> triple, double >> CountingProcess(5), double])
+    pipeline = ImageProcessingPipeline([branches / {1: [("value", "other")]}])
+    expected = pipeline(value=1)
+    double.calls = 0
+    pipeline.compile()
+    assert pipeline(value=1) == expected == Dict(value=2, other=10)
+    assert double.calls == 2
+    assert repr(pipeline.compile()).startswith("(Copy[0->4] >> CountingProcess[4->4]")
+
+
+class ContoursLikeProcess(AbstractProcess):
+    outputs = ("contours", "hierarchy")
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, *, value, **kwargs):
+        self.calls += 1
+        return Dict(contours=[value], hierarchy=np.zeros(1000))
+
+
+def test_liveness_prunes_unread_stages_and_names():
+    contours = ContoursLikeProcess()
+    unused = CountingProcess(7)
+    counted = ProcessLogic(lambda contours, **kwargs: Dict(count=len(contours)),
+                           outputs=("count",))
+    fork = ProcessFork([contours >> counted, unused, ProcessPassThrough()]) / {
+        1: [("value", "unused")]}
+    pipeline = CountingProcess(2) >> fork >> CountingProcess(3)
+    expected = pipeline(value=1)
+    assert expected.hierarchy is not None and expected.unused is not None
+
+    plan = pipeline.compile(outputs=("value", "count"))
+    assert pipeline.compile() is plan
+    assert pipeline(value=1) == Dict(value=6, count=1)
+    # The branch of 'unused' is pruned and 'hierarchy' is dropped in its branch
+    unused.calls = 0
+    pipeline(value=1)
+    assert unused.calls == 0
+    fork_stage = plan.stages[1]
+    assert fork_stage.branches[1] == []
+    assert repr(fork_stage.branches[0][-1]) == "Retain[1]{count, value}"
+    # The pure stages that only return unread names are pruned, too
+    pipeline = CountingProcess(2) >> contours >> counted
+    pipeline.compile(outputs=("value",))
+    contours.calls = 0
+    assert pipeline(value=1) == Dict(value=2)
+    assert contours.calls == 0 and len(pipeline.compile()) == 1
+
+
+class LazyContoursProcess(ContoursLikeProcess):
+    lazy_outputs = ("hierarchy",)
+
+    def __init__(self, hierarchy=True):
+        super().__init__()
+        self.hierarchy = hierarchy
+        if not hierarchy:
+            self.outputs = ("contours",)
+
+    def __call__(self, *, value, **kwargs):
+        self.calls += 1
+        if not self.hierarchy:
+            return Dict(contours=[value])
+        return Dict(contours=[value], hierarchy=np.zeros(1000))
+
+    def without(self, names):
+        return LazyContoursProcess(hierarchy=False) if "hierarchy" in names else self
+
+
+def test_liveness_drops_unread_lazy_outputs():
+    contours = LazyContoursProcess()
+    counted = ProcessLogic(lambda contours, **kwargs: Dict(count=len(contours)),
+                           outputs=("count",))
+    pipeline = contours >> counted
+    assert "hierarchy" in pipeline(value=1)
+    pipeline.compile(outputs=("count", "hierarchy"))
+    assert pipeline.compile().stages[0].process is contours
+    # In a chain and in a branch, without the hierarchy
+    pipeline.compile(outputs=("count",))
+    assert pipeline.compile().stages[0].process.hierarchy is False
+    assert pipeline(value=1) == Dict(count=1)
+    forked = (contours * ProcessPassThrough()) >> counted
+    forked.compile(outputs=("count", "value"))
+    branch = forked.compile().stages[0].branches[0][0]
+    assert branch.process.hierarchy is False
+    assert forked(value=1) == Dict(count=1, value=1)
+    # The cached processes are cached by another namespace, once
+    cache = ResultCache()
+    cached = contours.cached(cache)
+    assert cached.lazy_outputs == ("hierarchy",)
+    without = cached.without(frozenset({"hierarchy"}))
+    assert without is cached.without(frozenset({"hierarchy"}))
+    assert without.outputs == ("contours",) and without.namespace != cached.namespace
+    assert without(value=1) == Dict(contours=[1]) and len(cache) == 1
+    # The processes have no lazy outputs by default
+    counting = CountingProcess(2)
+    assert counting.without(frozenset({"value"})) is counting
+
+
+class ThreadNameProcess(AbstractProcess):
+    def __init__(self, name, main_thread=False):
+        self.name = name
+        self.main_thread = main_thread
+
+    def __call__(self, **kwargs) -> Dict:
+        return Dict(**{self.name: threading.current_thread().name})
+
+
+def test_aprocess_runs_off_the_event_loop():
+    pipeline = (ThreadNameProcess("worker") >>
+                ThreadNameProcess("gui", main_thread=True) >>
+                ThreadNameProcess("worker_2"))
+
+    async def main():
+        result = await pipeline.aprocess(value=1)
+        return result, threading.current_thread().name
+
+    result, loop_thread = asyncio.run(main())
+    assert isinstance(result, Dict) and result.value == 1
+    assert result.gui == loop_thread
+    assert result.worker.startswith("beenoculars-async")
+    assert result.worker_2.startswith("beenoculars-async")
+    assert len(pipeline.compile().segments) == 3
+
+
+@pytest.mark.parametrize("cancel_stale", [False, True])
+def test_latest_wins_scheduler(cancel_stale):
+    pipeline = ThreadNameProcess("worker") >> SleepyProcess("sleepy", 0.05)
+    scheduler = LatestWinsScheduler(cancel_stale=cancel_stale)
+    started = []
+
+    def run(value):
+        started.append(value)
+        return pipeline.aprocess(value=value)
+
+    async def main():
+        runs = [scheduler.submit(lambda value=value: run(value)) for value in range(5)]
+        return await asyncio.gather(*runs)
+
+    results = asyncio.run(main())
+    # The first one was in flight, the last one has replaced the pending ones
+    assert started == [0, 4]
+    assert results[4].value == 4
+    assert results[1:4] == [None] * 3
+    assert (results[0] is None) == cancel_stale
+    assert scheduler.dropped == (4 if cancel_stale else 3)
+    assert not scheduler.busy
+
+
+class ArrayScaleProcess(AbstractProcess):
+    outputs = ("image",)
+
+    def __call__(self, image, **kwargs) -> Dict:
+        return Payload(image=image * 2)
+
+
+def test_profiler_records_stages(tmp_path):
+    image = np.ones((10, 10), np.uint8)
+    for compiled in (False, True):
+        pipeline = ArrayScaleProcess() >> _forked_pipeline()
+        if compiled:
+            pipeline.compile()
+        assert active_profiler() is None
+        with Profiler() as profiler:
+            result = pipeline(image=image, value=1)
+        assert result.value == 2 and result.tripled == 6 and result.image.sum() == 200
+        assert active_profiler() is None
+        stats = profiler.stats()
+        # double, (double >> triple) * triple, and the last fork
+        assert stats["ScaleProcess"].calls == 5
+        assert stats["ArrayScaleProcess"].calls == 1
+        assert stats["ArrayScaleProcess"].bytes_in == 100
+        assert stats["ArrayScaleProcess"].bytes_out == 100
+        assert ("ForkJoin" in stats) == compiled
+        assert ("ProcessFork" in stats) != compiled
+        assert "ArrayScaleProcess" in profiler.summary()
+    profiler.save_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as f:
+        events = json.load(f)["traceEvents"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert len(spans) == len(profiler.spans)
+    assert all(e["dur"] >= 0 and "tid" in e for e in spans)
+
+
+def test_cancellation_token_stops_pipelines(caplog):
+    token = CancellationToken()
+    calls = []
+
+    class CancellingProcess(AbstractProcess):
+        def __call__(self, **kwargs) -> Dict:
+            calls.append(1)
+            token.cancel()
+            return Dict()
+
+    for compiled in (False, True):
+        calls.clear()
+        pipeline = CancellingProcess() >> CancellingProcess() >> _forked_pipeline()
+        if compiled:
+            pipeline.compile()
+        with using_token(token), pytest.raises(PipelineCancelledException):
+            pipeline(value=1)
+        assert calls == [1]
+        token = CancellationToken()
+    # A child token is cancelled with its parent
+    assert CancellationToken(parent=token).cancelled is False
+    token.cancel()
+    assert CancellationToken(parent=token).cancelled is True
+    # safe_call does not log a cancelled run as an error
+    log = logging.getLogger("test_cancellation")
+    with using_token(token), caplog.at_level(logging.DEBUG):
+        assert safe_call(log)(lambda: list(cancellable(range(10))))() is None
+    assert [record.levelno for record in caplog.records] == [logging.DEBUG]
+    assert list(cancellable(range(10))) == list(range(10))
+
+
+def test_cancelled_aprocess_stops_its_stages():
+    started = threading.Event()
+    calls = []
+
+    class WaitingProcess(AbstractProcess):
+        def __call__(self, **kwargs) -> Dict:
+            calls.append(1)
+            started.set()
+            time.sleep(0.05)
+            return Dict()
+
+    pipeline = WaitingProcess() >> WaitingProcess() >> WaitingProcess()
+
+    async def main():
+        task = asyncio.ensure_future(pipeline.aprocess(value=1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    time.sleep(0.1)
+    assert calls == [1]
+
+
+class DelayProcess(AbstractProcess):
+    outputs = ("value",)
+
+    def __init__(self, delay, factor=1):
+        self.delay = delay
+        self.factor = factor
+
+    def __call__(self, *, value, **kwargs) -> Dict:
+        time.sleep(self.delay)
+        return Dict(value=value * self.factor)
+
+
+def test_streaming_executor_overlaps_stages():
+    pipeline = (DelayProcess(0.02, 2) >> DelayProcess(0.02, 3) >>
+                DelayProcess(0.02, 5))
+    frames = [Dict(value=v) for v in range(12)]
+    start = time.perf_counter()
+    with StreamingExecutor(pipeline, queue_size=2) as executor:
+        results = [r.value for r in executor.map(iter(frames))]
+    elapsed = time.perf_counter() - start
+    assert results == [v * 30 for v in range(12)]
+    # The sequential run takes 12 * 0.06 s
+    assert elapsed < 0.6
+    stats = executor.stats()
+    assert [s.puts for s in stats] == [13] * 4
+    assert all(s.max_depth <= 2 for s in stats)
+
+
+def test_streaming_executor_backpressure_and_errors():
+    # The slow last stage blocks the first ones
+    pipeline = DelayProcess(0, 2) >> DelayProcess(0.02)
+    with StreamingExecutor(pipeline, queue_size=1) as executor:
+        assert len(list(executor.map(Dict(value=v) for v in range(8)))) == 8
+    assert executor.stats()[0].blocked > 0
+    assert "DelayProcess" in executor.summary()
+    # An error is raised at its frame and closes the stream
+    pipeline = DelayProcess(0, 2) >> FailingProcess("stage")
+    executor = StreamingExecutor(pipeline)
+    with pytest.raises(RuntimeError, match="stage"):
+        list(executor.map(Dict(value=v) for v in range(4)))
+    assert executor._threads == []